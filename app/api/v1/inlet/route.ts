@@ -2,12 +2,14 @@ import { NextResponse } from "next/server";
 import { getOrCreateUser } from "@/lib/db/users";
 import { query } from "@/lib/db/client";
 import { getModelInletCost } from "@/lib/utils/inlet-cost";
+import { readJsonBody, requestErrorStatus } from "@/lib/utils/request-body";
 
 export async function POST(req: Request) {
   try {
-    const data = await req.json();
+    const data = await readJsonBody(req);
     const user = await getOrCreateUser(data.user);
-    const modelId = data.body?.model;
+    // Compact (version 2) requests carry the model id at the top level.
+    const modelId = data.model ?? data.body?.model;
 
     if (user.deleted) {
       return NextResponse.json({
@@ -57,7 +59,7 @@ export async function POST(req: Request) {
           error instanceof Error ? error.message : "Error dealing with request",
         error_type: error instanceof Error ? error.name : "UNKNOWN_ERROR",
       },
-      { status: 500 }
+      { status: requestErrorStatus(error) }
     );
   }
 }
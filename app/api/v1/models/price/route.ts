@@ -1,6 +1,7 @@
 import { NextRequest, NextResponse } from "next/server";
 import { updateModelPrice } from "@/lib/db/client";
 import { verifyApiToken } from "@/lib/auth";
+import { invalidatePriceTable } from "@/lib/utils/price-table";
 
 interface PriceUpdate {
   id: string;
@@ -100,6 +101,7 @@ export async function POST(request: NextRequest) {
 
     const successCount = results.filter((r) => r.success).length;
     console.log(`Successfully updated prices of ${successCount} models`);
+    invalidatePriceTable();
 
     return NextResponse.json({
       success: true,
@@ -0,0 +1,55 @@
+import { NextResponse } from "next/server";
+import { getInletCostConfig } from "@/lib/utils/inlet-cost";
+import { getPriceTable } from "@/lib/utils/price-table";
+import { getDefaultModelPrice } from "@/lib/utils/usage";
+
+/**
+ * Price table for the filter's cost estimates and local costs. Unlike GET
+ * /api/v1/models this never calls Open WebUI. Models without a row are billed
+ * at the default prices, sent as `default`. `inlet_cost` is COST_ON_INLET:
+ * the filter only skips the inlet call for models it shows no inlet cost for.
+ * The ETag is the price table version, so an unchanged table costs the filter
+ * a 304 and no body.
+ */
+export async function GET(req: Request) {
+  try {
+    const table = await getPriceTable();
+    const etag = `"${table.version}"`;
+    if (req.headers.get("if-none-match") === etag) {
+      return new Response(null, { status: 304, headers: { ETag: etag } });
+    }
+
+    const defaultPrice = getDefaultModelPrice("default");
+    return NextResponse.json(
+      {
+        success: true,
+        version: table.version,
+        models: Array.from(table.prices.values()).map((price) => ({
+          id: price.id,
+          input_price: price.input_price,
+          output_price: price.output_price,
+          per_msg_price: price.per_msg_price,
+        })),
+        default: defaultPrice
+          ? {
+              input_price: defaultPrice.input_price,
+              output_price: defaultPrice.output_price,
+            }
+          : null,
+        inlet_cost: getInletCostConfig(),
+      },
+      { headers: { ETag: etag } }
+    );
+  } catch (error) {
+    console.error("Error fetching model prices:", error);
+    return NextResponse.json(
+      {
+        success: false,
+        error:
+          error instanceof Error ? error.message : "Failed to fetch prices",
+        error_type: error instanceof Error ? error.name : "UNKNOWN_ERROR",
+      },
+      { status: 500 }
+    );
+  }
+}
@@ -1,6 +1,7 @@
 import { NextRequest, NextResponse } from "next/server";
 import { pool } from "@/lib/db/client";
 import { verifyApiToken } from "@/lib/auth";
+import { invalidatePriceTable } from "@/lib/utils/price-table";
 
 export async function POST(request: NextRequest) {
   const authError = verifyApiToken(request);
@@ -88,6 +89,7 @@ export async function POST(request: NextRequest) {
       }
 
       const successCount = syncResults.filter((r) => r.success).length;
+      invalidatePriceTable();
 
       return NextResponse.json({
         success: true,
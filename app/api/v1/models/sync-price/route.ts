@@ -1,6 +1,7 @@
 import { NextRequest, NextResponse } from "next/server";
 import { pool } from "@/lib/db/client";
 import { verifyApiToken } from "@/lib/auth";
+import { invalidatePriceTable } from "@/lib/utils/price-table";
 
 export async function POST(request: NextRequest) {
   const authError = verifyApiToken(request);
@@ -84,6 +85,7 @@ export async function POST(request: NextRequest) {
       );
 
       const updatedModel = updateResult.rows[0];
+      invalidatePriceTable();
 
       return NextResponse.json({
         success: true,
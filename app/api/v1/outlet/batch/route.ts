@@ -0,0 +1,378 @@
+import { NextResponse } from "next/server";
+import { Pool, PoolClient } from "pg";
+import { createClient } from "@vercel/postgres";
+import { getClient } from "@/lib/db/client";
+import { getModelInletCost } from "@/lib/utils/inlet-cost";
+import {
+  DeltaUpload,
+  loadChatTotals,
+  rememberChatTotals,
+} from "@/lib/utils/chat-delta";
+import {
+  billedUsageKey,
+  findBilledUsage,
+  isDuplicateKeyError,
+} from "@/lib/utils/idempotency";
+import { getPriceTableVersion } from "@/lib/utils/price-table";
+import { readJsonBody, requestErrorStatus } from "@/lib/utils/request-body";
+import {
+  ModelPrice,
+  UsageRequest,
+  calculateCost,
+  countTokens,
+  decodeTokensPerSec,
+  getModelPrices,
+  parseUsageRequest,
+  verifyPrecomputedCost,
+} from "@/lib/utils/usage";
+
+const isVercel = process.env.VERCEL === "1";
+const MAX_BATCH_SIZE = 500;
+// Concurrent deliveries of events in this batch that may commit while it bills.
+const MAX_DUPLICATE_RETRIES = 3;
+
+interface UsageEvent {
+  userId: string;
+  userName: string;
+  modelId: string;
+  inputTokens: number;
+  outputTokens: number;
+  totalCost: number;
+  actualCost: number;
+  ttftMs: number | null;
+  decodeTokensPerSec: number | null;
+  jitterMs: number | null;
+  delta?: DeltaUpload;
+  costVerified: boolean | null;
+  idempotencyKey?: string;
+}
+
+interface BilledEvent {
+  index: number;
+  event: UsageEvent;
+  balance: number;
+}
+
+type EventResult =
+  | {
+      success: true;
+      inputTokens: number;
+      outputTokens: number;
+      totalCost: number;
+      newBalance: number;
+      costVerified?: boolean;
+      duplicate?: boolean;
+    }
+  | { success: false; error: string; error_type: string };
+
+function failure(error: unknown): EventResult {
+  return {
+    success: false,
+    error: error instanceof Error ? error.message : String(error),
+    error_type: error instanceof Error ? error.name : "UNKNOWN_ERROR",
+  };
+}
+
+function prepareEvent(
+  data: UsageRequest,
+  prices: Map<string, ModelPrice | null>
+): UsageEvent {
+  const modelId = data.modelId;
+  const modelPrice = prices.get(modelId);
+  if (!modelPrice) {
+    throw new Error(`Fail to fetch price info of model ${modelId}`);
+  }
+
+  const { inputTokens, outputTokens } = countTokens(data);
+  const totalCost = calculateCost(modelPrice, inputTokens, outputTokens);
+
+  return {
+    userId: data.user.id,
+    userName: data.user.name || "Unknown User",
+    modelId,
+    inputTokens,
+    outputTokens,
+    totalCost,
+    // A turn admitted without an inlet call was never charged the inlet cost.
+    actualCost: totalCost - (data.inletSkipped ? 0 : getModelInletCost(modelId)),
+    ttftMs: data.timing?.ttft_ms ?? null,
+    decodeTokensPerSec: decodeTokensPerSec(data.timing, outputTokens),
+    jitterMs: data.timing?.jitter_ms ?? null,
+    delta: data.delta,
+    costVerified: verifyPrecomputedCost(
+      data,
+      totalCost,
+      getPriceTableVersion()
+    ),
+    idempotencyKey: data.idempotencyKey,
+  };
+}
+
+/**
+ * Bill the prepared events on `db` and return the rows inserted for them.
+ * Duplicates and per-event failures are written to `results`. A concurrent
+ * delivery of one of the events makes the insert fail with a duplicate key.
+ */
+async function billEvents(
+  db: PoolClient,
+  prepared: { index: number; event: UsageEvent }[],
+  results: EventResult[]
+): Promise<BilledEvent[]> {
+  // Events billed by an earlier delivery get their original result back.
+  const billed = await findBilledUsage(
+    db,
+    prepared
+      .filter(({ event }) => event.idempotencyKey)
+      .map(({ event }) => ({
+        userId: event.userId,
+        key: event.idempotencyKey!,
+      }))
+  );
+  const batchKeys = new Set<string>();
+  const pending = prepared.filter(({ index, event }) => {
+    if (!event.idempotencyKey) {
+      return true;
+    }
+    const key = billedUsageKey(event.userId, event.idempotencyKey);
+    const previous = billed.get(key);
+    if (previous) {
+      results[index] = { success: true, ...previous, duplicate: true };
+      return false;
+    }
+    if (batchKeys.has(key)) {
+      results[index] = failure(
+        new Error("Event repeats an idempotency key of this batch")
+      );
+      return false;
+    }
+    batchKeys.add(key);
+    return true;
+  });
+
+  const costByUser = new Map<string, number>();
+  pending.forEach(({ event }) => {
+    costByUser.set(
+      event.userId,
+      (costByUser.get(event.userId) ?? 0) + event.actualCost
+    );
+  });
+
+  const balanceResult = await db.query(
+    `UPDATE users
+     SET balance = LEAST(
+       users.balance - CAST(v.cost AS DECIMAL(16,4)),
+       999999.9999
+     )
+     FROM (
+       SELECT unnest($1::text[]) AS id, unnest($2::numeric[]) AS cost
+     ) v
+     WHERE users.id = v.id
+     RETURNING users.id, users.balance`,
+    [Array.from(costByUser.keys()), Array.from(costByUser.values())]
+  );
+
+  const finalBalances = new Map<string, number>();
+  balanceResult.rows.forEach((row: { id: string; balance: string }) => {
+    const balance = Number(row.balance);
+    if (balance > 999999.9999) {
+      throw new Error("Balance exceeds maximum allowed value");
+    }
+    finalBalances.set(row.id, balance);
+  });
+
+  // Walk each user's events in order so balance_after matches what
+  // sequential single-event outlets would have recorded.
+  const runningBalances = new Map<string, number>();
+  finalBalances.forEach((balance, userId) => {
+    runningBalances.set(userId, balance + costByUser.get(userId)!);
+  });
+
+  const rows: BilledEvent[] = [];
+  pending.forEach(({ index, event }) => {
+    const running = runningBalances.get(event.userId);
+    if (running === undefined) {
+      results[index] = failure(new Error("User does not exist"));
+      return;
+    }
+    const balance = running - event.actualCost;
+    runningBalances.set(event.userId, balance);
+    rows.push({ index, event, balance });
+  });
+
+  if (rows.length > 0) {
+    await db.query(
+      `INSERT INTO user_usage_records (
+        user_id, nickname, model_name,
+        input_tokens, output_tokens,
+        cost, balance_after,
+        ttft_ms, decode_tokens_per_sec, jitter_ms,
+        idempotency_key
+      )
+      SELECT * FROM unnest(
+        $1::text[], $2::text[], $3::text[],
+        $4::int[], $5::int[],
+        $6::numeric[], $7::numeric[],
+        $8::real[], $9::real[], $10::real[],
+        $11::text[]
+      )`,
+      [
+        rows.map(({ event }) => event.userId),
+        rows.map(({ event }) => event.userName),
+        rows.map(({ event }) => event.modelId),
+        rows.map(({ event }) => event.inputTokens),
+        rows.map(({ event }) => event.outputTokens),
+        rows.map(({ event }) => event.totalCost),
+        rows.map(({ balance }) => balance),
+        rows.map(({ event }) => event.ttftMs),
+        rows.map(({ event }) => event.decodeTokensPerSec),
+        rows.map(({ event }) => event.jitterMs),
+        rows.map(({ event }) => event.idempotencyKey ?? null),
+      ]
+    );
+  }
+
+  return rows;
+}
+
+export async function POST(req: Request) {
+  let db: PoolClient | null = null;
+
+  try {
+    const data = await readJsonBody(req);
+    const events: any[] = Array.isArray(data.events) ? data.events : [];
+
+    if (events.length === 0 || events.length > MAX_BATCH_SIZE) {
+      return NextResponse.json(
+        {
+          success: false,
+          error: `Batch must contain between 1 and ${MAX_BATCH_SIZE} events`,
+          error_type: "INVALID_BATCH",
+        },
+        { status: 400 }
+      );
+    }
+
+    const modelIds = Array.from(
+      new Set(
+        events
+          .map((event) => event?.model ?? event?.body?.model)
+          .filter((modelId) => typeof modelId === "string")
+      )
+    ) as string[];
+    const prices = await getModelPrices(modelIds);
+
+    const results: EventResult[] = new Array(events.length);
+    const requests: { index: number; data: UsageRequest }[] = [];
+    events.forEach((event, index) => {
+      try {
+        requests.push({ index, data: parseUsageRequest(event) });
+      } catch (error) {
+        results[index] = failure(error);
+      }
+    });
+
+    await loadChatTotals(
+      requests.flatMap(({ data }) =>
+        data.delta && typeof data.user?.id === "string"
+          ? [{ userId: data.user.id, delta: data.delta }]
+          : []
+      )
+    );
+
+    const prepared: { index: number; event: UsageEvent }[] = [];
+    requests.forEach(({ index, data }) => {
+      try {
+        prepared.push({ index, event: prepareEvent(data, prices) });
+      } catch (error) {
+        results[index] = failure(error);
+      }
+    });
+
+    if (prepared.length > 0) {
+      const client = await getClient();
+      // The Vercel client is a pg Client, so it shares PoolClient's query API.
+      db = isVercel
+        ? (client as ReturnType<typeof createClient> as unknown as PoolClient)
+        : await (client as Pool).connect();
+
+      await db.query("BEGIN");
+
+      let rows: BilledEvent[] = [];
+      for (let attempt = 0; ; attempt++) {
+        await db.query("SAVEPOINT bill_batch");
+        try {
+          rows = await billEvents(db, prepared, results);
+          break;
+        } catch (error) {
+          if (!isDuplicateKeyError(error) || attempt >= MAX_DUPLICATE_RETRIES) {
+            throw error;
+          }
+          // A concurrent delivery committed one of these events first. Undo
+          // only this attempt; the next one answers that event as a duplicate.
+          await db.query("ROLLBACK TO SAVEPOINT bill_batch");
+        }
+      }
+
+      await db.query("COMMIT");
+
+      await rememberChatTotals(
+        rows.flatMap(({ event }) =>
+          event.delta
+            ? [
+                {
+                  userId: event.userId,
+                  delta: event.delta,
+                  totalTokens: event.inputTokens + event.outputTokens,
+                },
+              ]
+            : []
+        )
+      );
+
+      rows.forEach(({ index, event, balance }) => {
+        results[index] = {
+          success: true,
+          inputTokens: event.inputTokens,
+          outputTokens: event.outputTokens,
+          totalCost: event.totalCost,
+          newBalance: balance,
+          ...(event.costVerified === null
+            ? {}
+            : { costVerified: event.costVerified }),
+        };
+      });
+    }
+
+    console.log(
+      JSON.stringify({
+        success: true,
+        events: events.length,
+        failed: results.filter((result) => !result.success).length,
+      })
+    );
+
+    return NextResponse.json({
+      success: true,
+      results,
+      message: "Request successful",
+    });
+  } catch (error) {
+    if (db) {
+      await db.query("ROLLBACK");
+    }
+    console.error("Outlet batch error:", error);
+    return NextResponse.json(
+      {
+        success: false,
+        error:
+          error instanceof Error ? error.message : "Error processing request",
+        error_type: error instanceof Error ? error.name : "UNKNOWN_ERROR",
+      },
+      { status: requestErrorStatus(error) }
+    );
+  } finally {
+    if (!isVercel && db && "release" in db) {
+      db.release();
+    }
+  }
+}
@@ -1,128 +1,97 @@
 import { NextResponse } from "next/server";
-import { encode } from "gpt-tokenizer/model/gpt-4";
 import { Pool, PoolClient } from "pg";
 import { createClient } from "@vercel/postgres";
 import { query, getClient } from "@/lib/db/client";
 import { getModelInletCost } from "@/lib/utils/inlet-cost";
+import {
+  DeltaPrefixMismatchError,
+  loadChatTotals,
+  rememberChatTotals,
+} from "@/lib/utils/chat-delta";
+import {
+  BilledUsage,
+  billedUsageKey,
+  findBilledUsage,
+  isDuplicateKeyError,
+} from "@/lib/utils/idempotency";
+import { getPriceTableVersion } from "@/lib/utils/price-table";
+import { readJsonBody, requestErrorStatus } from "@/lib/utils/request-body";
+import {
+  calculateCost,
+  countTokens,
+  decodeTokensPerSec,
+  getModelPrice,
+  parseUsageRequest,
+  verifyPrecomputedCost,
+} from "@/lib/utils/usage";
 
 const isVercel = process.env.VERCEL === "1";
 
-interface Message {
-  role: string;
-  content: string;
-}
-
-interface ModelPrice {
-  id: string;
-  name: string;
-  input_price: number;
-  output_price: number;
-  per_msg_price: number;
-}
-
-type DbClient = ReturnType<typeof createClient> | Pool | PoolClient;
-
-async function getModelPrice(modelId: string): Promise<ModelPrice | null> {
-  const result = await query(
-    `SELECT id, name, input_price, output_price, per_msg_price 
-     FROM model_prices 
-     WHERE id = $1`,
-    [modelId]
-  );
-
-  if (result.rows[0]) {
-    return result.rows[0];
-  }
-
-  const defaultInputPrice = parseFloat(
-    process.env.DEFAULT_MODEL_INPUT_PRICE || "60"
-  );
-  const defaultOutputPrice = parseFloat(
-    process.env.DEFAULT_MODEL_OUTPUT_PRICE || "60"
-  );
-
-  if (
-    isNaN(defaultInputPrice) ||
-    defaultInputPrice < 0 ||
-    isNaN(defaultOutputPrice) ||
-    defaultOutputPrice < 0
-  ) {
-    return null;
-  }
-
-  return {
-    id: modelId,
-    name: modelId,
-    input_price: defaultInputPrice,
-    output_price: defaultOutputPrice,
-    per_msg_price: -1,
-  };
+function duplicateResponse(usage: BilledUsage) {
+  return NextResponse.json({
+    success: true,
+    ...usage,
+    duplicate: true,
+    message: "Request already billed",
+  });
 }
 
 export async function POST(req: Request) {
-  const client = (await getClient()) as DbClient;
-  let pgClient: DbClient | null = null;
+  let db: PoolClient | null = null;
+  let idempotency: { userId: string; key: string } | null = null;
 
   try {
-    if (isVercel) {
-      pgClient = client;
-    } else {
-      pgClient = await (client as Pool).connect();
-    }
-
-    const data = await req.json();
-    const modelId = data.body.model;
+    const data = parseUsageRequest(await readJsonBody(req));
+    const modelId = data.modelId;
     const userId = data.user.id;
     const userName = data.user.name || "Unknown User";
+    if (data.idempotencyKey) {
+      idempotency = { userId, key: data.idempotencyKey };
+    }
+    if (data.delta) {
+      await loadChatTotals([{ userId, delta: data.delta }]);
+    }
 
-    await query("BEGIN");
+    const client = await getClient();
+    // Run the whole outlet on one connection so BEGIN/COMMIT cover it; the
+    // Vercel client is a pg Client, so it shares PoolClient's query API.
+    db = isVercel
+      ? (client as ReturnType<typeof createClient> as unknown as PoolClient)
+      : await (client as Pool).connect();
 
-    const modelPrice = await getModelPrice(modelId);
-    if (!modelPrice) {
-      throw new Error(`Fail to fetch price info of model ${modelId}`);
-    }
+    await db.query("BEGIN");
 
-    const lastMessage = data.body.messages[data.body.messages.length - 1];
-
-    let inputTokens: number;
-    let outputTokens: number;
-    if (
-      lastMessage.usage &&
-      lastMessage.usage.prompt_tokens &&
-      lastMessage.usage.completion_tokens
-    ) {
-      inputTokens = lastMessage.usage.prompt_tokens;
-      outputTokens = lastMessage.usage.completion_tokens;
-    } else {
-      outputTokens = encode(lastMessage.content).length;
-      const totalTokens = data.body.messages.reduce(
-        (sum: number, msg: Message) => sum + encode(msg.content).length,
-        0
+    if (idempotency) {
+      const billed = await findBilledUsage(db, [idempotency]);
+      const previous = billed.get(
+        billedUsageKey(idempotency.userId, idempotency.key)
       );
-      inputTokens = totalTokens - outputTokens;
+      if (previous) {
+        await db.query("ROLLBACK");
+        return duplicateResponse(previous);
+      }
     }
 
-    let totalCost: number;
-    if (outputTokens === 0) {
-      totalCost = 0;
-      console.log("No charge for zero output tokens");
-    } else if (modelPrice.per_msg_price >= 0) {
-      totalCost = Number(modelPrice.per_msg_price);
-      console.log(
-        `Using fixed pricing: ${totalCost} (${modelPrice.per_msg_price} per message)`
-      );
-    } else {
-      const inputCost = (inputTokens / 1_000_000) * modelPrice.input_price;
-      const outputCost = (outputTokens / 1_000_000) * modelPrice.output_price;
-      totalCost = inputCost + outputCost;
+    const modelPrice = await getModelPrice(modelId);
+    if (!modelPrice) {
+      throw new Error(`Fail to fetch price info of model ${modelId}`);
     }
 
-    const inletCost = getModelInletCost(modelId);
+    const { inputTokens, outputTokens } = countTokens(data);
+    const totalCost = calculateCost(modelPrice, inputTokens, outputTokens);
+    const costVerified = verifyPrecomputedCost(
+      data,
+      totalCost,
+      getPriceTableVersion()
+    );
+
+    // A turn admitted without an inlet call was never charged the inlet cost.
+    const inletCost = data.inletSkipped ? 0 : getModelInletCost(modelId);
 
     const actualCost = totalCost - inletCost;
 
-    const userResult = await query(
-      `UPDATE users 
+    const userResult = await db.query(
+      `UPDATE users
        SET balance = LEAST(
          balance - CAST($1 AS DECIMAL(16,4)),
          999999.9999
@@ -142,12 +111,14 @@ export async function POST(req: Request) {
       throw new Error("Balance exceeds maximum allowed value");
     }
 
-    await query(
+    await db.query(
       `INSERT INTO user_usage_records (
-        user_id, nickname, model_name, 
-        input_tokens, output_tokens, 
-        cost, balance_after
-      ) VALUES ($1, $2, $3, $4, $5, $6, $7)`,
+        user_id, nickname, model_name,
+        input_tokens, output_tokens,
+        cost, balance_after,
+        ttft_ms, decode_tokens_per_sec, jitter_ms,
+        idempotency_key
+      ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)`,
       [
         userId,
         userName,
@@ -156,10 +127,20 @@ export async function POST(req: Request) {
         outputTokens,
         totalCost,
         newBalance,
+        data.timing?.ttft_ms ?? null,
+        decodeTokensPerSec(data.timing, outputTokens),
+        data.timing?.jitter_ms ?? null,
+        data.idempotencyKey ?? null,
       ]
     );
 
-    await query("COMMIT");
+    await db.query("COMMIT");
+
+    if (data.delta) {
+      await rememberChatTotals([
+        { userId, delta: data.delta, totalTokens: inputTokens + outputTokens },
+      ]);
+    }
 
     console.log(
       JSON.stringify({
@@ -178,10 +159,23 @@ export async function POST(req: Request) {
       outputTokens,
       totalCost,
       newBalance,
+      ...(costVerified === null ? {} : { costVerified }),
       message: "Request successful",
     });
   } catch (error) {
-    await query("ROLLBACK");
+    if (db) {
+      await db.query("ROLLBACK");
+    }
+    if (idempotency && isDuplicateKeyError(error)) {
+      // A concurrent retry of this outlet committed first.
+      const billed = await findBilledUsage({ query }, [idempotency]);
+      const previous = billed.get(
+        billedUsageKey(idempotency.userId, idempotency.key)
+      );
+      if (previous) {
+        return duplicateResponse(previous);
+      }
+    }
     console.error("Outlet error:", error);
     return NextResponse.json(
       {
@@ -190,11 +184,17 @@ export async function POST(req: Request) {
           error instanceof Error ? error.message : "Error processing request",
         error_type: error instanceof Error ? error.name : "UNKNOWN_ERROR",
       },
-      { status: 500 }
+      // 409 tells the filter to resend the whole conversation, not that we are down.
+      {
+        status:
+          error instanceof DeltaPrefixMismatchError
+            ? 409
+            : requestErrorStatus(error),
+      }
     );
   } finally {
-    if (!isVercel && pgClient && "release" in pgClient) {
-      pgClient.release();
+    if (!isVercel && db && "release" in db) {
+      db.release();
     }
   }
 }
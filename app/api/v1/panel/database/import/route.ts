@@ -1,6 +1,7 @@
 import { query } from "@/lib/db/client";
 import { NextResponse } from "next/server";
 import { verifyApiToken } from "@/lib/auth";
+import { invalidatePriceTable } from "@/lib/utils/price-table";
 
 export async function POST(req: Request) {
   const authError = verifyApiToken(req);
@@ -47,8 +48,9 @@ export async function POST(req: Request) {
           await query(
             `INSERT INTO user_usage_records (
               user_id, nickname, use_time, model_name, 
-              input_tokens, output_tokens, cost, balance_after
-            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)`,
+              input_tokens, output_tokens, cost, balance_after,
+              ttft_ms, decode_tokens_per_sec, jitter_ms
+            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)`,
             [
               record.user_id,
               record.nickname,
@@ -58,12 +60,16 @@ export async function POST(req: Request) {
               record.output_tokens,
               record.cost,
               record.balance_after,
+              record.ttft_ms ?? null,
+              record.decode_tokens_per_sec ?? null,
+              record.jitter_ms ?? null,
             ]
           );
         }
       }
 
       await query("COMMIT");
+      invalidatePriceTable();
 
       return NextResponse.json({
         success: true,
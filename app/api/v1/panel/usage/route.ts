@@ -27,7 +27,10 @@ export async function GET(request: Request) {
         SELECT 
           COALESCE(mp.name, uur.model_name) AS model_name,
           COUNT(*) as total_count,
-          COALESCE(SUM(uur.cost), 0) AS total_cost
+          COALESCE(SUM(uur.cost), 0) AS total_cost,
+          AVG(uur.ttft_ms) AS avg_ttft_ms,
+          AVG(uur.decode_tokens_per_sec) AS avg_decode_tokens_per_sec,
+          AVG(uur.jitter_ms) AS avg_jitter_ms
         FROM user_usage_records AS uur
         LEFT JOIN model_prices AS mp
           ON mp.id = uur.model_name
@@ -73,6 +76,14 @@ export async function GET(request: Request) {
         model_name: row.model_name,
         total_count: parseInt(row.total_count),
         total_cost: parseFloat(row.total_cost),
+        // Null for models without streamed turns reported by the filter.
+        avg_ttft_ms: row.avg_ttft_ms === null ? null : parseFloat(row.avg_ttft_ms),
+        avg_decode_tokens_per_sec:
+          row.avg_decode_tokens_per_sec === null
+            ? null
+            : parseFloat(row.avg_decode_tokens_per_sec),
+        avg_jitter_ms:
+          row.avg_jitter_ms === null ? null : parseFloat(row.avg_jitter_ms),
       })),
       users: userResult.rows.map((row) => ({
         nickname: row.nickname,
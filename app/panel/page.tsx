@@ -14,6 +14,7 @@ import TimeRangeSelector, {
 import ModelDistributionChart from "@/components/panel/ModelDistributionChart";
 import UserRankingChart from "@/components/panel/UserRankingChart";
 import DomainUsageTable from "@/components/panel/DomainUsageTable";
+import ModelTimingTable from "@/components/panel/ModelTimingTable";
 import UserSummaryTable from "@/components/panel/UserSummaryTable";
 import UsageRecordsTable from "@/components/panel/UsageRecordsTable";
 import HourlyDistributionChart, {
@@ -25,6 +26,7 @@ import { toast, Toaster } from "sonner";
 import { Card } from "@/components/ui/card";
 import {
   BarChartOutlined,
+  DashboardOutlined,
   GlobalOutlined,
   PieChartOutlined,
   TableOutlined,
@@ -36,6 +38,9 @@ interface ModelUsage {
   model_name: string;
   total_cost: number;
   total_count: number;
+  avg_ttft_ms: number | null;
+  avg_decode_tokens_per_sec: number | null;
+  avg_jitter_ms: number | null;
 }
 
 interface UserUsage {
@@ -655,6 +660,23 @@ export default function PanelPage() {
           />
         </motion.div>
 
+        <motion.div
+          initial={{ opacity: 0, y: 20 }}
+          animate={{ opacity: 1, y: 0 }}
+          transition={{ delay: 0.25 }}
+          className="py-6 bg-card text-card-foreground"
+        >
+          <div className="space-y-6">
+            <div className="flex items-center justify-between">
+              <h2 className="text-lg font-semibold tracking-tight flex items-center gap-2">
+                <DashboardOutlined className="text-primary" />
+                {t("panel.modelTiming.title")}
+              </h2>
+            </div>
+            <ModelTimingTable loading={loading} models={usageData.models} />
+          </div>
+        </motion.div>
+
         <motion.div
           initial={{ opacity: 0, y: 20 }}
           animate={{ opacity: 1, y: 0 }}
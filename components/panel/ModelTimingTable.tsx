@@ -0,0 +1,156 @@
+"use client";
+
+import { Table } from "antd";
+import { useTranslation } from "react-i18next";
+
+interface ModelTiming {
+  model_name: string;
+  total_count: number;
+  avg_ttft_ms: number | null;
+  avg_decode_tokens_per_sec: number | null;
+  avg_jitter_ms: number | null;
+}
+
+interface ModelTimingTableProps {
+  loading: boolean;
+  models: ModelTiming[];
+}
+
+// Models without streamed turns have no timings; sort them last.
+const byTiming =
+  (key: "avg_ttft_ms" | "avg_decode_tokens_per_sec" | "avg_jitter_ms") =>
+  (a: ModelTiming, b: ModelTiming) =>
+    (a[key] ?? Infinity) - (b[key] ?? Infinity);
+
+const formatMs = (value: number | null) =>
+  value === null ? "-" : `${Math.round(value).toLocaleString()} ms`;
+
+const formatRate = (value: number | null) =>
+  value === null ? "-" : `${value.toFixed(1)} T/s`;
+
+const MobileCard = ({
+  record,
+  t,
+}: {
+  record: ModelTiming;
+  t: (key: string) => string;
+}) => {
+  return (
+    <div className="p-4 bg-white rounded-xl border border-gray-100/80 shadow-sm transition-all duration-200 hover:shadow-md hover:border-gray-200/80">
+      <div className="flex justify-between items-start mb-4">
+        <div className="font-medium text-gray-900 break-all min-w-0 pr-3">
+          {record.model_name}
+        </div>
+        <div className="text-right shrink-0 font-medium text-primary tabular-nums">
+          {formatRate(record.avg_decode_tokens_per_sec)}
+        </div>
+      </div>
+
+      <div className="flex items-center gap-4 bg-gray-50/70 rounded-lg p-3">
+        <div className="flex-1 min-w-0">
+          <div className="text-xs text-gray-500 mb-1.5">
+            {t("panel.modelTiming.columns.ttft")}
+          </div>
+          <div className="text-sm text-gray-700 font-medium tabular-nums">
+            {formatMs(record.avg_ttft_ms)}
+          </div>
+        </div>
+        <div className="shrink-0">
+          <div className="text-xs text-gray-500 mb-1.5">
+            {t("panel.modelTiming.columns.jitter")}
+          </div>
+          <div className="text-sm text-gray-700 font-medium tabular-nums">
+            {formatMs(record.avg_jitter_ms)}
+          </div>
+        </div>
+      </div>
+    </div>
+  );
+};
+
+export default function ModelTimingTable({
+  loading,
+  models,
+}: ModelTimingTableProps) {
+  const { t } = useTranslation("common");
+  const timed = models.filter(
+    (m) =>
+      m.avg_ttft_ms !== null ||
+      m.avg_decode_tokens_per_sec !== null ||
+      m.avg_jitter_ms !== null
+  );
+
+  const columns = [
+    {
+      title: t("panel.modelTiming.columns.model"),
+      dataIndex: "model_name",
+      key: "model_name",
+      width: 220,
+      sorter: (a: ModelTiming, b: ModelTiming) =>
+        a.model_name.localeCompare(b.model_name),
+      render: (model: string) => (
+        <span className="font-medium break-all">{model}</span>
+      ),
+    },
+    {
+      title: t("panel.modelTiming.columns.ttft"),
+      dataIndex: "avg_ttft_ms",
+      key: "avg_ttft_ms",
+      width: 130,
+      sorter: byTiming("avg_ttft_ms"),
+      defaultSortOrder: "ascend" as const,
+      render: formatMs,
+    },
+    {
+      title: t("panel.modelTiming.columns.decode"),
+      dataIndex: "avg_decode_tokens_per_sec",
+      key: "avg_decode_tokens_per_sec",
+      width: 130,
+      sorter: byTiming("avg_decode_tokens_per_sec"),
+      render: formatRate,
+    },
+    {
+      title: t("panel.modelTiming.columns.jitter"),
+      dataIndex: "avg_jitter_ms",
+      key: "avg_jitter_ms",
+      width: 130,
+      sorter: byTiming("avg_jitter_ms"),
+      render: formatMs,
+    },
+  ];
+
+  return (
+    <div className="space-y-4">
+      <div className="hidden sm:block">
+        <Table
+          columns={columns}
+          dataSource={timed}
+          loading={loading}
+          pagination={false}
+          rowKey="model_name"
+          scroll={{ x: 600 }}
+          locale={{ emptyText: t("panel.modelTiming.empty") }}
+          className="bg-background rounded-md border [&_.ant-table-thead]:bg-muted [&_.ant-table-thead>tr>th]:bg-transparent [&_.ant-table-thead>tr>th]:text-muted-foreground [&_.ant-table-tbody>tr>td]:border-muted [&_.ant-table-tbody>tr:last-child>td]:border-b-0 [&_.ant-table-tbody>tr:hover>td]:bg-muted/50"
+        />
+      </div>
+
+      <div className="sm:hidden">
+        {loading ? (
+          <div className="flex justify-center py-8">
+            <div className="w-6 h-6 border-2 border-primary/30 border-t-primary animate-spin rounded-full" />
+          </div>
+        ) : timed.length === 0 ? (
+          <div className="text-center text-sm text-muted-foreground py-8">
+            {t("panel.modelTiming.empty")}
+          </div>
+        ) : (
+          <div className="space-y-3">
+            {timed.map((m) => (
+              <MobileCard key={m.model_name} record={m} t={t} />
+            ))}
+          </div>
+        )}
+      </div>
+    </div>
+  );
+}
@@ -261,11 +261,47 @@ export async function ensureTablesExist() {
           output_tokens INTEGER NOT NULL,
           cost DECIMAL(10, 4) NOT NULL,
           balance_after DECIMAL(10, 4) NOT NULL,
+          ttft_ms REAL,
+          decode_tokens_per_sec REAL,
+          jitter_ms REAL,
+          idempotency_key TEXT,
           FOREIGN KEY (user_id) REFERENCES users(id)
         );
       `);
+    } else {
+      try {
+        await query(`
+          ALTER TABLE user_usage_records
+            ADD COLUMN IF NOT EXISTS ttft_ms REAL,
+            ADD COLUMN IF NOT EXISTS decode_tokens_per_sec REAL,
+            ADD COLUMN IF NOT EXISTS jitter_ms REAL,
+            ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+        `);
+      } catch (error) {
+        console.error("Error adding stream timing columns:", error);
+      }
     }
 
+    // Outlets retried on another replica carry the same key and are billed once.
+    await query(`
+      CREATE UNIQUE INDEX IF NOT EXISTS user_usage_records_idempotency_key_idx
+      ON user_usage_records (user_id, idempotency_key)
+      WHERE idempotency_key IS NOT NULL;
+    `);
+
+    // Token totals of each chat's reported prefix, for delta uploads to any replica.
+    await query(`
+      CREATE TABLE IF NOT EXISTS chat_token_totals (
+        user_id TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        message_count INTEGER NOT NULL,
+        fingerprint TEXT NOT NULL,
+        tokens INTEGER NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, chat_id)
+      );
+    `);
+
     console.log("Database tables initialized successfully");
   } catch (error) {
     console.error("Failed to initialize database tables:", error);
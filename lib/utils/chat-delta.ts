@@ -0,0 +1,224 @@
+import { createHash } from "crypto";
+import { encode } from "gpt-tokenizer/model/gpt-4";
+import { query } from "@/lib/db/client";
+import type { Message } from "@/lib/utils/usage";
+
+/**
+ * Delta conversation uploads.
+ *
+ * Instead of the whole conversation, the filter sends the messages this chat has
+ * not reported yet plus the fingerprint of the prefix it already did. The
+ * fingerprint chains sha256 over each message's role and text, so both sides
+ * compute it the same way. Token totals of the reported prefix are kept per
+ * chat in the chat_token_totals table, so every replica can continue a chat,
+ * and cached in memory (CHAT_TOKEN_CACHE_SIZE chats) so a chat this replica
+ * reported last needs no lookup. When neither matches the sent prefix (edited
+ * history, a lost write) the route answers 409 and the filter resends the
+ * conversation in full once.
+ */
+export interface DeltaUpload {
+  chatId: string;
+  prefixCount: number;
+  prefixHash: string;
+  messages: Message[];
+}
+
+interface ChatTotals {
+  count: number;
+  fingerprint: string;
+  tokens: number;
+}
+
+const CACHE_SIZE = parseInt(process.env.CHAT_TOKEN_CACHE_SIZE || "10000");
+
+// Map iteration follows insertion order, so re-inserting on use makes it an LRU.
+const chatTotals = new Map<string, ChatTotals>();
+
+export class DeltaPrefixMismatchError extends Error {
+  constructor(chatId: string) {
+    super(`No token totals for chat ${chatId} match the sent prefix`);
+    this.name = "DELTA_PREFIX_MISMATCH";
+  }
+}
+
+export function chainFingerprint(
+  previous: string,
+  role: string,
+  content: string
+): string {
+  return createHash("sha256")
+    .update(previous)
+    .update("\n")
+    .update(role)
+    .update("\n")
+    .update(content)
+    .digest("hex")
+    .slice(0, 32);
+}
+
+export function parseDeltaUpload(delta: any): DeltaUpload | undefined {
+  if (delta === undefined || delta === null) {
+    return undefined;
+  }
+  if (
+    typeof delta.chat_id !== "string" ||
+    !Number.isInteger(delta.prefix_count) ||
+    delta.prefix_count < 0 ||
+    typeof delta.prefix_hash !== "string" ||
+    !Array.isArray(delta.messages) ||
+    delta.messages.length === 0
+  ) {
+    throw new Error("Invalid delta upload");
+  }
+  return {
+    chatId: delta.chat_id,
+    prefixCount: delta.prefix_count,
+    prefixHash: delta.prefix_hash,
+    messages: delta.messages,
+  };
+}
+
+function cacheKey(userId: string, chatId: string): string {
+  return `${userId}:${chatId}`;
+}
+
+function cacheTotals(key: string, totals: ChatTotals): void {
+  chatTotals.delete(key);
+  chatTotals.set(key, totals);
+  while (chatTotals.size > CACHE_SIZE) {
+    const oldest = chatTotals.keys().next().value;
+    if (oldest === undefined) {
+      break;
+    }
+    chatTotals.delete(oldest);
+  }
+}
+
+function matchesPrefix(cached: ChatTotals | undefined, delta: DeltaUpload) {
+  return (
+    cached !== undefined &&
+    cached.count === delta.prefixCount &&
+    cached.fingerprint === delta.prefixHash
+  );
+}
+
+/**
+ * Load the shared totals of chats whose cached prefix does not match the one
+ * sent, typically because another replica billed their last turn. Call it
+ * before countDeltaTokens; a failed lookup only costs a full resend.
+ */
+export async function loadChatTotals(
+  uploads: { userId: string; delta: DeltaUpload }[]
+): Promise<void> {
+  const missing = uploads.filter(
+    ({ userId, delta }) =>
+      delta.prefixCount > 0 &&
+      !matchesPrefix(chatTotals.get(cacheKey(userId, delta.chatId)), delta)
+  );
+  if (missing.length === 0) {
+    return;
+  }
+  try {
+    const result = await query(
+      `SELECT user_id, chat_id, message_count, fingerprint, tokens
+       FROM chat_token_totals
+       WHERE (user_id, chat_id) IN (
+         SELECT * FROM unnest($1::text[], $2::text[])
+       )`,
+      [
+        missing.map(({ userId }) => userId),
+        missing.map(({ delta }) => delta.chatId),
+      ]
+    );
+    result.rows.forEach((row) => {
+      cacheTotals(cacheKey(row.user_id, row.chat_id), {
+        count: Number(row.message_count),
+        fingerprint: row.fingerprint,
+        tokens: Number(row.tokens),
+      });
+    });
+  } catch (error) {
+    console.error("Failed to load chat token totals:", error);
+  }
+}
+
+export function countDeltaTokens(
+  userId: string,
+  delta: DeltaUpload
+): { inputTokens: number; outputTokens: number } {
+  let prefixTokens = 0;
+  if (delta.prefixCount > 0) {
+    const key = cacheKey(userId, delta.chatId);
+    const cached = chatTotals.get(key);
+    if (!matchesPrefix(cached, delta)) {
+      throw new DeltaPrefixMismatchError(delta.chatId);
+    }
+    cacheTotals(key, cached!);
+    prefixTokens = cached!.tokens;
+  }
+
+  const counts = delta.messages.map(
+    (msg) => encode(String(msg.content ?? "")).length
+  );
+  const outputTokens = counts[counts.length - 1];
+  const newInputTokens = counts
+    .slice(0, -1)
+    .reduce((sum, count) => sum + count, 0);
+  return { inputTokens: prefixTokens + newInputTokens, outputTokens };
+}
+
+/**
+ * Store the chats' totals once their turns are committed, so the next turn
+ * can send a delta to any replica. A failed write is logged, not raised: the
+ * turn is already billed and the next one falls back to a full resend.
+ */
+export async function rememberChatTotals(
+  turns: { userId: string; delta: DeltaUpload; totalTokens: number }[]
+): Promise<void> {
+  // Later turns of the same chat win, and one upsert may touch a row only once.
+  const latest = new Map<string, { userId: string; chatId: string } & ChatTotals>();
+  turns.forEach(({ userId, delta, totalTokens }) => {
+    const totals = {
+      count: delta.prefixCount + delta.messages.length,
+      fingerprint: delta.messages.reduce(
+        (previous, msg) =>
+          chainFingerprint(previous, msg.role ?? "", String(msg.content ?? "")),
+        delta.prefixHash
+      ),
+      tokens: totalTokens,
+    };
+    const key = cacheKey(userId, delta.chatId);
+    cacheTotals(key, totals);
+    latest.delete(key);
+    latest.set(key, { userId, chatId: delta.chatId, ...totals });
+  });
+  if (latest.size === 0) {
+    return;
+  }
+
+  const rows = Array.from(latest.values());
+  try {
+    await query(
+      `INSERT INTO chat_token_totals (
+        user_id, chat_id, message_count, fingerprint, tokens
+      )
+      SELECT * FROM unnest(
+        $1::text[], $2::text[], $3::integer[], $4::text[], $5::integer[]
+      )
+      ON CONFLICT (user_id, chat_id) DO UPDATE SET
+        message_count = EXCLUDED.message_count,
+        fingerprint = EXCLUDED.fingerprint,
+        tokens = EXCLUDED.tokens,
+        updated_at = CURRENT_TIMESTAMP`,
+      [
+        rows.map((row) => row.userId),
+        rows.map((row) => row.chatId),
+        rows.map((row) => row.count),
+        rows.map((row) => row.fingerprint),
+        rows.map((row) => row.tokens),
+      ]
+    );
+  } catch (error) {
+    console.error("Failed to store chat token totals:", error);
+  }
+}
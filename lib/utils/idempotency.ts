@@ -0,0 +1,59 @@
+/**
+ * Idempotent outlets.
+ *
+ * The filters send each usage event with an idempotency key (the Open WebUI
+ * message id), so an outlet retried on another replica after a timeout is
+ * billed once. The key is stored on the usage record under a unique
+ * (user_id, idempotency_key) index: a replay finds the record and gets the
+ * original result back, and a concurrent replay fails the insert and rolls
+ * back its balance update.
+ */
+export interface BilledUsage {
+  inputTokens: number;
+  outputTokens: number;
+  totalCost: number;
+  newBalance: number;
+}
+
+export function billedUsageKey(userId: string, key: string): string {
+  return `${userId}\n${key}`;
+}
+
+export function parseIdempotencyKey(key: unknown): string | undefined {
+  return typeof key === "string" && key.length > 0 && key.length <= 255
+    ? key
+    : undefined;
+}
+
+/** Usage already billed under these (user, key) pairs, by billedUsageKey. */
+export async function findBilledUsage(
+  db: { query: (text: string, params?: any[]) => Promise<{ rows: any[] }> },
+  pairs: { userId: string; key: string }[]
+): Promise<Map<string, BilledUsage>> {
+  const billed = new Map<string, BilledUsage>();
+  if (pairs.length === 0) {
+    return billed;
+  }
+  const result = await db.query(
+    `SELECT user_id, idempotency_key, input_tokens, output_tokens, cost, balance_after
+     FROM user_usage_records
+     WHERE (user_id, idempotency_key) IN (
+       SELECT * FROM unnest($1::text[], $2::text[])
+     )`,
+    [pairs.map((pair) => pair.userId), pairs.map((pair) => pair.key)]
+  );
+  result.rows.forEach((row) => {
+    billed.set(billedUsageKey(row.user_id, row.idempotency_key), {
+      inputTokens: Number(row.input_tokens),
+      outputTokens: Number(row.output_tokens),
+      totalCost: Number(row.cost),
+      newBalance: Number(row.balance_after),
+    });
+  });
+  return billed;
+}
+
+/** A concurrent request inserted the same idempotency key first. */
+export function isDuplicateKeyError(error: unknown): boolean {
+  return (error as { code?: string } | null)?.code === "23505";
+}
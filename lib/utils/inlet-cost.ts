@@ -33,3 +33,18 @@ export function getModelInletCost(modelId: string): number {
   const costConfig = parseInletCostConfig(process.env.COST_ON_INLET);
   return costConfig[modelId] ?? costConfig["default"] ?? 0;
 }
+
+/**
+ * COST_ON_INLET as published with the price table: models without their own
+ * entry are charged `default` on inlet. Lets the filter tell which models it
+ * may admit from its cached balance without an inlet call.
+ */
+export function getInletCostConfig(): {
+  default: number;
+  models: Record<string, number>;
+} {
+  const { default: defaultCost, ...models } = parseInletCostConfig(
+    process.env.COST_ON_INLET
+  );
+  return { default: defaultCost ?? 0, models };
+}
@@ -0,0 +1,96 @@
+import { createHash } from "crypto";
+import { query } from "@/lib/db/client";
+import type { ModelPrice } from "@/lib/utils/usage";
+
+/**
+ * In-memory copy of model_prices.
+ *
+ * Outlets look prices up here instead of querying the table on every turn.
+ * The copy is reloaded once it is PRICE_CACHE_TTL_MS old (default 30s), or
+ * right away after a price route invalidates it; other replicas pick up edits
+ * within the TTL. `version` hashes the prices, the default prices and
+ * COST_ON_INLET: it is the ETag of /api/v1/models/prices, and it tells whether
+ * a cost precomputed by the filter used the same prices as the server.
+ */
+export interface PriceTable {
+  prices: Map<string, ModelPrice>;
+  version: string;
+  loadedAt: number;
+}
+
+const TTL_MS = parseInt(process.env.PRICE_CACHE_TTL_MS || "30000");
+
+let cached: PriceTable | null = null;
+let loading: Promise<PriceTable> | null = null;
+// Bumped on invalidation so a load that started before it is not cached.
+let generation = 0;
+
+async function loadPriceTable(): Promise<PriceTable> {
+  const result = await query(
+    `SELECT id, name, input_price, output_price, per_msg_price
+     FROM model_prices
+     ORDER BY id`
+  );
+
+  const prices = new Map<string, ModelPrice>();
+  const hash = createHash("sha256");
+  result.rows.forEach((row) => {
+    const price: ModelPrice = {
+      id: row.id,
+      name: row.name,
+      input_price: Number(row.input_price),
+      output_price: Number(row.output_price),
+      per_msg_price: Number(row.per_msg_price),
+    };
+    prices.set(price.id, price);
+    hash.update(
+      `${price.id}\t${price.input_price}\t${price.output_price}\t${price.per_msg_price}\n`
+    );
+  });
+  hash.update(
+    `\tdefault\t${process.env.DEFAULT_MODEL_INPUT_PRICE || "60"}\t${
+      process.env.DEFAULT_MODEL_OUTPUT_PRICE || "60"
+    }\n`
+  );
+  hash.update(`\tinlet\t${process.env.COST_ON_INLET || ""}\n`);
+
+  return {
+    prices,
+    version: hash.digest("hex").slice(0, 16),
+    loadedAt: Date.now(),
+  };
+}
+
+export async function getPriceTable(): Promise<PriceTable> {
+  if (cached && Date.now() - cached.loadedAt < TTL_MS) {
+    return cached;
+  }
+  if (!loading) {
+    const started = generation;
+    const load: Promise<PriceTable> = loadPriceTable()
+      .then((table) => {
+        if (started === generation) {
+          cached = table;
+        }
+        return table;
+      })
+      .finally(() => {
+        if (loading === load) {
+          loading = null;
+        }
+      });
+    loading = load;
+  }
+  return loading;
+}
+
+/** Version of the cached table, if one is loaded. */
+export function getPriceTableVersion(): string | null {
+  return cached?.version ?? null;
+}
+
+export function invalidatePriceTable(): void {
+  generation += 1;
+  cached = null;
+  loading = null;
+}
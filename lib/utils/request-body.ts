@@ -0,0 +1,91 @@
+import { promisify } from "util";
+import * as zlib from "zlib";
+
+/**
+ * JSON request bodies with optional Content-Encoding.
+ *
+ * The filters may gzip or zstd-compress large inlet/outlet bodies. gzip is
+ * always accepted; zstd needs a Node.js with zlib zstd support (22.15+), and
+ * is answered with 415 otherwise so the filter falls back to plain bodies.
+ * Decompressed bodies are capped at MAX_REQUEST_BODY_BYTES (default 64 MiB).
+ * Bodies that cannot be decoded or parsed are the client's fault and get 400,
+ * which the filters do not count as a monitor failure.
+ */
+const MAX_BODY_BYTES = parseInt(
+  process.env.MAX_REQUEST_BODY_BYTES || String(64 * 1024 * 1024)
+);
+
+type Decompress = (
+  buffer: Buffer,
+  options: zlib.ZlibOptions
+) => Promise<Buffer>;
+
+const gunzip: Decompress = promisify(zlib.gunzip);
+const zstdDecompress: Decompress | null =
+  "zstdDecompress" in zlib ? promisify((zlib as any).zstdDecompress) : null;
+
+export class RequestBodyError extends Error {
+  constructor(message: string, name: string, public status: number) {
+    super(message);
+    this.name = name;
+  }
+}
+
+async function decompress(encoding: string, body: Buffer): Promise<Buffer> {
+  try {
+    if (encoding === "gzip") {
+      return await gunzip(body, { maxOutputLength: MAX_BODY_BYTES });
+    }
+    if (encoding === "zstd" && zstdDecompress) {
+      return await zstdDecompress(body, { maxOutputLength: MAX_BODY_BYTES });
+    }
+  } catch (error) {
+    if (error instanceof RangeError) {
+      throw new RequestBodyError(
+        `Decompressed body exceeds ${MAX_BODY_BYTES} bytes`,
+        "BODY_TOO_LARGE",
+        413
+      );
+    }
+    throw new RequestBodyError(
+      `Invalid ${encoding} body: ${error instanceof Error ? error.message : error}`,
+      "INVALID_BODY_ENCODING",
+      400
+    );
+  }
+  throw new RequestBodyError(
+    `Unsupported Content-Encoding ${encoding}`,
+    "UNSUPPORTED_CONTENT_ENCODING",
+    415
+  );
+}
+
+function parseJson(text: string): any {
+  try {
+    return JSON.parse(text);
+  } catch (error) {
+    throw new RequestBodyError(
+      `Invalid JSON body: ${error instanceof Error ? error.message : error}`,
+      "INVALID_JSON",
+      400
+    );
+  }
+}
+
+export async function readJsonBody(req: Request): Promise<any> {
+  const encoding = (req.headers.get("content-encoding") || "identity")
+    .trim()
+    .toLowerCase();
+  if (encoding === "identity") {
+    return parseJson(await req.text());
+  }
+  const body = await decompress(
+    encoding,
+    Buffer.from(await req.arrayBuffer())
+  );
+  return parseJson(body.toString("utf8"));
+}
+
+export function requestErrorStatus(error: unknown): number {
+  return error instanceof RequestBodyError ? error.status : 500;
+}
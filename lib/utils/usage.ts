@@ -0,0 +1,314 @@
+import { encode } from "gpt-tokenizer/model/gpt-4";
+import {
+  DeltaUpload,
+  countDeltaTokens,
+  parseDeltaUpload,
+} from "@/lib/utils/chat-delta";
+import { parseIdempotencyKey } from "@/lib/utils/idempotency";
+import { getPriceTable } from "@/lib/utils/price-table";
+
+export interface Usage {
+  prompt_tokens?: number;
+  completion_tokens?: number;
+}
+
+export interface Message {
+  role: string;
+  content: string;
+  usage?: Usage;
+}
+
+export interface UsageUser {
+  id: string;
+  name?: string;
+  email?: string;
+  role?: string;
+}
+
+/**
+ * Streaming timings measured by the filter's stream hook. `decode_ms` spans the
+ * first to the last content chunk; `jitter_ms` is the standard deviation of the
+ * gaps between chunks.
+ */
+export interface StreamTiming {
+  ttft_ms: number | null;
+  decode_ms: number;
+  chunks: number;
+  jitter_ms: number;
+}
+
+/**
+ * Cost the filter computed from its copy of the price table. `prices` is the
+ * price table version it used (see price-table.ts).
+ */
+export interface PrecomputedCost {
+  total: number;
+  prices: string;
+}
+
+/**
+ * Normalized inlet/outlet request.
+ *
+ * Version 1 (legacy) posts `{ user, body }` with the full conversation.
+ * Version 2 (compact) posts `{ version: 2, user, model, usage?, tokens?, messages?, delta? }`
+ * where `tokens` holds counts made by the filter and `messages` is only sent,
+ * as plain role/content pairs, when neither usage nor tokens is available.
+ * `delta` replaces `messages` with only the messages not yet reported for the
+ * chat (see chat-delta.ts). Either version may carry `cost`, which is checked
+ * against the server's own cost but never billed, and `idempotency_key`, under
+ * which the outlet is billed at most once (see idempotency.ts). `inlet_skipped`
+ * marks turns admitted without an inlet call (cached balance, monitor outage):
+ * their outlet bills the whole cost instead of deducting the inlet charge.
+ */
+export interface UsageRequest {
+  version: number;
+  user: UsageUser;
+  modelId: string;
+  messages: Message[];
+  usage?: Usage;
+  tokens?: {
+    input: number;
+    output: number;
+  };
+  timing?: StreamTiming;
+  delta?: DeltaUpload;
+  cost?: PrecomputedCost;
+  idempotencyKey?: string;
+  inletSkipped: boolean;
+}
+
+export const LATEST_USAGE_REQUEST_VERSION = 2;
+
+function isNonNegative(value: unknown): value is number {
+  return typeof value === "number" && Number.isFinite(value) && value >= 0;
+}
+
+function parseStreamTiming(timing: any): StreamTiming | undefined {
+  if (
+    !timing ||
+    !isNonNegative(timing.decode_ms) ||
+    !isNonNegative(timing.jitter_ms) ||
+    !Number.isInteger(timing.chunks) ||
+    timing.chunks < 1
+  ) {
+    return undefined;
+  }
+  return {
+    ttft_ms: isNonNegative(timing.ttft_ms) ? timing.ttft_ms : null,
+    decode_ms: timing.decode_ms,
+    chunks: timing.chunks,
+    jitter_ms: timing.jitter_ms,
+  };
+}
+
+function parsePrecomputedCost(cost: any): PrecomputedCost | undefined {
+  if (!cost || !isNonNegative(cost.total) || typeof cost.prices !== "string") {
+    return undefined;
+  }
+  return { total: cost.total, prices: cost.prices };
+}
+
+export function parseUsageRequest(data: any): UsageRequest {
+  const version = Number(data?.version ?? 1);
+  // Timings and precomputed costs are optional in both versions and never affect billing.
+  const timing = parseStreamTiming(data?.timing);
+  const cost = parsePrecomputedCost(data?.cost);
+  const idempotencyKey = parseIdempotencyKey(data?.idempotency_key);
+  const inletSkipped = data?.inlet_skipped === true;
+
+  if (version === 1) {
+    const messages: Message[] = data.body?.messages ?? [];
+    return {
+      version,
+      user: data.user,
+      modelId: data.body?.model,
+      messages,
+      usage: messages[messages.length - 1]?.usage,
+      timing,
+      cost,
+      idempotencyKey,
+      inletSkipped,
+    };
+  }
+
+  if (version === 2) {
+    return {
+      version,
+      user: data.user,
+      modelId: data.model,
+      messages: data.messages ?? [],
+      usage: data.usage,
+      tokens: data.tokens,
+      timing,
+      delta: parseDeltaUpload(data.delta),
+      cost,
+      idempotencyKey,
+      inletSkipped,
+    };
+  }
+
+  throw new Error(
+    `Unsupported request version ${data.version}, latest is ${LATEST_USAGE_REQUEST_VERSION}`
+  );
+}
+
+export interface ModelPrice {
+  id: string;
+  name: string;
+  input_price: number;
+  output_price: number;
+  per_msg_price: number;
+}
+
+export function getDefaultModelPrice(modelId: string): ModelPrice | null {
+  const defaultInputPrice = parseFloat(
+    process.env.DEFAULT_MODEL_INPUT_PRICE || "60"
+  );
+  const defaultOutputPrice = parseFloat(
+    process.env.DEFAULT_MODEL_OUTPUT_PRICE || "60"
+  );
+
+  if (
+    isNaN(defaultInputPrice) ||
+    defaultInputPrice < 0 ||
+    isNaN(defaultOutputPrice) ||
+    defaultOutputPrice < 0
+  ) {
+    return null;
+  }
+
+  return {
+    id: modelId,
+    name: modelId,
+    input_price: defaultInputPrice,
+    output_price: defaultOutputPrice,
+    per_msg_price: -1,
+  };
+}
+
+export async function getModelPrice(
+  modelId: string
+): Promise<ModelPrice | null> {
+  const { prices } = await getPriceTable();
+  return prices.get(modelId) ?? getDefaultModelPrice(modelId);
+}
+
+export async function getModelPrices(
+  modelIds: string[]
+): Promise<Map<string, ModelPrice | null>> {
+  const prices = new Map<string, ModelPrice | null>();
+  if (modelIds.length === 0) {
+    return prices;
+  }
+
+  const table = await getPriceTable();
+  modelIds.forEach((modelId) => {
+    prices.set(
+      modelId,
+      table.prices.get(modelId) ?? getDefaultModelPrice(modelId)
+    );
+  });
+
+  return prices;
+}
+
+export function countTokens(request: UsageRequest): {
+  inputTokens: number;
+  outputTokens: number;
+} {
+  const { usage, tokens, messages, delta } = request;
+
+  if (usage && usage.prompt_tokens && usage.completion_tokens) {
+    return {
+      inputTokens: usage.prompt_tokens,
+      outputTokens: usage.completion_tokens,
+    };
+  }
+
+  if (
+    tokens &&
+    Number.isInteger(tokens.input) &&
+    Number.isInteger(tokens.output) &&
+    tokens.input >= 0 &&
+    tokens.output >= 0
+  ) {
+    return { inputTokens: tokens.input, outputTokens: tokens.output };
+  }
+
+  if (delta) {
+    return countDeltaTokens(request.user.id, delta);
+  }
+
+  if (messages.length === 0) {
+    throw new Error("Request carries neither usage nor messages");
+  }
+
+  const lastMessage = messages[messages.length - 1];
+  const outputTokens = encode(lastMessage.content).length;
+  const totalTokens = messages.reduce(
+    (sum: number, msg: Message) => sum + encode(msg.content).length,
+    0
+  );
+  return { inputTokens: totalTokens - outputTokens, outputTokens };
+}
+
+/**
+ * Tokens after the first chunk over the first-to-last chunk time, assuming the
+ * output is spread evenly over the chunks.
+ */
+export function decodeTokensPerSec(
+  timing: StreamTiming | undefined,
+  outputTokens: number
+): number | null {
+  if (!timing || outputTokens <= 0 || timing.chunks < 2 || timing.decode_ms <= 0) {
+    return null;
+  }
+  const decodedTokens = (outputTokens * (timing.chunks - 1)) / timing.chunks;
+  return decodedTokens / (timing.decode_ms / 1000);
+}
+
+/**
+ * Whether the filter's precomputed cost matches ours; null when it sent none.
+ * It only counts as verified when both sides used the same price table.
+ */
+export function verifyPrecomputedCost(
+  request: UsageRequest,
+  totalCost: number,
+  priceVersion: string | null
+): boolean | null {
+  if (!request.cost) {
+    return null;
+  }
+  const verified =
+    request.cost.prices === priceVersion &&
+    Math.abs(request.cost.total - totalCost) < 1e-6;
+  if (!verified) {
+    console.warn(
+      `Precomputed cost ${request.cost.total} (prices ${request.cost.prices}) of model ${request.modelId} does not match ${totalCost} (prices ${priceVersion})`
+    );
+  }
+  return verified;
+}
+
+export function calculateCost(
+  modelPrice: ModelPrice,
+  inputTokens: number,
+  outputTokens: number
+): number {
+  if (outputTokens === 0) {
+    console.log("No charge for zero output tokens");
+    return 0;
+  }
+
+  if (modelPrice.per_msg_price >= 0) {
+    const totalCost = Number(modelPrice.per_msg_price);
+    console.log(
+      `Using fixed pricing: ${totalCost} (${modelPrice.per_msg_price} per message)`
+    );
+    return totalCost;
+  }
+
+  const inputCost = (inputTokens / 1_000_000) * modelPrice.input_price;
+  const outputCost = (outputTokens / 1_000_000) * modelPrice.output_price;
+  return inputCost + outputCost;
+}
@@ -33,8 +33,13 @@ export async function middleware(request: NextRequest) {
 
     const authHeader = request.headers.get("authorization");
     const providedKey = authHeader?.replace("Bearer ", "");
+    // The price list is also read by the filter, which only knows API_KEY.
+    const filterKey =
+      pathname.startsWith("/api/v1/models/prices") && API_KEY
+        ? API_KEY
+        : token;
 
-    if (!providedKey || providedKey !== token) {
+    if (!providedKey || (providedKey !== token && providedKey !== filterKey)) {
       console.log("Invalid API key or token");
       return NextResponse.json({ error: "Unauthorized" }, { status: 401 });
     }
@@ -13,7 +13,115 @@ from typing import Optional, Union, Generator, Iterator
 import os
 import requests
 import asyncio
+import gzip
+import io
 import json
+import sqlite3
+import threading
+import time
+
+
+# 旧版 JSON 记录目录；迁移完成前的记录仍从这里读取
+RECORD_DIRECTORY = "/app/backend/data/record"
+RECORD_DB_PATH = "/app/backend/data/usage_records.db"
+
+
+class RecordReader:
+    """
+    读取监控过滤器写入的 SQLite 记录库（只查询不写入）。
+    较早的记录被压缩进按天的分段（usage_segments），找不到时回退到旧版 JSON 文件。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self._conn is None:
+            if not os.path.exists(self.path):
+                return None
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+        return self._conn
+
+    def get(self, message_id: str, timestamp: Optional[float] = None) -> Optional[dict]:
+        """timestamp 为消息的创建时间，用来只解压对应日期的分段"""
+        with self._lock:
+            conn = self._connect()
+            if conn is not None:
+                try:
+                    row = conn.execute(
+                        "SELECT * FROM usage_records WHERE message_id = ?",
+                        (message_id,),
+                    ).fetchone()
+                except sqlite3.OperationalError:
+                    # 过滤器尚未建表
+                    row = None
+                if row is not None:
+                    return {k: row[k] for k in row.keys() if row[k] is not None}
+                record = self._find_in_segments(conn, message_id, timestamp)
+                if record is not None:
+                    return record
+
+        file_path = os.path.join(RECORD_DIRECTORY, f"{message_id}.json")
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def _find_in_segments(
+        conn: sqlite3.Connection, message_id: str, timestamp: Optional[float]
+    ) -> Optional[dict]:
+        """只解压消息所在日期的分段；没有时间戳时不查分段，避免逐个解压整个历史"""
+        if not timestamp:
+            return None
+        if timestamp > 1e11:
+            timestamp /= 1000  # 毫秒
+        # 记录在回复结束时写入，可能已跨过零点
+        days = (
+            time.strftime("%Y-%m-%d", time.localtime(timestamp)),
+            time.strftime("%Y-%m-%d", time.localtime(timestamp + 86400)),
+        )
+        # 先按字节匹配再解析，只解析命中的那一行
+        needle = f'"message_id":{json.dumps(message_id, ensure_ascii=False)}'.encode("utf-8")
+        try:
+            cursor = conn.execute(
+                "SELECT data FROM usage_segments WHERE day IN (?, ?) ORDER BY day", days
+            )
+            for (data,) in cursor:
+                with gzip.GzipFile(fileobj=io.BytesIO(data)) as segment:
+                    for line in segment:
+                        if needle in line:
+                            record = json.loads(line)
+                            return {k: v for k, v in record.items() if v is not None}
+        except sqlite3.OperationalError:
+            # 过滤器尚未创建分段表
+            return None
+        return None
+
+    def _get_rollup(self, sql: str, params: tuple) -> Optional[dict]:
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return None
+            try:
+                row = conn.execute(sql, params).fetchone()
+            except sqlite3.OperationalError:
+                return None
+        return dict(row) if row is not None else None
+
+    def get_chat(self, chat_id: str) -> Optional[dict]:
+        """对话累计用量（由过滤器在每次写入时增量维护）"""
+        return self._get_rollup("SELECT * FROM chat_usage WHERE chat_id = ?", (chat_id,))
+
+    def get_user_day(self, user_id: str, day: str) -> Optional[dict]:
+        """用户某一天（YYYY-MM-DD，服务器本地时区）的累计用量"""
+        return self._get_rollup(
+            "SELECT * FROM user_daily_usage WHERE user_id = ? AND day = ?",
+            (user_id, day),
+        )
 
 
 class Action:
@@ -38,10 +146,43 @@ class Action:
             description="是否显示每秒输出token数",
             json_schema_extra={"ui:group": "显示设置"},
         )
+        show_chat_summary: bool = Field(
+            default=False,
+            description="是否显示整个对话的累计用量",
+            json_schema_extra={"ui:group": "显示设置"},
+        )
+        show_today_summary: bool = Field(
+            default=False,
+            description="是否显示当前用户今日的累计用量",
+            json_schema_extra={"ui:group": "显示设置"},
+        )
+        record_db_path: str = Field(
+            default=RECORD_DB_PATH,
+            description="计费记录数据库路径，需与监控过滤器一致",
+            json_schema_extra={"ui:group": "存储设置"},
+        )
 
     def __init__(self):
         self.valves = self.Valves()
-        pass
+        self._reader: Optional[RecordReader] = None
+
+    def _get_reader(self) -> RecordReader:
+        if self._reader is None or self._reader.path != self.valves.record_db_path:
+            self._reader = RecordReader(self.valves.record_db_path)
+        return self._reader
+
+    def _format_rollup(self, label: str, rollup: dict) -> str:
+        """格式化累计用量：Token、费用、平均输出速度和总耗时"""
+        parts = []
+        if self.valves.show_tokens:
+            parts.append(f"Token: {rollup['input_tokens']}+{rollup['output_tokens']}")
+        if self.valves.show_cost:
+            parts.append(f"Cost: ${rollup['total_cost']:.6f}")
+        elapsed_time = rollup["elapsed_time"]
+        if self.valves.show_tokens_per_sec and elapsed_time > 0:
+            parts.append(f"Avg {(rollup['output_tokens'] / elapsed_time):.2f} T/s")
+        parts.append(f"Time: {elapsed_time:.2f}s")
+        return f"{label} ({rollup['messages']}): " + ", ".join(parts)
 
     async def action(
         self,
@@ -85,34 +226,33 @@ class Action:
                 )
             return None
 
-        # 构建文件路径
-        file_path = os.path.join("/app/backend/data/record", f"{message_id}.json")
-
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
+        # 读取统计信息
+        try:
+            stats_data = await asyncio.to_thread(
+                self._get_reader().get,
+                message_id,
+                last_assistant_message.get("timestamp"),
+            )
+        except Exception as e:
             if __event_emitter__:
                 await __event_emitter__(
                     {
                         "type": "status",
                         "data": {
-                            "description": f"未查找到该消息的计费记录，请联系管理员",
+                            "description": f"读取统计文件失败: {str(e)}",
                             "done": True,
                         },
                     }
                 )
             return None
 
-        # 读取统计信息
-        try:
-            with open(file_path, "r") as f:
-                stats_data = json.load(f)
-        except Exception as e:
+        if stats_data is None:
             if __event_emitter__:
                 await __event_emitter__(
                     {
                         "type": "status",
                         "data": {
-                            "description": f"读取统计文件失败: {str(e)}",
+                            "description": f"未查找到该消息的计费记录，请联系管理员",
                             "done": True,
                         },
                     }
@@ -150,6 +290,19 @@ class Action:
                     f"{(stats_data['output_tokens']/elapsed_time):.2f} T/s"
                 )
 
+        reader = self._get_reader()
+        chat_id = body.get("chat_id")
+        if self.valves.show_chat_summary and chat_id:
+            rollup = await asyncio.to_thread(reader.get_chat, chat_id)
+            if rollup:
+                stats_array.append(self._format_rollup("Chat", rollup))
+        user_id = (__user__ or {}).get("id")
+        if self.valves.show_today_summary and user_id:
+            today = time.strftime("%Y-%m-%d")
+            rollup = await asyncio.to_thread(reader.get_user_day, user_id, today)
+            if rollup:
+                stats_array.append(self._format_rollup("Today", rollup))
+
         stats = " | ".join(stat for stat in stats_array)
 
         # 发送状态更新
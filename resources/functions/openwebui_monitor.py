@@ -6,25 +6,56 @@ version: 0.3.12
 requirements: httpx
 license: MIT
 """
+import asyncio
+import bisect
+import gzip
+import hashlib
 import logging
+import math
+import os
+import random
+import sqlite3
+import threading
 import time
-from typing import Dict, Optional
-from httpx import AsyncClient
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+from httpx import AsyncClient, ConnectError, ConnectTimeout, HTTPStatusError, Limits, Timeout, TransportError
 from pydantic import BaseModel, Field
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no flock, and Open WebUI runs there as a single worker.
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Default file for state_backend=sqlite, shared by the workers of one host.
+STATE_DB_PATH = "/app/backend/data/usage_monitor/state.db"
+
+# Open WebUI background tasks that run the filter but produce no visible, billed reply.
+INTERNAL_TASKS = {"follow_up_generation", "title_generation", "tags_generation"}
+
 TRANSLATIONS = {
     "en": {
         "request_failed": "Request failed: {error_msg}",
         "insufficient_balance": "Insufficient balance: Current balance `{balance:.4f}`",
+        "insufficient_for_estimate": "Insufficient balance: this request may cost about `{cost:.4f}`, available `{balance:.4f}`",
         "cost": "Cost: ${cost:.4f}",
         "balance": "Balance: ${balance:.4f}",
         "tokens": "Tokens: {input}+{output}",
         "time_spent": "Time: {time:.2f}s",
         "tokens_per_sec": "{tokens_per_sec:.2f} T/s",
+        "ttft": "TTFT: {ttft:.2f}s",
+        "billing_pending": "Billing pending",
+        "billing_unavailable": "Billing unavailable",
     },
     "zh": {
         "request_failed": "è¯·æ±‚å¤±è´¥: {error_msg}",
@@ -34,6 +65,10 @@ TRANSLATIONS = {
         "tokens": "Token: {input}+{output}",
         "time_spent": "è€—æ—¶: {time:.2f}s",
         "tokens_per_sec": "{tokens_per_sec:.2f} T/s",
+        "ttft": "首字: {ttft:.2f}s",
+        "insufficient_for_estimate": "余额不足: 本次请求预计花费约 `{cost:.4f}`，可用余额 `{balance:.4f}`",
+        "billing_pending": "计费处理中",
+        "billing_unavailable": "计费服务不可用",
     },
 }
 
@@ -42,9 +77,1665 @@ class CustomException(Exception):
     pass
 
 
+class MonitorUnavailableError(Exception):
+    """Raised without touching the network while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after ``failure_threshold`` consecutive failures. Once ``reset_timeout``
+    has passed the circuit is half-open and lets a single probe through; the probe's outcome
+    closes or re-opens it. A threshold of 0 disables the breaker.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started_at: Optional[float] = None
+        self.opens = 0
+        self.rejections = 0
+
+    def configure(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probe_started_at = None
+        return self._state
+
+    def allow(self) -> bool:
+        if self.failure_threshold <= 0:
+            return True
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN:
+            now = time.monotonic()
+            # A probe that never reported back (e.g. cancelled) must not wedge the circuit.
+            if self._probe_started_at is None or now - self._probe_started_at >= self.reset_timeout:
+                self._probe_started_at = now
+                return True
+        self.rejections += 1
+        return False
+
+    def record_success(self) -> None:
+        self._state = self.CLOSED
+        self._failures = 0
+        self._probe_started_at = None
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._state == self.HALF_OPEN or (
+            self.failure_threshold > 0 and self._failures >= self.failure_threshold
+        ):
+            if self._state != self.OPEN:
+                self.opens += 1
+                logger.warning("usage_monitor: monitor unreachable, opening circuit for %.0fs", self.reset_timeout)
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._probe_started_at = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self._failures, "opens": self.opens, "rejections": self.rejections}
+
+
+def is_outage_error(err: BaseException) -> bool:
+    """True for failures that mean the monitor is unreachable or broken, not that it said no."""
+    if isinstance(err, (MonitorUnavailableError, TransportError)):
+        return True
+    return isinstance(err, HTTPStatusError) and err.response.status_code >= 500
+
+
+def parse_endpoints(value: str) -> List[str]:
+    """Base URLs from the api_endpoint valve: one URL or a comma-separated list of replicas."""
+    return [url.strip().rstrip("/") for url in (value or "").split(",") if url.strip()]
+
+
+class MonitorEndpoint:
+    __slots__ = ("url", "outstanding", "ewma", "failures", "ejected_until", "ejections", "ejections_total")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.ewma: Optional[float] = None
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.ejections_total = 0
+
+
+class EndpointPool:
+    """
+    Client-side balancing over monitor replicas.
+
+    ``least_outstanding`` picks the replica with the fewest requests in flight; ``ewma``
+    weights that by each replica's smoothed latency (peak EWMA), so a slow replica gets
+    less traffic before it fails outright. Health checks are passive: after ``eject_after``
+    consecutive outage errors a replica is skipped for ``eject_seconds``, doubling on each
+    repeat up to 8x, and its next success restores it. When every replica is ejected the
+    one due back first is used anyway, so a single endpoint behaves as before.
+    """
+
+    EWMA_ALPHA = 0.3
+
+    def __init__(self):
+        self.endpoints: Dict[str, MonitorEndpoint] = {}
+        self._value: Optional[str] = None
+        self.strategy = "least_outstanding"
+        self.eject_after = 3
+        self.eject_seconds = 30.0
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def configure(self, value: str, strategy: str, eject_after: int, eject_seconds: float) -> None:
+        if value != self._value:
+            # Replicas that stay in the list keep their load and health.
+            self.endpoints = {url: self.endpoints.get(url) or MonitorEndpoint(url) for url in parse_endpoints(value)}
+            self._value = value
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+
+    def _score(self, endpoint: MonitorEndpoint) -> float:
+        if self.strategy == "ewma":
+            return (endpoint.ewma or 0.0) * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def pick(self, exclude: Tuple[str, ...] = ()) -> Optional[MonitorEndpoint]:
+        candidates = [endpoint for endpoint in self.endpoints.values() if endpoint.url not in exclude]
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+        now = time.monotonic()
+        healthy = [endpoint for endpoint in candidates if endpoint.ejected_until <= now]
+        if not healthy:
+            return min(candidates, key=lambda endpoint: endpoint.ejected_until)
+        best = min(self._score(endpoint) for endpoint in healthy)
+        return random.choice([endpoint for endpoint in healthy if self._score(endpoint) == best])
+
+    def finish(self, endpoint: MonitorEndpoint, seconds: float, outage: Optional[bool]) -> None:
+        """Record a finished call; ``outage`` is None when it was cancelled and says nothing about health."""
+        endpoint.outstanding -= 1
+        if outage is None:
+            return
+        if not outage:
+            endpoint.failures = 0
+            endpoint.ejections = 0
+            endpoint.ejected_until = 0.0
+            endpoint.ewma = seconds if endpoint.ewma is None else endpoint.ewma + self.EWMA_ALPHA * (seconds - endpoint.ewma)
+            return
+        endpoint.failures += 1
+        if self.eject_after > 0 and endpoint.failures >= self.eject_after and len(self.endpoints) > 1:
+            duration = self.eject_seconds * min(2**endpoint.ejections, 8)
+            endpoint.ejected_until = time.monotonic() + duration
+            endpoint.ejections += 1
+            endpoint.ejections_total += 1
+            endpoint.failures = 0
+            logger.warning("usage_monitor: monitor replica %s failing, ejecting it for %.0fs", endpoint.url, duration)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        return {
+            endpoint.url: {
+                "healthy": endpoint.ejected_until <= now,
+                "outstanding": endpoint.outstanding,
+                "ewma_seconds": endpoint.ewma,
+                "ejections": endpoint.ejections_total,
+            }
+            for endpoint in self.endpoints.values()
+        }
+
+
+class TTLCache:
+    """
+    Bounded map with a shared TTL and a size cap.
+
+    Entries are kept in write order, so expired entries are purged from the front on each
+    write (amortized O(1)) and the oldest entries are evicted first once ``max_size`` is hit.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def configure(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def _expired(self, expires_at: float, now: float) -> bool:
+        return self.ttl > 0 and expires_at <= now
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if self._expired(item[0], time.monotonic()):
+            del self._data[key]
+            self.expirations += 1
+            return default
+        return item[1]
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def now(self) -> float:
+        """Clock that timestamps stored in this map are compared against."""
+        return time.monotonic()
+
+    def set(self, key: Any, value: Any) -> None:
+        now = time.monotonic()
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        self._purge(now)
+
+    def add(self, key: Any, value: Any) -> bool:
+        """Set ``key`` only if it is absent; True when this call stored it."""
+        if key in self:
+            return False
+        self.set(key, value)
+        return True
+
+    def decrement(self, key: Any, field: str, amount: float, floor: Optional[float] = None) -> Optional[float]:
+        """Subtract ``amount`` from a numeric field of a stored dict unless the result would drop to ``floor``."""
+        entry = self.get(key)
+        if entry is None or field not in entry:
+            return None
+        value = entry[field] - amount
+        if floor is not None and value <= floor:
+            return None
+        entry[field] = value
+        return value
+
+    def update(self, key: Any, fn: Callable[[Any], Tuple[Any, Any]]) -> Any:
+        """Replace the value with ``fn(value)[0]`` (None deletes it) and return ``fn(value)[1]``."""
+        value, result = fn(self.get(key))
+        if value is None:
+            self._data.pop(key, None)
+        else:
+            self.set(key, value)
+        return result
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        if self._expired(item[0], time.monotonic()):
+            self.expirations += 1
+            return default
+        return item[1]
+
+    def _purge(self, now: float) -> None:
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if not self._expired(expires_at, now):
+                break
+            del self._data[key]
+            self.expirations += 1
+        while self.max_size > 0 and len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "evictions": self.evictions, "expirations": self.expirations}
+
+
+class BalanceCache:
+    """
+    Per-user balance snapshots seeded from monitor responses and debited optimistically.
+
+    Pre-flight reservations are held inside the user's entry, keyed by turn, and count
+    against the balance until outlet releases them or they expire; seeding a fresh balance
+    keeps them, so turns still in flight stay covered.
+    """
+
+    def __init__(self, entries: Optional[Union[TTLCache, "SharedMap"]] = None):
+        # user_id -> {"balance": float, "last_cost": float, "updated_at": seconds on entries.now(),
+        #             "reservations": {turn key: [amount, expires at]}}
+        self._entries = entries if entries is not None else TTLCache()
+
+    def get(self, user_id: str, ttl: float) -> Optional[Dict[str, float]]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if ttl <= 0 or self._entries.now() - entry["updated_at"] > ttl:
+            return None
+        return entry
+
+    def peek(self, user_id: str) -> Optional[Dict[str, float]]:
+        """Last known entry regardless of freshness, for degraded mode."""
+        return self._entries.get(user_id)
+
+    def seed(self, user_id: str, balance: float, last_cost: Optional[float] = None) -> None:
+        now = self._entries.now()
+
+        def apply(entry: Optional[dict]) -> Tuple[dict, None]:
+            entry = entry or {"last_cost": 0.0}
+            entry["balance"] = float(balance)
+            if last_cost is not None:
+                entry["last_cost"] = float(last_cost)
+            entry["updated_at"] = now
+            return entry, None
+
+        self._entries.update(user_id, apply)
+
+    @staticmethod
+    def _live_reservations(entry: dict, now: float) -> Dict[str, List[float]]:
+        return {key: held for key, held in (entry.get("reservations") or {}).items() if held[1] > now}
+
+    def available(self, entry: dict) -> float:
+        """Cached balance minus the unexpired reservations held against it."""
+        held = self._live_reservations(entry, self._entries.now()).values()
+        return entry["balance"] - sum(amount for amount, _ in held)
+
+    def reserve(self, user_id: str, key: str, amount: float, ttl: float, floor: float = 0.0) -> Optional[float]:
+        """Hold ``amount`` for turn ``key`` unless the available balance would drop to ``floor``; returns what is left."""
+        now = self._entries.now()
+
+        def apply(entry: Optional[dict]) -> Tuple[Optional[dict], Optional[float]]:
+            if entry is None or "balance" not in entry:
+                return entry, None
+            live = self._live_reservations(entry, now)
+            live.pop(key, None)
+            left = entry["balance"] - sum(held for held, _ in live.values()) - amount
+            if left > floor:
+                live[key] = [amount, now + ttl]
+            entry["reservations"] = live
+            return entry, left if left > floor else None
+
+        return self._entries.update(user_id, apply)
+
+    def release(self, user_id: str, key: str, debit: bool = False) -> float:
+        """Drop the reservation of turn ``key``; with ``debit`` its amount stays spent until the next seed."""
+        now = self._entries.now()
+
+        def apply(entry: Optional[dict]) -> Tuple[Optional[dict], float]:
+            if entry is None:
+                return None, 0.0
+            live = self._live_reservations(entry, now)
+            held = live.pop(key, None)
+            entry["reservations"] = live
+            if held is None:
+                return entry, 0.0
+            if debit:
+                entry["balance"] -= held[0]
+            return entry, held[0]
+
+        return self._entries.update(user_id, apply)
+
+    def debit(self, user_id: str, amount: float, floor: Optional[float] = None) -> Optional[float]:
+        """Atomically take ``amount`` off the cached balance; None if missing or it would reach ``floor``."""
+        # Debits do not refresh updated_at: only authoritative balances extend freshness.
+        return self._entries.decrement(user_id, "balance", amount, floor)
+
+    def invalidate(self, user_id: str) -> None:
+        self._entries.pop(user_id, None)
+
+    def configure(self, max_size: int, ttl: float) -> None:
+        self._entries.configure(max_size, ttl)
+
+    def stats(self) -> Dict[str, int]:
+        return self._entries.stats()
+
+
+class StateBackend:
+    """
+    Key/value store shared by the filter instances of several workers.
+
+    Values are JSON, keys are namespaced per state map and expire after a per-write TTL.
+    ``add`` and ``decrement`` must be atomic across processes: they carry message dedupe
+    and cached balance debits.
+    """
+
+    name = "memory"
+
+    def now(self) -> float:
+        # Wall clock, so timestamps compare across processes (and hosts, for Redis).
+        return time.time()
+
+    def get(self, namespace: str, key: str) -> Any:
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: Any, ttl: float) -> None:
+        raise NotImplementedError
+
+    def pop(self, namespace: str, key: str) -> Any:
+        raise NotImplementedError
+
+    def add(self, namespace: str, key: str, value: Any, ttl: float) -> bool:
+        raise NotImplementedError
+
+    def decrement(self, namespace: str, key: str, field: str, amount: float, floor: Optional[float]) -> Optional[float]:
+        raise NotImplementedError
+
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Tuple[Any, Any]], ttl: float) -> Any:
+        """Atomic read-modify-write; ``fn`` must be pure, as it may run more than once."""
+        raise NotImplementedError
+
+    def size(self, namespace: str) -> Optional[int]:
+        """Live entries in ``namespace``, or None when counting them is not cheap."""
+        return None
+
+
+class SQLiteStateBackend(StateBackend):
+    """Single-host backend: one WAL-mode SQLite file shared by every worker."""
+
+    name = "sqlite"
+    PURGE_EVERY = 256
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Workers are forked after the module loads, so each process opens its own connection.
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS filter_state ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL,"
+                " PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS filter_state_expires ON filter_state (expires_at)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _expires_at(ttl: float, now: float) -> Optional[float]:
+        return now + ttl if ttl > 0 else None
+
+    def _after_write(self, conn: sqlite3.Connection, now: float) -> None:
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM filter_state WHERE expires_at <= ?", (now,))
+
+    def _select(self, conn: sqlite3.Connection, namespace: str, key: str, now: float) -> Optional[str]:
+        row = conn.execute(
+            "SELECT value FROM filter_state WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, now),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get(self, namespace: str, key: str) -> Any:
+        with self._lock:
+            raw = self._select(self._connection(), namespace, key, self.now())
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, namespace: str, key: str, value: Any, ttl: float) -> None:
+        now = self.now()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO filter_state VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), self._expires_at(ttl, now)),
+            )
+            self._after_write(conn, now)
+
+    def pop(self, namespace: str, key: str) -> Any:
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                raw = self._select(conn, namespace, key, self.now())
+                conn.execute("DELETE FROM filter_state WHERE namespace = ? AND key = ?", (namespace, key))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return json.loads(raw) if raw is not None else None
+
+    def add(self, namespace: str, key: str, value: Any, ttl: float) -> bool:
+        now = self.now()
+        with self._lock:
+            conn = self._connection()
+            # Expired rows count as absent, so the upsert may only overwrite those.
+            cursor = conn.execute(
+                "INSERT INTO filter_state VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at"
+                " WHERE filter_state.expires_at <= ?",
+                (namespace, key, json.dumps(value), self._expires_at(ttl, now), now),
+            )
+            self._after_write(conn, now)
+            return cursor.rowcount == 1
+
+    def decrement(self, namespace: str, key: str, field: str, amount: float, floor: Optional[float]) -> Optional[float]:
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                raw = self._select(conn, namespace, key, self.now())
+                entry = json.loads(raw) if raw is not None else None
+                if not isinstance(entry, dict) or field not in entry:
+                    conn.execute("COMMIT")
+                    return None
+                value = entry[field] - amount
+                if floor is not None and value <= floor:
+                    conn.execute("COMMIT")
+                    return None
+                entry[field] = value
+                conn.execute(
+                    "UPDATE filter_state SET value = ? WHERE namespace = ? AND key = ?",
+                    (json.dumps(entry), namespace, key),
+                )
+                conn.execute("COMMIT")
+                return value
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Tuple[Any, Any]], ttl: float) -> Any:
+        now = self.now()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                raw = self._select(conn, namespace, key, now)
+                value, result = fn(json.loads(raw) if raw is not None else None)
+                if value is None:
+                    conn.execute("DELETE FROM filter_state WHERE namespace = ? AND key = ?", (namespace, key))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO filter_state VALUES (?, ?, ?, ?)",
+                        (namespace, key, json.dumps(value), self._expires_at(ttl, now)),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            self._after_write(conn, now)
+        return result
+
+    def size(self, namespace: str) -> Optional[int]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT COUNT(*) FROM filter_state WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, self.now()),
+            ).fetchone()
+        return row[0]
+
+
+class RedisStateBackend(StateBackend):
+    """Multi-host backend for Redis or a protocol-compatible server (Valkey, KeyDB, ...)."""
+
+    name = "redis"
+    KEY_PREFIX = "usage_monitor:"
+    # GET/SET under one script so concurrent debits of the same user serialize on the server.
+    DECREMENT_SCRIPT = """
+local raw = redis.call('GET', KEYS[1])
+if not raw then return false end
+local entry = cjson.decode(raw)
+local value = tonumber(entry[ARGV[1]])
+if value == nil then return false end
+value = value - tonumber(ARGV[2])
+if ARGV[3] ~= '' and value <= tonumber(ARGV[3]) then return false end
+entry[ARGV[1]] = value
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl > 0 then
+  redis.call('SET', KEYS[1], cjson.encode(entry), 'PX', ttl)
+else
+  redis.call('SET', KEYS[1], cjson.encode(entry))
+end
+return tostring(value)
+"""
+
+    def __init__(self, url: str, timeout: float = 0.5):
+        import redis
+
+        self._client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._decrement = self._client.register_script(self.DECREMENT_SCRIPT)
+        self._watch_error = redis.WatchError
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.KEY_PREFIX}{namespace}:{key}"
+
+    @staticmethod
+    def _ttl_ms(ttl: float) -> Optional[int]:
+        return max(1, int(ttl * 1000)) if ttl > 0 else None
+
+    def get(self, namespace: str, key: str) -> Any:
+        raw = self._client.get(self._key(namespace, key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, namespace: str, key: str, value: Any, ttl: float) -> None:
+        self._client.set(self._key(namespace, key), json.dumps(value), px=self._ttl_ms(ttl))
+
+    def pop(self, namespace: str, key: str) -> Any:
+        pipe = self._client.pipeline(transaction=True)
+        pipe.get(self._key(namespace, key))
+        pipe.delete(self._key(namespace, key))
+        raw, _ = pipe.execute()
+        return json.loads(raw) if raw is not None else None
+
+    def add(self, namespace: str, key: str, value: Any, ttl: float) -> bool:
+        return bool(self._client.set(self._key(namespace, key), json.dumps(value), px=self._ttl_ms(ttl), nx=True))
+
+    def decrement(self, namespace: str, key: str, field: str, amount: float, floor: Optional[float]) -> Optional[float]:
+        result = self._decrement(
+            keys=[self._key(namespace, key)], args=[field, repr(float(amount)), "" if floor is None else repr(float(floor))]
+        )
+        return float(result) if result is not None else None
+
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Tuple[Any, Any]], ttl: float) -> Any:
+        name = self._key(namespace, key)
+        with self._client.pipeline() as pipe:
+            # Optimistic transaction: retry when another client wrote the key in between.
+            while True:
+                try:
+                    pipe.watch(name)
+                    raw = pipe.get(name)
+                    value, result = fn(json.loads(raw) if raw is not None else None)
+                    pipe.multi()
+                    if value is None:
+                        pipe.delete(name)
+                    else:
+                        pipe.set(name, json.dumps(value), px=self._ttl_ms(ttl))
+                    pipe.execute()
+                    return result
+                except self._watch_error:
+                    continue
+
+
+def create_state_backend(kind: str, url: str) -> Optional[StateBackend]:
+    """Backend for the ``state_backend`` valve; None keeps state in process."""
+    if kind == "sqlite":
+        return SQLiteStateBackend(url or STATE_DB_PATH)
+    if kind == "redis":
+        return RedisStateBackend(url or "redis://localhost:6379/0")
+    return None
+
+
+class SharedMap:
+    """
+    TTLCache-compatible view of one namespace in a StateBackend.
+
+    Without a backend, or while the backend is failing, entries live in a local TTLCache,
+    i.e. the filter degrades to per-worker state rather than failing the turn.
+    """
+
+    WARN_INTERVAL = 60.0
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.local = TTLCache()
+        self.backend: Optional[StateBackend] = None
+        self.errors = 0
+        self._warned_at = float("-inf")
+
+    def configure(self, max_size: int, ttl: float) -> None:
+        self.local.configure(max_size, ttl)
+
+    def _fallback(self, op: str, err: Exception) -> None:
+        self.errors += 1
+        now = time.monotonic()
+        if now - self._warned_at >= self.WARN_INTERVAL:
+            self._warned_at = now
+            logger.warning(
+                "usage_monitor: %s state backend failed on %s %s (%s), using worker-local state",
+                self.backend.name,
+                op,
+                self.namespace,
+                err,
+            )
+
+    def now(self) -> float:
+        return self.backend.now() if self.backend is not None else self.local.now()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if self.backend is not None:
+            try:
+                value = self.backend.get(self.namespace, str(key))
+                return default if value is None else value
+            except Exception as err:
+                self._fallback("get", err)
+        return self.local.get(key, default)
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key) is not None
+
+    def set(self, key: Any, value: Any) -> None:
+        if self.backend is not None:
+            try:
+                self.backend.set(self.namespace, str(key), value, self.local.ttl)
+                return
+            except Exception as err:
+                self._fallback("set", err)
+        self.local.set(key, value)
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        if self.backend is not None:
+            try:
+                value = self.backend.pop(self.namespace, str(key))
+                return default if value is None else value
+            except Exception as err:
+                self._fallback("pop", err)
+        return self.local.pop(key, default)
+
+    def add(self, key: Any, value: Any) -> bool:
+        if self.backend is not None:
+            try:
+                return self.backend.add(self.namespace, str(key), value, self.local.ttl)
+            except Exception as err:
+                self._fallback("add", err)
+        return self.local.add(key, value)
+
+    def decrement(self, key: Any, field: str, amount: float, floor: Optional[float] = None) -> Optional[float]:
+        if self.backend is not None:
+            try:
+                return self.backend.decrement(self.namespace, str(key), field, amount, floor)
+            except Exception as err:
+                self._fallback("decrement", err)
+        return self.local.decrement(key, field, amount, floor)
+
+    def update(self, key: Any, fn: Callable[[Any], Tuple[Any, Any]]) -> Any:
+        if self.backend is not None:
+            try:
+                return self.backend.update(self.namespace, str(key), fn, self.local.ttl)
+            except Exception as err:
+                self._fallback("update", err)
+        return self.local.update(key, fn)
+
+    def __len__(self) -> int:
+        return self.stats()["size"]
+
+    def stats(self) -> Dict[str, int]:
+        stats = self.local.stats()
+        if self.backend is not None:
+            try:
+                size = self.backend.size(self.namespace)
+            except Exception as err:
+                self._fallback("size", err)
+            else:
+                if size is not None:
+                    stats["size"] = size
+        return stats
+
+
+# Histogram bucket upper bounds: seconds, bytes, seconds per turn, tokens per second, events.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+TURN_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# name -> (type, help, buckets); gauges and state counters are sampled when rendering.
+METRIC_DEFINITIONS = {
+    "request_seconds": ("histogram", "Round trip time of monitor requests.", LATENCY_BUCKETS),
+    "serialize_seconds": ("histogram", "Time spent encoding monitor request bodies.", LATENCY_BUCKETS),
+    "request_bytes": ("histogram", "Monitor request body size as sent, after any compression.", SIZE_BUCKETS),
+    "request_encoding_total": ("counter", "Monitor request bodies by content encoding.", None),
+    "response_bytes": ("histogram", "Monitor response body size.", SIZE_BUCKETS),
+    "errors_total": ("counter", "Failed monitor calls by path and error type.", None),
+    "hook_seconds": ("histogram", "Time the filter adds to a turn in inlet and outlet.", LATENCY_BUCKETS),
+    "inlet_cache_total": ("counter", "Inlet balance checks answered locally (hit) or by the monitor (miss).", None),
+    "reservations_total": ("counter", "Pre-flight cost reservations by result.", None),
+    "local_cost_checks_total": ("counter", "Locally computed costs the monitor confirmed (match) or recomputed (mismatch).", None),
+    "outlet_total": ("counter", "Outlet calls by how their usage was handled.", None),
+    "turn_seconds": ("histogram", "Elapsed time from inlet to outlet per turn.", TURN_BUCKETS),
+    "turn_tokens_per_second": ("histogram", "Output tokens per second over the whole turn.", RATE_BUCKETS),
+    "ttft_seconds": ("histogram", "Time from inlet to the first streamed chunk.", TURN_BUCKETS),
+    "decode_tokens_per_second": ("histogram", "Output tokens per second between the first and last chunk.", RATE_BUCKETS),
+    "report_batch_size": ("histogram", "Usage events per delivery to the monitor.", BATCH_BUCKETS),
+    "report_queue_depth": ("gauge", "Usage events waiting in the in-memory queue.", None),
+    "report_spool_pending": ("gauge", "1 while the spool may hold undelivered usage events.", None),
+    "report_consecutive_failures": ("gauge", "Failed deliveries since the last successful one.", None),
+    "state_entries": ("gauge", "Entries in each bounded state map.", None),
+    "state_removed_total": ("counter", "State map entries dropped by size eviction or expiry.", None),
+    "state_backend_errors_total": ("counter", "Shared state backend calls that failed and fell back to worker-local state.", None),
+    "token_cache_total": ("counter", "Local token count cache lookups by result.", None),
+    "endpoint_retries_total": ("counter", "Monitor calls retried on another replica after an outage error.", None),
+    "endpoint_healthy": ("gauge", "1 while a monitor replica is not ejected.", None),
+    "endpoint_outstanding": ("gauge", "Requests in flight per monitor replica.", None),
+    "endpoint_latency_ewma_seconds": ("gauge", "Smoothed round trip time per monitor replica.", None),
+    "endpoint_ejections_total": ("counter", "Times a monitor replica was ejected after consecutive failures.", None),
+    "breaker_state": ("gauge", "Circuit breaker state, 1 for the current one.", None),
+    "breaker_opens_total": ("counter", "Times the circuit breaker opened.", None),
+    "breaker_rejections_total": ("counter", "Monitor calls refused while the circuit was open.", None),
+    "capture_lines_total": ("counter", "Traffic capture lines written or dropped.", None),
+}
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _prom_labels(labels: Tuple[Tuple[str, Any], ...], **extra: Any) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for key, value in items
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Metrics:
+    """
+    In-process counters and histograms rendered in the Prometheus text exposition format.
+
+    Updates are plain dict and int operations on the event loop, so recording costs well
+    under a microsecond. ``render`` should also run on the loop; write its output elsewhere.
+    """
+
+    def __init__(self, prefix: str, definitions: Dict[str, Tuple[str, str, Optional[Tuple]]]):
+        self.prefix = prefix
+        self.definitions = definitions
+        self.enabled = True
+        self._series: Dict[Tuple[str, Tuple[Tuple[str, Any], ...]], Any] = {}
+
+    def inc(self, name: str, amount: float = 1, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def observe(self, name: str, value: Optional[float], **labels: Any) -> None:
+        if not self.enabled or value is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._series.get(key)
+        if histogram is None:
+            histogram = self._series[key] = Histogram(self.definitions[name][2])
+        histogram.observe(value)
+
+    def render(self, samples: List[Tuple[str, Dict[str, Any], float]] = ()) -> str:
+        """Render recorded series plus point-in-time ``(name, labels, value)`` samples."""
+        grouped: Dict[str, List[Tuple[Tuple, Any]]] = {}
+        for (name, labels), value in list(self._series.items()):
+            grouped.setdefault(name, []).append((labels, value))
+        for name, labels, value in samples:
+            grouped.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+
+        lines = []
+        for name, (kind, help_text, _) in self.definitions.items():
+            if name not in grouped:
+                continue
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in sorted(grouped[name], key=lambda item: item[0]):
+                if not isinstance(value, Histogram):
+                    lines.append(f"{full_name}{_prom_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_prom_labels(labels, le=float(bound))} {cumulative}")
+                lines.append(f"{full_name}_bucket{_prom_labels(labels, le='+Inf')} {value.count}")
+                lines.append(f"{full_name}_sum{_prom_labels(labels)} {value.sum}")
+                lines.append(f"{full_name}_count{_prom_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+def error_label(err: BaseException) -> str:
+    if isinstance(err, HTTPStatusError):
+        return f"http_{err.response.status_code}"
+    if isinstance(err, MonitorUnavailableError):
+        return "circuit_open"
+    if isinstance(err, CustomException):
+        return "rejected"
+    return type(err).__name__
+
+
+def write_text_atomic(path: str, text: str) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        handle.write(text)
+    os.replace(tmp_path, path)
+
+
+class StreamTiming:
+    """First/last chunk times and inter-chunk gap moments of one streamed message."""
+
+    __slots__ = ("first", "last", "chunks", "gap_sum", "gap_sq_sum", "ttft")
+
+    def __init__(self, now: float, turn_start: Optional[float]):
+        self.first = self.last = now
+        self.chunks = 1
+        self.gap_sum = 0.0
+        self.gap_sq_sum = 0.0
+        self.ttft = None if turn_start is None else max(0.0, now - turn_start)
+
+    def add(self, now: float) -> None:
+        gap = now - self.last
+        self.gap_sum += gap
+        self.gap_sq_sum += gap * gap
+        self.last = now
+        self.chunks += 1
+
+    def summary(self) -> Dict[str, Any]:
+        """Wire form sent to the monitor; jitter is the standard deviation of chunk gaps."""
+        gaps = self.chunks - 1
+        mean = self.gap_sum / gaps if gaps else 0.0
+        jitter = math.sqrt(max(0.0, self.gap_sq_sum / gaps - mean * mean)) if gaps else 0.0
+        return {
+            "ttft_ms": None if self.ttft is None else round(self.ttft * 1000, 1),
+            "decode_ms": round((self.last - self.first) * 1000, 1),
+            "chunks": self.chunks,
+            "jitter_ms": round(jitter * 1000, 2),
+        }
+
+
+def chunk_has_content(event: dict) -> bool:
+    for choice in event.get("choices") or ():
+        delta = (choice.get("delta") or {}) if isinstance(choice, dict) else {}
+        if delta.get("content") or delta.get("reasoning_content"):
+            return True
+    return False
+
+
+def decode_tokens_per_sec(timing: Optional[dict], output_tokens: int) -> Optional[float]:
+    """
+    Decode speed from a timing summary: tokens after the first chunk over the first-to-last
+    chunk time, assuming tokens are spread evenly over chunks.
+    """
+    if not timing or not output_tokens or timing["chunks"] < 2 or timing["decode_ms"] <= 0:
+        return None
+    decoded = output_tokens * (timing["chunks"] - 1) / timing["chunks"]
+    return decoded / (timing["decode_ms"] / 1000)
+
+
+# Wire format version understood by the monitor's inlet/outlet routes; 1 is the legacy {"user", "body"} shape.
+COMPACT_PAYLOAD_VERSION = 2
+USER_FIELDS = ("id", "email", "name", "role")
+
+
+def json_default(o: Any) -> Any:
+    if hasattr(o, "model_dump"):
+        return o.model_dump(mode="json")
+    return o.dict() if hasattr(o, "dict") else str(o)
+
+
+def dump_json(data: Any) -> bytes:
+    """
+    Encode a request body straight to UTF-8 JSON bytes in one pass.
+
+    Uses orjson when it is installed; pydantic models (user valves, model metadata) are
+    dumped by ``json_default`` either way, so callers never convert them up front.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # orjson refuses integers beyond 64 bits and very deep nesting; the stdlib does not.
+            pass
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=json_default).encode("utf-8")
+
+
+def to_jsonable(data: Any) -> Any:
+    return (orjson.loads if orjson is not None else json.loads)(dump_json(data))
+
+
+# Content-Encoding values the monitor's inlet/outlet routes can decode.
+REQUEST_COMPRESSIONS = ("gzip", "zstd")
+
+
+def request_headers(encoding: str) -> Dict[str, str]:
+    headers = {"Content-Type": "application/json"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return headers
+
+
+def compress_body(content: bytes, encoding: str) -> Optional[bytes]:
+    """Compress a request body, or return None when the codec is not available here."""
+    if encoding == "gzip":
+        return gzip.compress(content, compresslevel=5, mtime=0)
+    if encoding == "zstd":
+        try:
+            from compression import zstd  # Python 3.14+
+
+            return zstd.compress(content, level=3)
+        except ImportError:
+            pass
+        try:
+            import zstandard
+        except ImportError:
+            return None
+        return zstandard.ZstdCompressor(level=3).compress(content)
+    return None
+
+
+def message_text(content: Any) -> str:
+    """Flatten message content (plain string or multimodal parts) to the text that gets tokenized."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            part.get("text", "") for part in content if isinstance(part, dict) and part.get("type") == "text"
+        )
+    return "" if content is None else str(content)
+
+
+class TokenCounter:
+    """
+    Local token counting for turns without provider usage.
+
+    Counts are cached per message content hash in a bounded LRU, so earlier turns of a
+    conversation are never re-tokenized. ``tiktoken`` uses cl100k_base, the encoding the
+    monitor itself counts with; ``heuristic`` trades accuracy for speed.
+    """
+
+    def __init__(self, backend: str, cache_size: int):
+        self.requested_backend = backend
+        self.backend = backend
+        self.cache_size = max(0, cache_size)
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self._encoding = None
+        self.hits = 0
+        self.misses = 0
+        if backend == "tiktoken":
+            try:
+                import tiktoken
+
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as err:
+                logger.warning("usage_monitor: tiktoken unavailable (%s), using heuristic token counts", err)
+                self.backend = "heuristic"
+
+    def _encode_length(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        # Roughly 4 characters per token for ASCII text and one token per CJK/other character.
+        ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+        return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached
+        self.misses += 1
+        tokens = self._encode_length(text)
+        if self.cache_size:
+            self._cache[key] = tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def count_messages(self, messages: List[dict]) -> Tuple[int, int]:
+        """Return (input, output) tokens the way the monitor splits them: last message is output."""
+        counts = [self.count(message_text(m.get("content"))) for m in messages if isinstance(m, dict)]
+        if not counts:
+            return 0, 0
+        return sum(counts[:-1]), counts[-1]
+
+
+class PriceTable:
+    """
+    Model prices mirrored from the monitor's ``/api/v1/models/prices``.
+
+    Prices are per million tokens; a ``per_msg_price`` >= 0 is a flat price per reply, as in
+    the monitor's calculateCost. Models missing from the table use the monitor's defaults.
+    ``version`` identifies the monitor's table: it is sent back with locally computed costs
+    and, as the ETag, makes refreshes of an unchanged table a bodyless 304. Inlet costs
+    (the monitor's COST_ON_INLET) stay unknown with monitors that do not publish them.
+    """
+
+    def __init__(self):
+        self.prices: Dict[str, Dict[str, float]] = {}
+        self.default: Optional[Dict[str, float]] = None
+        self.inlet_costs: Optional[Dict[str, float]] = None
+        self.default_inlet_cost: Optional[float] = None
+        self.version: Optional[str] = None
+        self.etag: Optional[str] = None
+        self.fetched_at: Optional[float] = None
+        self.attempted_at: Optional[float] = None
+
+    def due(self, interval: float) -> bool:
+        return self.attempted_at is None or time.monotonic() - self.attempted_at >= interval
+
+    def load(self, data: dict, etag: Optional[str] = None) -> None:
+        self.prices = {
+            str(model["id"]): {
+                "input_price": float(model["input_price"]),
+                "output_price": float(model["output_price"]),
+                "per_msg_price": float(model.get("per_msg_price", -1)),
+            }
+            for model in data.get("models") or []
+        }
+        default = data.get("default")
+        self.default = (
+            {"input_price": float(default["input_price"]), "output_price": float(default["output_price"]), "per_msg_price": -1.0}
+            if default
+            else None
+        )
+        inlet_cost = data.get("inlet_cost")
+        if isinstance(inlet_cost, dict):
+            self.inlet_costs = {str(k): float(v) for k, v in (inlet_cost.get("models") or {}).items()}
+            self.default_inlet_cost = float(inlet_cost.get("default") or 0)
+        else:
+            self.inlet_costs = self.default_inlet_cost = None
+        self.version = data.get("version")
+        self.etag = etag
+        self.fetched_at = time.monotonic()
+
+    def inlet_cost(self, model_id: Optional[str]) -> Optional[float]:
+        """What the monitor charges this model on inlet, or None while that is unknown."""
+        if self.inlet_costs is None:
+            return None
+        return self.inlet_costs.get(model_id, self.default_inlet_cost) if model_id is not None else self.default_inlet_cost
+
+    def price(self, model_id: Optional[str]) -> Optional[Dict[str, float]]:
+        return self.prices.get(model_id, self.default) if model_id is not None else self.default
+
+    def estimate(self, model_id: Optional[str], input_tokens: int, output_tokens: int) -> Optional[float]:
+        """Upper-bound style cost of a turn, or None while the model's price is unknown."""
+        price = self.price(model_id)
+        if price is None:
+            return None
+        if price["per_msg_price"] >= 0:
+            return price["per_msg_price"]
+        return (input_tokens * price["input_price"] + output_tokens * price["output_price"]) / 1_000_000
+
+    def cost(self, model_id: Optional[str], input_tokens: int, output_tokens: int) -> Optional[float]:
+        """The monitor's calculateCost on the cached prices, or None while they are unknown."""
+        price = self.price(model_id)
+        if price is None or self.version is None:
+            return None
+        if output_tokens == 0:
+            return 0.0
+        if price["per_msg_price"] >= 0:
+            return price["per_msg_price"]
+        return (input_tokens / 1_000_000) * price["input_price"] + (output_tokens / 1_000_000) * price["output_price"]
+
+
+def payload_tokens(payload: dict) -> Optional[Tuple[int, int]]:
+    """(input, output) tokens the monitor will bill for an outlet payload, when known up front."""
+    usage = payload.get("usage")
+    if usage is None and isinstance(payload.get("body"), dict):
+        messages = payload["body"].get("messages") or []
+        usage = messages[-1].get("usage") if messages and isinstance(messages[-1], dict) else None
+    if usage and usage.get("prompt_tokens") and usage.get("completion_tokens"):
+        return usage["prompt_tokens"], usage["completion_tokens"]
+    tokens = payload.get("tokens")
+    if tokens:
+        return tokens["input"], tokens["output"]
+    return None
+
+
+def compact_user(user: dict) -> dict:
+    return {k: user.get(k) for k in USER_FIELDS if k in user}
+
+
+def compact_usage_payload(
+    user: dict, body: dict, with_messages: bool = True, token_counter: Optional[TokenCounter] = None
+) -> dict:
+    """
+    Build a version 2 request: model id, user and the last message's usage.
+    When usage is missing, local token counts are sent if a counter is given; otherwise plain
+    role/content pairs are included so the monitor can count tokens itself.
+    """
+    payload = {"version": COMPACT_PAYLOAD_VERSION, "user": compact_user(user), "model": body.get("model")}
+    if not with_messages:
+        return payload
+    messages = body.get("messages") or []
+    usage = (messages[-1].get("usage") if messages and isinstance(messages[-1], dict) else None) or {}
+    if usage.get("prompt_tokens") and usage.get("completion_tokens"):
+        payload["usage"] = {"prompt_tokens": usage["prompt_tokens"], "completion_tokens": usage["completion_tokens"]}
+    elif token_counter is not None:
+        input_tokens, output_tokens = token_counter.count_messages(messages)
+        payload["tokens"] = {"input": input_tokens, "output": output_tokens}
+    else:
+        payload["messages"] = [{"role": m.get("role"), "content": message_text(m.get("content"))} for m in messages]
+    return payload
+
+
+def chain_fingerprint(previous: str, role: str, content: str) -> str:
+    """sha256 over the previous fingerprint, role and text; the monitor computes the same chain."""
+    digest = hashlib.sha256()
+    for part in (previous, "\n", role, "\n", content):
+        digest.update(part.encode("utf-8", "surrogatepass"))
+    return digest.hexdigest()[:32]
+
+
+def message_fingerprints(messages: List[dict]) -> List[str]:
+    fingerprints = []
+    previous = ""
+    for message in messages:
+        previous = chain_fingerprint(previous, message.get("role") or "", message.get("content") or "")
+        fingerprints.append(previous)
+    return fingerprints
+
+
+def delta_section(chat_id: str, messages: List[dict], fingerprints: List[str], prefix_count: int) -> dict:
+    """Version 2 "delta": only the messages after the first ``prefix_count`` already reported ones."""
+    return {
+        "chat_id": chat_id,
+        "prefix_count": prefix_count,
+        "prefix_hash": fingerprints[prefix_count - 1] if prefix_count else "",
+        "messages": messages[prefix_count:],
+    }
+
+
+# Bumped when the fields of a traffic capture line change; scripts/replay_filters.py checks it.
+CAPTURE_FORMAT_VERSION = 1
+
+
+def anonymize_id(value: Any) -> Optional[str]:
+    """Stable short hash of a user, chat or message id, so captures link turns without the ids."""
+    if value is None:
+        return None
+    return hashlib.sha256(f"usage_monitor:{value}".encode("utf-8", "surrogatepass")).hexdigest()[:16]
+
+
+def capture_sampled(turn: Optional[str], rate: float) -> bool:
+    """Sample whole turns: inlet and outlet of one message id are captured together, on any worker."""
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    if turn is None:
+        return random.random() < rate
+    return int(turn[:8], 16) / 0x100000000 < rate
+
+
+def call_shape(
+    hook: str, body: dict, metadata: dict, user: dict, seconds: float, outcome: str, chunks: Optional[int] = None
+) -> dict:
+    """
+    One traffic capture line: the shape of an inlet/outlet call without its content.
+
+    Ids are hashed, messages are reduced to a role letter and a character count each, and the
+    outlet keeps only the token counts of the attached usage. Model ids are kept as sent.
+    """
+    messages = [m for m in body.get("messages") or [] if isinstance(m, dict)]
+    shape: Dict[str, Any] = {
+        "v": CAPTURE_FORMAT_VERSION,
+        "ts": round(time.time(), 3),
+        "hook": hook,
+        "turn": anonymize_id(metadata.get("message_id")),
+        "user": anonymize_id(user.get("id")),
+        "chat": anonymize_id(body.get("chat_id") or metadata.get("chat_id")),
+        "model": body.get("model"),
+        "roles": "".join(str(m.get("role") or "?")[:1] for m in messages),
+        "chars": [len(message_text(m.get("content"))) for m in messages],
+        "ms": round(seconds * 1000, 3),
+        "outcome": outcome,
+    }
+    task = body.get("task") or metadata.get("task")
+    if task:
+        shape["task"] = task
+    if hook == "outlet":
+        usage = messages[-1].get("usage") if messages else None
+        shape["usage"] = (
+            [usage.get("prompt_tokens"), usage.get("completion_tokens")] if isinstance(usage, dict) else None
+        )
+        if chunks is not None:
+            shape["chunks"] = chunks
+    return shape
+
+
+def append_lines(path: str, lines: List[bytes]) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "ab") as handle:
+        handle.write(b"".join(lines))
+
+
+class TrafficCapture:
+    """
+    Buffered NDJSON writer for capture_path, replayed by scripts/replay_filters.py.
+
+    Lines are appended off the event loop in one write per second (or per 256 lines), so a
+    capture costs the hooks a dict and a serialization. If the disk falls behind, lines beyond
+    max_pending are dropped and counted rather than held in memory.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, flush_lines: int = 256, max_pending: int = 65536):
+        self.flush_interval = flush_interval
+        self.flush_lines = flush_lines
+        self.max_pending = max_pending
+        self._lines: List[bytes] = []
+        self._path: Optional[str] = None
+        self._flushed_at = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, path: str, shape: dict) -> None:
+        self._path = path
+        if len(self._lines) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._lines.append(dump_json(shape) + b"\n")
+        now = time.monotonic()
+        if len(self._lines) < self.flush_lines and now - self._flushed_at < self.flush_interval:
+            return
+        if self._task is not None and not self._task.done():
+            return
+        lines, self._lines = self._lines, []
+        self._flushed_at = now
+        self._task = asyncio.get_running_loop().create_task(self._write(path, lines))
+
+    async def _write(self, path: str, lines: List[bytes]) -> None:
+        try:
+            await asyncio.to_thread(append_lines, path, lines)
+            self.written += len(lines)
+        except OSError as err:
+            self.dropped += len(lines)
+            logger.warning("usage_monitor: failed to write traffic capture to %s: %s", path, err)
+
+    async def flush(self) -> None:
+        """Write out buffered lines now, e.g. before a capture file is collected."""
+        if self._task is not None:
+            await self._task
+        if self._lines and self._path:
+            lines, self._lines = self._lines, []
+            self._flushed_at = time.monotonic()
+            await self._write(self._path, lines)
+
+
+class UsageReporter:
+    """
+    Background delivery of outlet usage events.
+
+    Events are queued in memory (bounded) and delivered in batches by a worker task that
+    coalesces whatever arrives within ``report_batch_window`` seconds.
+    When the queue is full or a delivery fails, events are appended to an NDJSON spool
+    file which is replayed once the monitor accepts deliveries again and on restart.
+    Events that keep failing past ``max_attempts`` (0 = retry forever) go to ``<spool>.dead``.
+    Callers that need the monitor's answer submit with ``wait=True``; those events are
+    never spooled and their failure is raised back to the caller instead.
+    The spool may be shared by the workers of a host: appends and the rename into
+    ``.replay`` lock the spool file, and one worker at a time replays it under ``<spool>.lock``.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[List[dict]], Awaitable[List[Union[dict, Exception]]]],
+        get_valves: Callable[[], Any],
+        on_delivered: Optional[Callable[[dict, dict], Awaitable[None]]] = None,
+    ):
+        self._send = send
+        self._get_valves = get_valves
+        self._on_delivered = on_delivered
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, get_valves().report_queue_size))
+        self._task: Optional[asyncio.Task] = None
+        self._file_lock = threading.Lock()
+        self._failures = 0
+        self._spooled = True  # unknown until the first replay, so check the disk once
+        self._waiters: Dict[str, asyncio.Future] = {}
+
+    @property
+    def spool_path(self) -> str:
+        return self._get_valves().report_spool_path
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self._queue.qsize(), "spool_pending": int(self._spooled), "failures": self._failures}
+
+    def ensure_started(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        if self._task is not None and not self._task.cancelled() and self._task.exception():
+            logger.error("usage_monitor: reporter stopped, restarting: %s", self._task.exception())
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, event: dict, wait: bool = False) -> Optional[dict]:
+        self.ensure_started()
+        if wait:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters[event["id"]] = future
+            try:
+                await self._queue.put(event)
+                return await future
+            finally:
+                self._waiters.pop(event["id"], None)
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            await self._spool([event])
+        return None
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        pending = []
+        while not self._queue.empty():
+            event = self._queue.get_nowait()
+            waiter = self._waiters.get(event["id"])
+            if waiter is not None:
+                if not waiter.done():
+                    waiter.set_exception(CustomException("usage reporter stopped"))
+                continue
+            pending.append(event)
+        if pending:
+            await self._spool(pending)
+
+    async def _run(self) -> None:
+        await self._replay()
+        while True:
+            if self._spooled:
+                # Retry the spool on the backoff schedule even when no new events arrive.
+                try:
+                    first = await asyncio.wait_for(self._queue.get(), self._retry_delay())
+                except asyncio.TimeoutError:
+                    await self._replay()
+                    continue
+            else:
+                first = await self._queue.get()
+            batch = await self._next_batch(first)
+            failed = await self._deliver(batch)
+            if failed:
+                await self._park(failed)
+                await self._backoff()
+                continue
+            self._failures = 0
+            if self._spooled:
+                await self._replay()
+
+    async def _next_batch(self, first: dict) -> List[dict]:
+        batch = [first]
+        valves = self._get_valves()
+        batch_size = max(1, valves.report_batch_size)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max(0.0, valves.report_batch_window)
+        while len(batch) < batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _deliver(self, events: List[dict]) -> List[dict]:
+        try:
+            results = await self._send([e["payload"] for e in events])
+        except Exception as err:
+            results = [err] * len(events)
+        failed = []
+        for event, result in zip(events, results):
+            waiter = self._waiters.get(event["id"])
+            if isinstance(result, Exception):
+                if waiter is not None:
+                    if not waiter.done():
+                        waiter.set_exception(result)
+                    continue
+                event["attempts"] = event.get("attempts", 0) + 1
+                event["last_error"] = str(result)
+                failed.append(event)
+                continue
+            if self._on_delivered:
+                await self._on_delivered(event, result)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(result)
+        if failed:
+            logger.warning("usage_monitor: %d/%d usage events failed: %s", len(failed), len(events), failed[0]["last_error"])
+        return failed
+
+    async def _park(self, events: List[dict]) -> None:
+        max_attempts = self._get_valves().report_max_attempts
+        dead = [e for e in events if max_attempts > 0 and e["attempts"] >= max_attempts]
+        retry = [e for e in events if not (max_attempts > 0 and e["attempts"] >= max_attempts)]
+        if dead:
+            logger.error("usage_monitor: giving up on %d usage events, see %s.dead", len(dead), self.spool_path)
+            await asyncio.to_thread(self._append_lines, f"{self.spool_path}.dead", [json.dumps(e) for e in dead])
+        if retry:
+            await self._spool(retry)
+
+    async def _spool(self, events: List[dict]) -> None:
+        await asyncio.to_thread(self._append_lines, self.spool_path, [json.dumps(e) for e in events])
+        self._spooled = True
+
+    def _retry_delay(self) -> float:
+        valves = self._get_valves()
+        delay = min(valves.report_retry_max_delay, valves.report_retry_base_delay * 2 ** max(0, self._failures - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _backoff(self) -> None:
+        self._failures += 1
+        await asyncio.sleep(self._retry_delay())
+
+    async def _replay(self) -> None:
+        """Deliver spooled events; a leftover ``.replay`` file from a crashed run goes first."""
+        lock = await asyncio.to_thread(self._lock_replay)
+        if lock is None:
+            # Another worker is replaying the shared spool; look again after the retry delay.
+            self._spooled = True
+            return
+        try:
+            await self._replay_locked()
+        finally:
+            await asyncio.to_thread(self._unlock, lock)
+
+    async def _replay_locked(self) -> None:
+        self._spooled = False
+        replay_path = f"{self.spool_path}.replay"
+        for source in (None, self.spool_path):
+            if source is not None:
+                if not await asyncio.to_thread(self._rename, source, replay_path):
+                    continue
+            elif not await asyncio.to_thread(os.path.exists, replay_path):
+                continue
+            handle = await asyncio.to_thread(open, replay_path, "r", encoding="utf-8")
+            try:
+                while True:
+                    chunk = await asyncio.to_thread(self._read_events, handle, self._get_valves().report_batch_size)
+                    if not chunk:
+                        break
+                    failed = await self._deliver(chunk)
+                    if failed:
+                        rest = await asyncio.to_thread(handle.readlines)
+                        await self._park(failed)
+                        await asyncio.to_thread(self._append_lines, self.spool_path, [line.rstrip("\n") for line in rest])
+                        await asyncio.to_thread(handle.close)
+                        await asyncio.to_thread(os.remove, replay_path)
+                        self._spooled = True
+                        await self._backoff()
+                        return
+            finally:
+                if not handle.closed:
+                    await asyncio.to_thread(handle.close)
+            await asyncio.to_thread(os.remove, replay_path)
+            logger.info("usage_monitor: replayed spooled usage events from %s", source or replay_path)
+
+    def _read_events(self, handle, limit: int) -> List[dict]:
+        events = []
+        while len(events) < max(1, limit):
+            line = handle.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                logger.error("usage_monitor: skipping corrupt spool line: %.200s", line)
+                self._append_lines(f"{self.spool_path}.dead", [line])
+        return events
+
+    def _append_lines(self, path: str, lines: List[str]) -> None:
+        lines = [line for line in lines if line]
+        if not lines:
+            return
+        with self._file_lock:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            while True:
+                with open(path, "a", encoding="utf-8") as f:
+                    self._flock(f)
+                    # Renamed to .replay by another worker between open and lock: append to the new file.
+                    if not self._is_current(f, path):
+                        continue
+                    f.write("\n".join(lines) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                    return
+
+    def _rename(self, src: str, dst: str) -> bool:
+        with self._file_lock:
+            try:
+                f = open(src, "rb")
+            except FileNotFoundError:
+                return False
+            with f:
+                # Waits for appends in flight, so none lands in dst after it has been read.
+                self._flock(f)
+                if not self._is_current(f, src):
+                    return False
+                os.replace(src, dst)
+                return True
+
+    def _lock_replay(self) -> Optional[Any]:
+        """Exclusive, non-blocking hold on ``<spool>.lock``; None while another worker replays."""
+        path = f"{self.spool_path}.lock"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        handle = open(path, "a")
+        if not self._flock(handle, blocking=False):
+            handle.close()
+            return None
+        return handle
+
+    @staticmethod
+    def _unlock(handle) -> None:
+        # Closing the file releases the lock; the lock file itself stays for the next replay.
+        handle.close()
+
+    @staticmethod
+    def _flock(handle, blocking: bool = True) -> bool:
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    @staticmethod
+    def _is_current(handle, path: str) -> bool:
+        try:
+            return os.fstat(handle.fileno()).st_ino == os.stat(path).st_ino
+        except FileNotFoundError:
+            return False
+
+
 class Filter:
     class Valves(BaseModel):
-        api_endpoint: str = Field(default="", description="openwebui-monitor's base url")
+        api_endpoint: str = Field(
+            default="", description="openwebui-monitor's base url, or several replicas' base urls separated by commas"
+        )
         api_key: str = Field(default="", description="openwebui-monitor's api key")
         priority: int = Field(default=5, description="filter priority")
         language: str = Field(default="zh", description="language (en/zh)")
@@ -53,38 +1744,813 @@ class Filter:
         show_cost: bool = Field(default=True, description="show cost")
         show_balance: bool = Field(default=True, description="show balance")
         show_tokens: bool = Field(default=True, description="show tokens")
+        show_ttft: bool = Field(default=True, description="show time to first token (needs stream_timing)")
+        stream_timing: bool = Field(
+            default=True,
+            description="timestamp streamed chunks to report time to first token, decode speed and jitter instead of whole-turn T/s",
+        )
+        connect_timeout: float = Field(default=3.0, description="connect timeout to the monitor (seconds)")
+        request_timeout: float = Field(default=10.0, description="read/write timeout for monitor requests (seconds)")
+        max_connections: int = Field(default=100, description="max concurrent connections to the monitor")
+        max_keepalive_connections: int = Field(default=20, description="max idle keep-alive connections kept in the pool")
+        keepalive_expiry: float = Field(default=30.0, description="idle keep-alive connection expiry (seconds)")
+        http2: bool = Field(default=False, description="use HTTP/2 when available (requires the h2 package)")
+        request_compression: str = Field(
+            default="off",
+            description="compress large monitor request bodies: off, gzip or zstd (zstd needs Python 3.14 or the zstandard package here and Node.js 22.15+ on the monitor); needs an up-to-date monitor",
+        )
+        compression_min_bytes: int = Field(
+            default=16384, description="only compress request bodies at least this large (bytes)"
+        )
+        compact_payload: bool = Field(
+            default=False,
+            description="send only model, user and usage (version 2 protocol) instead of the whole conversation; needs an up-to-date monitor",
+        )
+        token_counter: str = Field(
+            default="off",
+            description="count tokens locally when the provider returns no usage (off/tiktoken/heuristic); needs compact_payload",
+        )
+        token_cache_size: int = Field(default=10000, description="per-message token counts kept in the LRU cache")
+        delta_upload: bool = Field(
+            default=False,
+            description="when messages must be sent, send only those the monitor has not seen for this chat; needs compact_payload and an up-to-date monitor",
+        )
+        balance_cache_ttl: float = Field(
+            default=30.0,
+            description="seconds a cached balance may gate inlet without asking the monitor (0 disables); only for models the cached price table shows without an inlet cost",
+        )
+        balance_cache_margin: float = Field(
+            default=0.1, description="only trust the cache while balance minus the last turn's cost stays above this"
+        )
+        reserve_estimates: bool = Field(
+            default=False,
+            description="estimate each request's cost from cached model prices before the call, hold it against the balance and reject requests the balance cannot cover",
+        )
+        reserve_output_tokens: int = Field(
+            default=256, description="output tokens assumed when estimating a request's cost"
+        )
+        reservation_ttl: float = Field(
+            default=600.0, description="seconds before a reservation whose outlet never arrived stops counting against the balance"
+        )
+        price_refresh_interval: float = Field(
+            default=300.0, description="seconds between background refreshes of the cached model price table"
+        )
+        local_cost: bool = Field(
+            default=True,
+            description="keep a copy of the monitor's price table to show costs without waiting on the monitor (async reporting) and send them for the monitor to check",
+        )
+        state_max_entries: int = Field(
+            default=10000, description="max entries kept in each per-turn/per-user state map (0 = unbounded)"
+        )
+        state_ttl: float = Field(
+            default=3600.0, description="seconds before per-turn/per-user state entries expire (0 = never)"
+        )
+        state_backend: str = Field(
+            default="memory",
+            description="where balance, dedupe and turn state live: memory (per worker), sqlite (shared by the workers of one host) or redis (shared across hosts, requires the redis package); shared backends bound entries by state_ttl only",
+        )
+        state_url: str = Field(
+            default="",
+            description=f"SQLite file or redis:// URL for state_backend (empty = {STATE_DB_PATH} or redis://localhost:6379/0)",
+        )
+        async_reporting: bool = Field(
+            default=False, description="report outlet usage from a background queue instead of blocking the reply"
+        )
+        report_spool_path: str = Field(
+            default="/app/backend/data/usage_monitor/outlet_spool.ndjson",
+            description="append-only spool for usage events the monitor has not accepted yet",
+        )
+        report_queue_size: int = Field(default=1000, description="in-memory usage events before spilling to the spool")
+        report_batch_size: int = Field(default=20, description="max usage events delivered per batch")
+        breaker_failure_threshold: int = Field(
+            default=5, description="consecutive monitor failures that open the circuit breaker (0 disables it)"
+        )
+        breaker_reset_timeout: float = Field(
+            default=30.0, description="seconds the circuit stays open before a single probe request is let through"
+        )
+        endpoint_selection: str = Field(
+            default="least_outstanding",
+            description="how to spread requests over several monitor replicas: least_outstanding or ewma (latency weighted)",
+        )
+        endpoint_retries: int = Field(
+            default=1,
+            description="retry a failed call on up to this many other replicas; outlets are retried safely because they carry an idempotency key (needs an up-to-date monitor)",
+        )
+        endpoint_eject_after: int = Field(
+            default=3, description="consecutive failures after which a replica is skipped for a while (0 disables ejection)"
+        )
+        endpoint_eject_seconds: float = Field(
+            default=30.0, description="seconds an ejected replica is skipped, doubled for each repeat ejection up to 8x"
+        )
+        outage_policy: str = Field(
+            default="fail_closed",
+            description="when the monitor is unreachable: fail_closed (reject chats), fail_open (allow unless the cached balance is exhausted, usage is not billed) or defer (allow and spool usage for later billing)",
+        )
+        report_batch_window: float = Field(
+            default=0.0, description="seconds to wait for more usage events before sending a batch (0 = send immediately)"
+        )
+        report_retry_base_delay: float = Field(default=1.0, description="first retry delay after a failed delivery (seconds)")
+        report_retry_max_delay: float = Field(default=60.0, description="upper bound for the retry backoff (seconds)")
+        report_max_attempts: int = Field(
+            default=0, description="move an event to <spool>.dead after this many failed deliveries (0 = never)"
+        )
+        metrics_enabled: bool = Field(default=True, description="record latency, size, cache and error metrics")
+        metrics_file: str = Field(
+            default="",
+            description="write Prometheus text metrics to this file, e.g. for node_exporter's textfile collector; {pid} is replaced by the worker's process id (empty disables)",
+        )
+        metrics_interval: float = Field(default=15.0, description="seconds between metrics file writes")
+        capture_path: str = Field(
+            default="",
+            description="append anonymized inlet/outlet call shapes (hashed ids, model, message sizes, usage presence, hook timings; no content) to this NDJSON file for scripts/replay_filters.py; {pid} is replaced by the worker's process id (empty disables)",
+        )
+        capture_sample_rate: float = Field(default=1.0, description="fraction of turns captured when capture_path is set (0-1)")
 
     def __init__(self):
         self.type = "filter"
         self.name = "OpenWebUI Monitor"
         self.valves = self.Valves()
-        self.outage_map: Dict[str, bool] = {}
+        # Per-user "balance exhausted" flags, per-turn start times and emitted message ids all
+        # live in bounded TTL maps so errored or skipped turns cannot leak memory. They are
+        # SharedMaps so inlet and outlet of one turn may run on different workers.
+        self.outage_map = SharedMap("outage")
         # Legacy field kept; switched to monotonic seconds.
         self.start_time: Optional[float] = None
-        # Per-turn timing keyed by message_id (fallback to per-user key).
-        self._turn_start: Dict[str, float] = {}
+        # Per-turn timing keyed by message_id (fallback to per-user key), in turn_start.now() seconds.
+        self._turn_start = SharedMap("turn_start")
+        # The same starts on this worker's monotonic clock, so stream() never reaches the backend.
+        self._stream_starts = TTLCache()
         # Prevent duplicate emission per visible assistant message
-        self._emitted_ids: Set[str] = set()
+        self._emitted_ids = SharedMap("emitted")
+        # Turns admitted without an inlet call, keyed like _turn_start; their outlet carries
+        # inlet_skipped so the monitor bills the inlet cost it never charged.
+        self._skipped_inlets = SharedMap("inlet_skipped")
+        # Streamed chunk timings keyed by message_id, filled by stream() and consumed by outlet.
+        # Updated on every chunk, so always worker-local.
+        self._stream_stats = TTLCache()
+        # "user:chat" -> (message count, fingerprint) last accepted by the monitor, for delta uploads.
+        self._chat_digests = SharedMap("chat_digest")
+        # Shared pooled client, rebuilt when its configuration or event loop changes.
+        self._client: Optional[AsyncClient] = None
+        self._client_key: Optional[Tuple] = None
+        # Local balance gate so most inlets skip the monitor round trip.
+        self._balance_cache = BalanceCache(SharedMap("balance"))
+        self._state_backend: Optional[StateBackend] = None
+        self._state_backend_key: Tuple[str, str] = ("memory", "")
+        # Model prices for pre-flight estimates, refreshed off the request path.
+        self._prices = PriceTable()
+        self._prices_task: Optional[asyncio.Task] = None
+        # Cleared when the monitor answers 404 for /api/v1/models/prices (older deployments).
+        self._prices_supported = True
+        self._estimate_counter: Optional[TokenCounter] = None
+        # Background outlet reporting, bound to the event loop that created it.
+        self._reporter: Optional[UsageReporter] = None
+        self._reporter_loop: Optional[int] = None
+        self._token_counter: Optional[TokenCounter] = None
+        self._breaker = CircuitBreaker()
+        self._endpoints = EndpointPool()
+        # Cleared when the monitor answers 404 for /api/v1/outlet/batch (older deployments).
+        self._batch_supported = True
+        # Encodings the monitor answered 415 for (e.g. zstd on an older Node.js); sent uncompressed from then on.
+        self._rejected_encodings: Set[str] = set()
+        self.metrics = Metrics("usage_monitor", METRIC_DEFINITIONS)
+        self._metrics_written_at = 0.0
+        self._metrics_task: Optional[asyncio.Task] = None
+        self._capture = TrafficCapture()
+
+    def _state_maps(self) -> Dict[str, Any]:
+        return {
+            "outage_map": self.outage_map,
+            "turn_start": self._turn_start,
+            "skipped_inlets": self._skipped_inlets,
+            "emitted_ids": self._emitted_ids,
+            "stream_stats": self._stream_stats,
+            "stream_starts": self._stream_starts,
+            "chat_digests": self._chat_digests,
+            "balance_cache": self._balance_cache,
+        }
+
+    def breaker_stats(self) -> Dict[str, Any]:
+        return self._breaker.stats()
+
+    def _sync_valves(self) -> None:
+        for state in self._state_maps().values():
+            state.configure(self.valves.state_max_entries, self.valves.state_ttl)
+        self.metrics.enabled = self.valves.metrics_enabled
+        key = (self.valves.state_backend, self.valves.state_url)
+        if key != self._state_backend_key:
+            self._state_backend_key = key
+            try:
+                self._state_backend = create_state_backend(*key)
+            except Exception as err:
+                logger.warning("usage_monitor: cannot use %s state backend (%s), keeping state per worker", key[0], err)
+                self._state_backend = None
+            for state in self._shared_maps():
+                state.backend = self._state_backend
+
+    def _shared_maps(self) -> List["SharedMap"]:
+        return [
+            self.outage_map,
+            self._turn_start,
+            self._skipped_inlets,
+            self._emitted_ids,
+            self._chat_digests,
+            self._balance_cache._entries,
+        ]
+
+    async def _offload(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run ``fn``, which touches shared state, in a thread when a state backend is configured."""
+        if self._state_backend is None:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    def state_stats(self) -> Dict[str, Dict[str, int]]:
+        """Current size plus eviction/expiration counters of each bounded state map."""
+        return {name: state.stats() for name, state in self._state_maps().items()}
+
+    def metrics_text(self) -> str:
+        """Prometheus text exposition of the recorded metrics plus current queue, state and breaker gauges."""
+        samples: List[Tuple[str, Dict[str, Any], float]] = []
+        if self._reporter is not None:
+            reporter_stats = self._reporter.stats()
+            samples.append(("report_queue_depth", {}, reporter_stats["queued"]))
+            samples.append(("report_spool_pending", {}, reporter_stats["spool_pending"]))
+            samples.append(("report_consecutive_failures", {}, reporter_stats["failures"]))
+        for name, stats in self.state_stats().items():
+            samples.append(("state_entries", {"map": name}, stats["size"]))
+            samples.append(("state_removed_total", {"map": name, "reason": "evicted"}, stats["evictions"]))
+            samples.append(("state_removed_total", {"map": name, "reason": "expired"}, stats["expirations"]))
+        for state in self._shared_maps():
+            samples.append(("state_backend_errors_total", {"map": state.namespace}, state.errors))
+        if self._token_counter is not None:
+            samples.append(("token_cache_total", {"result": "hit"}, self._token_counter.hits))
+            samples.append(("token_cache_total", {"result": "miss"}, self._token_counter.misses))
+        breaker = self.breaker_stats()
+        for state in ("closed", "half_open", "open"):
+            samples.append(("breaker_state", {"state": state}, int(breaker["state"] == state)))
+        samples.append(("breaker_opens_total", {}, breaker["opens"]))
+        for url, stats in self._endpoints.stats().items():
+            samples.append(("endpoint_healthy", {"endpoint": url}, int(stats["healthy"])))
+            samples.append(("endpoint_outstanding", {"endpoint": url}, stats["outstanding"]))
+            if stats["ewma_seconds"] is not None:
+                samples.append(("endpoint_latency_ewma_seconds", {"endpoint": url}, stats["ewma_seconds"]))
+            samples.append(("endpoint_ejections_total", {"endpoint": url}, stats["ejections"]))
+        samples.append(("breaker_rejections_total", {}, breaker["rejections"]))
+        if self.valves.capture_path:
+            samples.append(("capture_lines_total", {"result": "written"}, self._capture.written))
+            samples.append(("capture_lines_total", {"result": "dropped"}, self._capture.dropped))
+        return self.metrics.render(samples)
+
+    def _maybe_write_metrics(self) -> None:
+        path = self.valves.metrics_file
+        if not path or not self.valves.metrics_enabled:
+            return
+        now = time.monotonic()
+        if now - self._metrics_written_at < self.valves.metrics_interval:
+            return
+        if self._metrics_task is not None and not self._metrics_task.done():
+            return
+        self._metrics_written_at = now
+        self._metrics_task = asyncio.get_running_loop().create_task(
+            self._write_metrics(path.replace("{pid}", str(os.getpid())), self.metrics_text())
+        )
+
+    @staticmethod
+    async def _write_metrics(path: str, text: str) -> None:
+        try:
+            await asyncio.to_thread(write_text_atomic, path, text)
+        except OSError as err:
+            logger.warning("usage_monitor: failed to write metrics to %s: %s", path, err)
+
+    def _capture_call(
+        self,
+        hook: str,
+        body: Any,
+        metadata: Optional[dict],
+        user: Optional[dict],
+        seconds: float,
+        outcome: str,
+        chunks: Optional[int] = None,
+    ) -> None:
+        path = self.valves.capture_path
+        if not path or not isinstance(body, dict):
+            return
+        metadata = metadata or {}
+        if not capture_sampled(anonymize_id(metadata.get("message_id")), self.valves.capture_sample_rate):
+            return
+        try:
+            shape = call_shape(hook, body, metadata, user or {}, seconds, outcome, chunks)
+            self._capture.record(path.replace("{pid}", str(os.getpid())), shape)
+        except Exception as err:
+            # Capturing is diagnostics only; it must never fail a chat.
+            logger.debug("usage_monitor: traffic capture failed: %s", err)
 
     def get_text(self, key: str, **kwargs) -> str:
         lang = self.valves.language if self.valves.language in TRANSLATIONS else "en"
         text = TRANSLATIONS[lang].get(key, TRANSLATIONS["en"][key])
         return text.format(**kwargs) if kwargs else text
 
-    async def request(self, client: AsyncClient, url: str, headers: dict, json_data: dict):
-        json_data = json.loads(json.dumps(json_data, default=lambda o: o.dict() if hasattr(o, "dict") else str(o)))
+    def _http2_enabled(self) -> bool:
+        if not self.valves.http2:
+            return False
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("usage_monitor: http2 requested but h2 is not installed, using HTTP/1.1")
+            return False
+        return True
+
+    async def get_client(self) -> AsyncClient:
+        """Return the shared client, creating it lazily or rebuilding it when the valves change."""
+        key = (
+            self.valves.api_key,
+            self.valves.connect_timeout,
+            self.valves.request_timeout,
+            self.valves.max_connections,
+            self.valves.max_keepalive_connections,
+            self.valves.keepalive_expiry,
+            self.valves.http2,
+            id(asyncio.get_running_loop()),
+        )
+        if self._client is not None and not self._client.is_closed and self._client_key == key:
+            return self._client
+
+        old_client = self._client
+        self._client = AsyncClient(
+            headers={"Authorization": f"Bearer {self.valves.api_key}"},
+            timeout=Timeout(self.valves.request_timeout, connect=self.valves.connect_timeout),
+            limits=Limits(
+                max_connections=self.valves.max_connections,
+                max_keepalive_connections=self.valves.max_keepalive_connections,
+                keepalive_expiry=self.valves.keepalive_expiry,
+            ),
+            http2=self._http2_enabled(),
+        )
+        self._client_key = key
+        if old_client is not None and not old_client.is_closed:
+            try:
+                await old_client.aclose()
+            except Exception as err:
+                # The old client may belong to an event loop that is already gone.
+                logger.debug("usage_monitor: failed to close stale client: %s", err)
+        return self._client
+
+    async def close(self) -> None:
+        if self._reporter is not None:
+            await self._reporter.stop()
+            self._reporter = None
+        await self._capture.flush()
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        self._client_key = None
+
+    def _sync_endpoints(self) -> EndpointPool:
+        self._endpoints.configure(
+            self.valves.api_endpoint,
+            self.valves.endpoint_selection,
+            self.valves.endpoint_eject_after,
+            self.valves.endpoint_eject_seconds,
+        )
+        return self._endpoints
+
+    async def _send(self, endpoint: MonitorEndpoint, method: str, path: str, **kwargs: Any):
+        client = await self.get_client()
+        endpoint.outstanding += 1
+        started = time.perf_counter()
+        outage: Optional[bool] = None
+        try:
+            response = await client.request(method, f"{endpoint.url}{path}", **kwargs)
+            outage = response.status_code >= 500
+            return response
+        except Exception as err:
+            outage = is_outage_error(err)
+            raise
+        finally:
+            self._endpoints.finish(endpoint, time.perf_counter() - started, outage)
+
+    async def request(self, path: str, json_data: dict, idempotent: bool = False):
+        """
+        POST to a monitor replica. An outage error is retried on another replica when the
+        request never reached the first one, or when ``idempotent`` says a repeat is harmless.
+        """
+        self._breaker.configure(self.valves.breaker_failure_threshold, self.valves.breaker_reset_timeout)
+        if not self._breaker.allow():
+            self.metrics.inc("errors_total", path=path, type="circuit_open")
+            raise MonitorUnavailableError(f"monitor circuit open, skipped {path}")
+
+        started = time.perf_counter()
+        raw = dump_json(json_data)
+        content, encoding = self._compress(raw)
+        sent = time.perf_counter()
+        self.metrics.observe("serialize_seconds", sent - started, path=path)
+        self.metrics.observe("request_bytes", len(content), path=path)
+        self.metrics.inc("request_encoding_total", path=path, encoding=encoding)
 
-        response = await client.post(url=url, headers=headers, json=json_data)
-        response.raise_for_status()
+        endpoints = self._sync_endpoints()
+        tried: Tuple[str, ...] = ()
+        while True:
+            endpoint = endpoints.pick(exclude=tried)
+            if endpoint is None:
+                raise MonitorUnavailableError("no monitor endpoint configured")
+            tried += (endpoint.url,)
+            try:
+                response = await self._send(endpoint, "POST", path, content=content, headers=request_headers(encoding))
+                if response.status_code == 415 and encoding != "identity":
+                    logger.warning("usage_monitor: monitor does not accept %s request bodies, sending them uncompressed", encoding)
+                    self._rejected_encodings.add(encoding)
+                    content, encoding = raw, "identity"
+                    self.metrics.inc("request_encoding_total", path=path, encoding=encoding)
+                    response = await self._send(endpoint, "POST", path, content=content, headers=request_headers(encoding))
+                response.raise_for_status()
+                break
+            except Exception as err:
+                self.metrics.inc("errors_total", path=path, type=error_label(err))
+                if (
+                    is_outage_error(err)
+                    and (idempotent or isinstance(err, (ConnectError, ConnectTimeout)))
+                    and len(tried) <= self.valves.endpoint_retries
+                    and len(tried) < len(endpoints)
+                ):
+                    logger.warning("usage_monitor: %s failed on %s (%s), retrying on another replica", path, endpoint.url, err)
+                    self.metrics.inc("endpoint_retries_total", path=path)
+                    continue
+                if is_outage_error(err):
+                    self._breaker.record_failure()
+                else:
+                    self._breaker.record_success()
+                raise
+        self._breaker.record_success()
+        self.metrics.observe("request_seconds", time.perf_counter() - sent, path=path)
+        self.metrics.observe("response_bytes", len(response.content), path=path)
         response_data = response.json()
         if not response_data.get("success"):
+            self.metrics.inc("errors_total", path=path, type="rejected")
             logger.error(self.get_text("request_failed", error_msg=response_data))
             raise CustomException(self.get_text("request_failed", error_msg=response_data))
         return response_data
 
+    def _compress(self, raw: bytes) -> Tuple[bytes, str]:
+        encoding = self.valves.request_compression
+        if (
+            encoding not in REQUEST_COMPRESSIONS
+            or encoding in self._rejected_encodings
+            or len(raw) < self.valves.compression_min_bytes
+        ):
+            return raw, "identity"
+        compressed = compress_body(raw, encoding)
+        if compressed is None:
+            logger.warning("usage_monitor: %s compression is not available, sending request bodies uncompressed", encoding)
+            self._rejected_encodings.add(encoding)
+            return raw, "identity"
+        if len(compressed) >= len(raw):
+            return raw, "identity"
+        return compressed, encoding
+
+    def get_reporter(self) -> UsageReporter:
+        loop_id = id(asyncio.get_running_loop())
+        if self._reporter is None or self._reporter_loop != loop_id:
+            self._reporter = UsageReporter(self._send_outlet_events, lambda: self.valves, self._on_outlet_delivered)
+            self._reporter_loop = loop_id
+        self._reporter.ensure_started()
+        return self._reporter
+
+    async def _send_outlet_events(self, payloads: List[dict]) -> List[Union[dict, Exception]]:
+        self.metrics.observe("report_batch_size", len(payloads))
+        if self._batch_supported and len(payloads) > 1:
+            try:
+                response_data = await self.request(
+                    path="/api/v1/outlet/batch", json_data={"events": payloads}, idempotent=True
+                )
+                if len(response_data.get("results") or []) != len(payloads):
+                    raise CustomException(self.get_text("request_failed", error_msg=response_data))
+                return [
+                    result if result.get("success") else CustomException(self.get_text("request_failed", error_msg=result))
+                    for result in response_data.get("results") or []
+                ]
+            except HTTPStatusError as err:
+                if err.response.status_code != 404:
+                    raise
+                logger.warning("usage_monitor: monitor has no batch endpoint, sending usage events one by one")
+                self._batch_supported = False
+
+        results: List[Union[dict, Exception]] = []
+        for index, payload in enumerate(payloads):
+            try:
+                results.append(await self.request(path="/api/v1/outlet", json_data=payload, idempotent=True))
+            except CustomException as err:
+                results.append(err)
+            except Exception as err:
+                # Transport-level failure: the rest of the batch would fail the same way.
+                results.extend([err] * (len(payloads) - index))
+                break
+        return results
+
+    async def _on_outlet_delivered(self, event: dict, response_data: dict) -> None:
+        self._check_cost(response_data)
+        if "newBalance" in response_data:
+            await self._offload(
+                self._balance_cache.seed,
+                event["payload"]["user"].get("id", "default"),
+                response_data["newBalance"],
+                response_data.get("totalCost"),
+            )
+
+    def _pop_elapsed(self, __metadata__: dict, user_id: str) -> Optional[float]:
+        # Prefer per-turn timing keyed by message_id; then per-user; then legacy start_time.
+        start = None
+        msg_id = __metadata__.get("message_id")
+        if msg_id is not None:
+            start = self._turn_start.pop(str(msg_id), None)
+        if start is None:
+            start = self._turn_start.pop(f"user:{user_id}", None)
+        if start is not None:
+            return max(0.0, self._turn_start.now() - start)
+        if self.start_time is None:
+            return None
+        return max(0.0, time.monotonic() - self.start_time)
+
+    def _time_stats(self, elapsed: Optional[float], output_tokens: int, timing: Optional[dict] = None) -> List[str]:
+        self.metrics.observe("turn_seconds", elapsed)
+        if elapsed and output_tokens:
+            self.metrics.observe("turn_tokens_per_second", output_tokens / elapsed)
+        ttft = timing["ttft_ms"] / 1000 if timing and timing["ttft_ms"] is not None else None
+        decode_rate = decode_tokens_per_sec(timing, output_tokens)
+        self.metrics.observe("ttft_seconds", ttft)
+        self.metrics.observe("decode_tokens_per_second", decode_rate)
+
+        stats_list = []
+        if ttft is not None and self.valves.show_ttft:
+            stats_list.append(self.get_text("ttft", ttft=ttft))
+        if elapsed is not None and self.valves.show_time_spent:
+            stats_list.append(self.get_text("time_spent", time=elapsed))
+            if self.valves.show_tokens_per_sec:
+                if decode_rate is not None:
+                    tokens_per_sec = decode_rate
+                else:
+                    tokens_per_sec = (output_tokens / elapsed) if elapsed > 0 else 0
+                stats_list.append(self.get_text("tokens_per_sec", tokens_per_sec=tokens_per_sec))
+        return stats_list
+
+    def get_token_counter(self) -> Optional[TokenCounter]:
+        backend = self.valves.token_counter
+        if backend not in ("tiktoken", "heuristic"):
+            return None
+        counter = self._token_counter
+        if (
+            counter is None
+            or counter.requested_backend != backend
+            or counter.cache_size != max(0, self.valves.token_cache_size)
+        ):
+            counter = self._token_counter = TokenCounter(backend, self.valves.token_cache_size)
+        return counter
+
+    def _usage_payload(
+        self, __user__: dict, body: dict, with_messages: bool = True, timing: Optional[dict] = None
+    ) -> dict:
+        if self.valves.compact_payload:
+            payload = compact_usage_payload(__user__, body, with_messages, self.get_token_counter())
+        else:
+            payload = {"user": __user__, "body": body}
+        if timing:
+            payload["timing"] = timing
+        if with_messages:
+            self._attach_cost(payload)
+        return payload
+
+    def _build_outlet_event(
+        self, msg_key: str, __user__: dict, body: dict, timing: Optional[dict] = None, inlet_skipped: bool = False
+    ) -> dict:
+        if self.valves.compact_payload:
+            payload = compact_usage_payload(__user__, body, token_counter=self.get_token_counter())
+        else:
+            payload = {"user": compact_user(__user__), "body": {"model": body.get("model"), "messages": body.get("messages") or []}}
+        if timing:
+            payload["timing"] = timing
+        self._attach_cost(payload)
+        # The monitor bills each key once, so retries and replays are safe.
+        payload["idempotency_key"] = msg_key
+        if inlet_skipped:
+            payload["inlet_skipped"] = True
+        return {"id": msg_key, "created_at": time.time(), "attempts": 0, "payload": to_jsonable(payload)}
+
+    async def _request_outlet(
+        self,
+        msg_key: str,
+        __user__: dict,
+        body: dict,
+        chat_id: Optional[str],
+        timing: Optional[dict],
+        inlet_skipped: bool = False,
+    ) -> dict:
+        payload = self._usage_payload(__user__, body, timing=timing)
+        payload["idempotency_key"] = msg_key
+        if inlet_skipped:
+            payload["inlet_skipped"] = True
+        if not (self.valves.delta_upload and self.valves.compact_payload and chat_id and payload.get("messages")):
+            return await self.request(path="/api/v1/outlet", json_data=payload, idempotent=True)
+
+        messages = payload.pop("messages")
+        fingerprints = message_fingerprints(messages)
+        chat_key = f"{__user__.get('id', 'default')}:{chat_id}"
+        prefix_count = 0
+        reported = await self._offload(self._chat_digests.get, chat_key)
+        if reported is not None:
+            count, fingerprint = reported
+            # At least the reply must be new, and edited history falls back to a full upload.
+            if 0 < count < len(messages) and fingerprints[count - 1] == fingerprint:
+                prefix_count = count
+        payload["delta"] = delta_section(chat_id, messages, fingerprints, prefix_count)
+        try:
+            response_data = await self.request(path="/api/v1/outlet", json_data=payload, idempotent=True)
+        except HTTPStatusError as err:
+            if prefix_count == 0 or err.response.status_code != 409:
+                raise
+            # The monitor has no totals matching this prefix (edited history, a lost write): send everything once.
+            payload["delta"] = delta_section(chat_id, messages, fingerprints, 0)
+            response_data = await self.request(path="/api/v1/outlet", json_data=payload, idempotent=True)
+        await self._offload(self._chat_digests.set, chat_key, (len(messages), fingerprints[-1]))
+        return response_data
+
+    async def _pop_stream_timing(self, msg_key: str) -> Optional[dict]:
+        self._stream_starts.pop(msg_key)
+        stats = self._stream_stats.pop(msg_key)
+        if stats is None:
+            return None
+        if stats.ttft is None:
+            # The inlet ran on another worker: place its shared start on this worker's clock.
+            start = await self._offload(self._turn_start.get, msg_key)
+            if start is not None:
+                since_first = time.monotonic() - stats.first
+                stats.ttft = max(0.0, self._turn_start.now() - start - since_first)
+        return stats.summary()
+
+    async def _report_async(
+        self,
+        msg_key: str,
+        user_id: str,
+        __user__: dict,
+        __metadata__: dict,
+        body: dict,
+        last_msg: dict,
+        __event_emitter__,
+        timing: Optional[dict] = None,
+        inlet_skipped: bool = False,
+    ) -> dict:
+        event = self._build_outlet_event(msg_key, __user__, body, timing, inlet_skipped)
+        await self.get_reporter().submit(event)
+        usage = last_msg.get("usage") or {}
+        output_tokens = usage.get("completion_tokens") or 0
+        stats_list = []
+        if self.valves.show_tokens and usage.get("prompt_tokens") and output_tokens:
+            stats_list.append(self.get_text("tokens", input=usage["prompt_tokens"], output=output_tokens))
+        if self.valves.show_cost and "cost" in event["payload"]:
+            stats_list.append(self.get_text("cost", cost=event["payload"]["cost"]["total"]))
+        elapsed = await self._offload(self._pop_elapsed, __metadata__, user_id)
+        stats_list.extend(self._time_stats(elapsed, output_tokens, timing))
+        stats_list.append(self.get_text("billing_pending"))
+        stats = " | ".join(stats_list)
+        if __event_emitter__:
+            await __event_emitter__({"type": "status", "data": {"description": stats, "done": True}})
+        logger.info("usage_monitor: %s %s", user_id, stats)
+        return body
+
+    def _refresh_prices_soon(self) -> None:
+        if not self._prices_supported or not self._prices.due(self.valves.price_refresh_interval):
+            return
+        if self._prices_task is not None and not self._prices_task.done():
+            return
+        self._prices.attempted_at = time.monotonic()
+        self._prices_task = asyncio.get_running_loop().create_task(self._fetch_prices())
+
+    async def _fetch_prices(self) -> None:
+        path = "/api/v1/models/prices"
+        headers = {"If-None-Match": self._prices.etag} if self._prices.etag else {}
+        try:
+            endpoint = self._sync_endpoints().pick()
+            if endpoint is None:
+                return
+            response = await self._send(endpoint, "GET", path, headers=headers)
+            if response.status_code == 304:
+                self._prices.fetched_at = time.monotonic()
+                return
+            response.raise_for_status()
+            self._prices.load(response.json(), response.headers.get("ETag"))
+        except Exception as err:
+            self.metrics.inc("errors_total", path=path, type=error_label(err))
+            if isinstance(err, HTTPStatusError) and err.response.status_code == 404:
+                logger.warning("usage_monitor: monitor has no price table endpoint, costs are computed by the monitor only")
+                self._prices_supported = False
+                return
+            logger.warning("usage_monitor: failed to refresh model prices: %s", err)
+
+    def _attach_cost(self, payload: dict) -> Optional[float]:
+        """Add the locally computed cost to an outlet payload for the monitor to check."""
+        if not self.valves.local_cost:
+            return None
+        tokens = payload_tokens(payload)
+        model_id = payload.get("model") or (payload.get("body") or {}).get("model")
+        cost = self._prices.cost(model_id, *tokens) if tokens else None
+        if cost is not None:
+            payload["cost"] = {"total": cost, "prices": self._prices.version}
+        return cost
+
+    def _check_cost(self, response_data: dict) -> None:
+        if "costVerified" in response_data:
+            self.metrics.inc("local_cost_checks_total", result="match" if response_data["costVerified"] else "mismatch")
+
+    def _estimate_cost(self, body: dict) -> Optional[float]:
+        """Fast pre-flight cost of the request: prompt tokens plus reserve_output_tokens at cached prices."""
+        counter = self.get_token_counter()
+        if counter is None:
+            if self._estimate_counter is None or self._estimate_counter.cache_size != max(0, self.valves.token_cache_size):
+                self._estimate_counter = TokenCounter("heuristic", self.valves.token_cache_size)
+            counter = self._estimate_counter
+        messages = body.get("messages") or []
+        input_tokens = sum(counter.count(message_text(m.get("content"))) for m in messages if isinstance(m, dict))
+        return self._prices.estimate(body.get("model"), input_tokens, max(0, self.valves.reserve_output_tokens))
+
+    def _reserve(self, user_id: str, turn_key: str, estimate: Optional[float], floor: float = 0.0) -> bool:
+        """Hold the estimate against the cached balance; True when covered (or nothing to hold)."""
+        if estimate is None or self._balance_cache.peek(user_id) is None:
+            self.metrics.inc("reservations_total", result="skipped")
+            return True
+        left = self._balance_cache.reserve(user_id, turn_key, estimate, self.valves.reservation_ttl, floor)
+        self.metrics.inc("reservations_total", result="held" if left is not None else "rejected")
+        return left is not None
+
+    def _insufficient_for_estimate(self, user_id: str, estimate: float) -> CustomException:
+        entry = self._balance_cache.peek(user_id)
+        available = self._balance_cache.available(entry) if entry is not None else 0.0
+        message = self.get_text("insufficient_for_estimate", cost=estimate, balance=available)
+        logger.info(message)
+        return CustomException(message)
+
+    def _try_cached_inlet(
+        self, user_id: str, model_id: Optional[str], turn_key: str, estimate: Optional[float] = None
+    ) -> bool:
+        """Gate the turn from the local balance cache; False means the monitor must be asked."""
+        # Only a model the price table shows without an inlet cost may skip the call: the
+        # monitor would otherwise charge nothing on inlet yet still deduct it at outlet.
+        if self._prices.inlet_cost(model_id) != 0:
+            return False
+        entry = self._balance_cache.get(user_id, self.valves.balance_cache_ttl)
+        if entry is None:
+            return False
+        if estimate is not None:
+            # The reservation is the check: it fails once in-flight turns have used up the margin.
+            if self._balance_cache.reserve(
+                user_id, turn_key, estimate, self.valves.reservation_ttl, self.valves.balance_cache_margin
+            ) is None:
+                return False
+            self.metrics.inc("reservations_total", result="held")
+            self.outage_map.set(user_id, False)
+            return True
+        # Check and debit in one step, so concurrent turns on other workers cannot both pass the margin.
+        if self._balance_cache.debit(user_id, entry["last_cost"], floor=self.valves.balance_cache_margin) is None:
+            return False
+        self.outage_map.set(user_id, False)
+        return True
+
+    def _settle(self, user_id: str, turn_key: str, debit: bool = False) -> None:
+        if self.valves.reserve_estimates:
+            self._balance_cache.release(user_id, turn_key, debit)
+
+    def stream(self, event: dict, __metadata__: Optional[dict] = None) -> dict:
+        """Timestamp content chunks per message; synchronous so Open WebUI calls it without awaiting."""
+        if not self.valves.stream_timing:
+            return event
+        msg_id = (__metadata__ or {}).get("message_id")
+        if msg_id is None or not isinstance(event, dict) or not chunk_has_content(event):
+            return event
+        now = time.monotonic()
+        key = str(msg_id)
+        stats = self._stream_stats.get(key)
+        if stats is None:
+            # Only worker-local state here; outlet fills in TTFT when the inlet ran elsewhere.
+            self._stream_stats.set(key, StreamTiming(now, self._stream_starts.get(key)))
+        else:
+            stats.add(now)
+        return event
+
     async def inlet(self, body: dict, __metadata__: Optional[dict] = None, __user__: Optional[dict] = None) -> dict:
+        started = time.perf_counter()
+        outcome = "error"
+        request = body
+        try:
+            body = await self._inlet(body, __metadata__, __user__)
+            outcome = "ok"
+            return body
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.observe("hook_seconds", elapsed, hook="inlet", outcome=outcome)
+            self._maybe_write_metrics()
+            self._capture_call("inlet", request, __metadata__, __user__, elapsed, outcome)
+
+    async def _inlet(self, body: dict, __metadata__: Optional[dict], __user__: Optional[dict]) -> dict:
         __user__ = __user__ or {}
         __metadata__ = __metadata__ or {}
+        self._sync_valves()
         # Start a monotonic timer to avoid wall-clock jumps.
         self.start_time = time.monotonic()
         user_id = __user__.get("id", "default")
@@ -92,33 +2558,81 @@ class Filter:
         msg_id = (__metadata__ or {}).get("message_id")
         if msg_id is not None:
             key = str(msg_id)
+            self._stream_starts.set(key, time.monotonic())
         else:
             key = f"user:{user_id}"
-        self._turn_start[key] = self.start_time
+        await self._offload(self._turn_start.set, key, self._turn_start.now())
+
+        if self.valves.async_reporting:
+            # Starts the worker early so a spool left by a previous run is replayed promptly.
+            self.get_reporter()
+        if self.valves.local_cost or self.valves.reserve_estimates or self.valves.balance_cache_ttl > 0:
+            self._refresh_prices_soon()
 
-        client = AsyncClient()
+        estimate = None
+        task = (body or {}).get("task") or __metadata__.get("task")
+        if self.valves.reserve_estimates and task not in INTERNAL_TASKS:
+            estimate = self._estimate_cost(body or {})
+
+        if await self._offload(self._try_cached_inlet, user_id, (body or {}).get("model"), key, estimate):
+            self.metrics.inc("inlet_cache_total", result="hit")
+            await self._offload(self._mark_inlet_skipped, key, task)
+            return body
+        self.metrics.inc("inlet_cache_total", result="miss")
 
         try:
             response_data = await self.request(
-                client=client,
-                url=f"{self.valves.api_endpoint}/api/v1/inlet",
-                headers={"Authorization": f"Bearer {self.valves.api_key}"},
-                json_data={"user": __user__, "body": body},
+                path="/api/v1/inlet",
+                json_data=self._usage_payload(__user__, body or {}, with_messages=False),
+                # An inlet charges the model's inlet cost, so only retry it for models priced free.
+                idempotent=self._prices.inlet_cost((body or {}).get("model")) == 0,
             )
-            self.outage_map[user_id] = response_data.get("balance", 0) <= 0
-            if self.outage_map[user_id]:
+            if "balance" in response_data:
+                await self._offload(self._balance_cache.seed, user_id, response_data["balance"])
+            exhausted = response_data.get("balance", 0) <= 0
+            await self._offload(self.outage_map.set, user_id, exhausted)
+            if exhausted:
                 logger.info(self.get_text("insufficient_balance", balance=response_data.get("balance", 0)))
                 raise CustomException(self.get_text("insufficient_balance", balance=response_data.get("balance", 0)))
+            if not await self._offload(self._reserve, user_id, key, estimate):
+                raise await self._offload(self._insufficient_for_estimate, user_id, estimate)
             return body
 
         except Exception as err:
-            logger.exception(self.get_text("request_failed", error_msg=err))
             if isinstance(err, CustomException):
+                logger.exception(self.get_text("request_failed", error_msg=err))
                 raise err
+            if is_outage_error(err) and self.valves.outage_policy in ("fail_open", "defer"):
+                return await self._offload(self._degraded_inlet, user_id, body, err, key, estimate, task)
+            logger.exception(self.get_text("request_failed", error_msg=err))
             raise Exception(f"error calculating usage, {err}") from err
 
-        finally:
-            await client.aclose()
+    def _mark_inlet_skipped(self, turn_key: str, task: Optional[str]) -> None:
+        # Internal tasks never reach the billing outlet, so there is nothing to flag.
+        if task not in INTERNAL_TASKS:
+            self._skipped_inlets.set(turn_key, True)
+
+    def _degraded_inlet(
+        self,
+        user_id: str,
+        body: dict,
+        err: Exception,
+        turn_key: str,
+        estimate: Optional[float] = None,
+        task: Optional[str] = None,
+    ) -> dict:
+        """Admit the turn while the monitor is down, unless the last known balance is exhausted."""
+        entry = self._balance_cache.peek(user_id)
+        if entry is not None and entry["balance"] <= 0:
+            self.outage_map.set(user_id, True)
+            raise CustomException(self.get_text("insufficient_balance", balance=entry["balance"]))
+        if not self._reserve(user_id, turn_key, estimate):
+            raise self._insufficient_for_estimate(user_id, estimate)
+        logger.warning("usage_monitor: monitor unavailable (%s), admitting %s under %s policy", err, user_id, self.valves.outage_policy)
+        self.outage_map.set(user_id, False)
+        # The inlet cost was never charged; the outlet, or its deferred replay, bills it.
+        self._mark_inlet_skipped(turn_key, task)
+        return body
 
     async def outlet(
         self,
@@ -126,15 +2640,37 @@ class Filter:
         __metadata__: Optional[dict] = None,
         __user__: Optional[dict] = None,
         __event_emitter__: Optional[callable] = None,
+    ) -> dict:
+        started = time.perf_counter()
+        outcome = "error"
+        request = body
+        chunks = None
+        if self.valves.capture_path and (__metadata__ or {}).get("message_id") is not None:
+            # Read before _outlet pops the stream timing, so replays can re-stream as many chunks.
+            stream_timing = self._stream_stats.get(str(__metadata__["message_id"]))
+            chunks = stream_timing.chunks if stream_timing is not None else None
+        try:
+            body = await self._outlet(body, __metadata__, __user__, __event_emitter__)
+            outcome = "ok"
+            return body
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.observe("hook_seconds", elapsed, hook="outlet", outcome=outcome)
+            self._maybe_write_metrics()
+            self._capture_call("outlet", request, __metadata__, __user__, elapsed, outcome, chunks)
+
+    async def _outlet(
+        self, body: dict, __metadata__: Optional[dict], __user__: Optional[dict], __event_emitter__: Optional[callable]
     ) -> dict:
         __user__ = __user__ or {}
         __metadata__ = __metadata__ or {}
         user_id = __user__.get("id", "default")
+        self._sync_valves()
         # Open-WebUI specific gating to stop double-fire without suppressing output:
         # 1) Skip internal tasks that also call outlet (these are not visible messages).
-        internal_tasks = {"follow_up_generation", "title_generation", "tags_generation"}
         task = (body or {}).get("task") or (__metadata__ or {}).get("task")
-        if task in internal_tasks:
+        if task in INTERNAL_TASKS:
+            self.metrics.inc("outlet_total", result="skipped")
             return body
         # 2) Only emit for visible assistant messages (top chip attaches to these).
         last_msg = None
@@ -142,25 +2678,50 @@ class Filter:
             msgs = body.get("messages") or []
             last_msg = msgs[-1] if msgs else None
         if not isinstance(last_msg, dict) or last_msg.get("role") != "assistant":
+            self.metrics.inc("outlet_total", result="skipped")
             return body
         # 3) De-duplicate strictly by Open-WebUI message_id (stable per turn).
         msg_key = str((__metadata__ or {}).get("message_id") or time.time_ns())
-        if msg_key in self._emitted_ids:
+        # Mark as emitted before any monitor call, atomically so only one worker wins a duplicate outlet.
+        if not await self._offload(self._emitted_ids.add, msg_key, True):
+            self.metrics.inc("outlet_total", result="duplicate")
             return body
-        # Mark as emitted before any await to avoid races.
-        self._emitted_ids.add(msg_key)
-        if self.outage_map.get(user_id, False):
+        turn_key = str(__metadata__["message_id"]) if __metadata__.get("message_id") is not None else f"user:{user_id}"
+        inlet_skipped = bool(await self._offload(self._skipped_inlets.pop, turn_key, False))
+        if await self._offload(self.outage_map.get, user_id, False):
+            await self._offload(self._settle, user_id, turn_key)
+            self.metrics.inc("outlet_total", result="skipped")
             return body
+        timing = await self._pop_stream_timing(msg_key)
 
-        client = AsyncClient()
+        if self.valves.async_reporting:
+            self.metrics.inc("outlet_total", result="queued")
+            # Keep the estimate spent until the queued event is billed and seeds the real balance.
+            await self._offload(self._settle, user_id, turn_key, True)
+            try:
+                return await self._report_async(
+                    msg_key, user_id, __user__, __metadata__, body, last_msg, __event_emitter__, timing, inlet_skipped
+                )
+            except Exception as err:
+                logger.exception(self.get_text("request_failed", error_msg=err))
+                raise Exception(self.get_text("request_failed", error_msg=err))
 
         try:
-            response_data = await self.request(
-                client=client,
-                url=f"{self.valves.api_endpoint}/api/v1/outlet",
-                headers={"Authorization": f"Bearer {self.valves.api_key}"},
-                json_data={"user": __user__, "body": body},
-            )
+            if self.valves.report_batch_window > 0:
+                # Coalesce with concurrent turns but still wait for this event's own result.
+                response_data = await self.get_reporter().submit(
+                    self._build_outlet_event(msg_key, __user__, body, timing, inlet_skipped), wait=True
+                )
+            else:
+                chat_id = (body or {}).get("chat_id") or __metadata__.get("chat_id")
+                response_data = await self._request_outlet(msg_key, __user__, body, chat_id, timing, inlet_skipped)
+                # Batched events are checked by _on_outlet_delivered.
+                self._check_cost(response_data)
+            if "newBalance" in response_data:
+                await self._offload(
+                    self._balance_cache.seed, user_id, response_data["newBalance"], response_data.get("totalCost")
+                )
+            await self._offload(self._settle, user_id, turn_key)
             stats_list = []
             if self.valves.show_tokens:
                 stats_list.append(self.get_text("tokens", input=response_data["inputTokens"], output=response_data["outputTokens"]))
@@ -168,32 +2729,32 @@ class Filter:
                 stats_list.append(self.get_text("cost", cost=response_data["totalCost"]))
             if self.valves.show_balance:
                 stats_list.append(self.get_text("balance", balance=response_data["newBalance"]))
-            if self.start_time and self.valves.show_time_spent:
-                # Prefer per-turn timing keyed by message_id; then per-user; then legacy start_time.
-                start = None
-                msg_id = (__metadata__ or {}).get("message_id")
-                if msg_id is not None:
-                    start = self._turn_start.pop(str(msg_id), None)
-                if start is None:
-                    start = self._turn_start.pop(f"user:{user_id}", None)
-                if start is None:
-                    start = self.start_time
-
-                if start is not None:
-                    elapsed = max(0.0, time.monotonic() - start)
-                    stats_list.append(self.get_text("time_spent", time=elapsed))
-                    if self.valves.show_tokens_per_sec:
-                        out_tokens = response_data.get("outputTokens", 0) or 0
-                        tokens_per_sec = (out_tokens / elapsed) if elapsed > 0 else 0
-                        stats_list.append(self.get_text("tokens_per_sec", tokens_per_sec=tokens_per_sec))
+            elapsed = await self._offload(self._pop_elapsed, __metadata__, user_id)
+            stats_list.extend(self._time_stats(elapsed, response_data.get("outputTokens", 0) or 0, timing))
 
             stats = " | ".join(stats_list)
             if __event_emitter__:
                 await __event_emitter__({"type": "status", "data": {"description": stats, "done": True}})
             logger.info("usage_monitor: %s %s", user_id, stats)
+            self.metrics.inc("outlet_total", result="billed")
             return body
         except Exception as err:
+            if is_outage_error(err) and self.valves.outage_policy == "defer":
+                logger.warning("usage_monitor: monitor unavailable (%s), deferring billing of %s", err, msg_key)
+                self.metrics.inc("outlet_total", result="deferred")
+                await self._offload(self._settle, user_id, turn_key, True)
+                return await self._report_async(
+                    msg_key, user_id, __user__, __metadata__, body, last_msg, __event_emitter__, timing, inlet_skipped
+                )
+            if is_outage_error(err) and self.valves.outage_policy == "fail_open":
+                logger.warning("usage_monitor: monitor unavailable (%s), %s not billed", err, msg_key)
+                self.metrics.inc("outlet_total", result="unbilled")
+                await self._offload(self._settle, user_id, turn_key)
+                if __event_emitter__:
+                    await __event_emitter__(
+                        {"type": "status", "data": {"description": self.get_text("billing_unavailable"), "done": True}}
+                    )
+                return body
+            await self._offload(self._settle, user_id, turn_key)
             logger.exception(self.get_text("request_failed", error_msg=err))
             raise Exception(self.get_text("request_failed", error_msg=err))
-        finally:
-            await client.aclose()
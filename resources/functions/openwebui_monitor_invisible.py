@@ -1,77 +1,1515 @@
 from typing import Optional, Callable, Any, Awaitable
 from pydantic import Field, BaseModel
-import requests
+import asyncio
+import bisect
+import csv
+import datetime
+import gzip
+import hashlib
+import httpx
+import io
 import time
-from open_webui.utils.misc import get_last_assistant_message
 import json
 import os
+import random
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# 旧版按消息写入的 JSON 记录目录，仅用于一次性迁移
+RECORD_DIRECTORY = "/app/backend/data/record"
+RECORD_DB_PATH = "/app/backend/data/usage_records.db"
+# 增量上传时记住的对话数上限
+CHAT_DIGEST_LIMIT = 10000
+
+RECORD_COLUMNS = (
+    "message_id",
+    "user_id",
+    "chat_id",
+    "model",
+    "created_at",
+    "input_tokens",
+    "output_tokens",
+    "total_cost",
+    "new_balance",
+    "elapsed_time",
+    "tokens_per_sec",
+)
+
+# 汇总表中累加的字段
+ROLLUP_COLUMNS = ("input_tokens", "output_tokens", "total_cost", "elapsed_time")
+
+
+def local_day(timestamp: float) -> str:
+    """时间戳所在的日期（服务器本地时区），与 user_daily_usage 的 day 一致"""
+    return time.strftime("%Y-%m-%d", time.localtime(timestamp))
+
+
+def day_start(day: str) -> float:
+    return datetime.datetime.strptime(day, "%Y-%m-%d").timestamp()
+
+
+def days_ago(days: int) -> str:
+    return (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+
+
+def encode_segment(records) -> bytes:
+    """把一天的记录编码为 gzip 压缩的 NDJSON"""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as segment:
+        for record in records:
+            segment.write(
+                json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            )
+            segment.write(b"\n")
+    return buffer.getvalue()
+
+
+def iter_segment(data) -> Any:
+    """逐行解压分段，不一次性展开整天的数据"""
+    with gzip.GzipFile(fileobj=data if hasattr(data, "read") else io.BytesIO(data)) as segment:
+        for line in segment:
+            if line.strip():
+                yield json.loads(line)
+
+
+class RecordStore:
+    """
+    基于 SQLite（WAL 模式）的计费记录存储，替代每条消息一个 JSON 文件。
+
+    并发写入会合并到同一个事务中提交（group commit）；按 message_id 主键查询，
+    并在 user_id、chat_id 和 created_at 上建立二级索引。
+    每次写入同时增量更新按对话（chat_usage）和按用户每日（user_daily_usage）的汇总，
+    计费按钮读取汇总只需一次主键查询，与对话长度无关。
+    增量上传时监控端已接受的对话前缀（chat_digests）也存在这里，供各 worker 共用。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._pending = []
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS usage_records (
+                    message_id TEXT PRIMARY KEY,
+                    user_id TEXT,
+                    chat_id TEXT,
+                    model TEXT,
+                    created_at REAL NOT NULL,
+                    input_tokens INTEGER,
+                    output_tokens INTEGER,
+                    total_cost REAL,
+                    new_balance REAL,
+                    elapsed_time REAL,
+                    tokens_per_sec REAL
+                );
+                CREATE INDEX IF NOT EXISTS usage_records_user_idx
+                    ON usage_records (user_id, created_at);
+                CREATE INDEX IF NOT EXISTS usage_records_chat_idx
+                    ON usage_records (chat_id, created_at);
+                CREATE INDEX IF NOT EXISTS usage_records_created_idx
+                    ON usage_records (created_at);
+                CREATE TABLE IF NOT EXISTS chat_usage (
+                    chat_id TEXT PRIMARY KEY,
+                    user_id TEXT,
+                    messages INTEGER NOT NULL DEFAULT 0,
+                    input_tokens INTEGER NOT NULL DEFAULT 0,
+                    output_tokens INTEGER NOT NULL DEFAULT 0,
+                    total_cost REAL NOT NULL DEFAULT 0,
+                    elapsed_time REAL NOT NULL DEFAULT 0,
+                    updated_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS user_daily_usage (
+                    user_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    messages INTEGER NOT NULL DEFAULT 0,
+                    input_tokens INTEGER NOT NULL DEFAULT 0,
+                    output_tokens INTEGER NOT NULL DEFAULT 0,
+                    total_cost REAL NOT NULL DEFAULT 0,
+                    elapsed_time REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, day)
+                );
+                CREATE TABLE IF NOT EXISTS store_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS usage_segments (
+                    day TEXT PRIMARY KEY,
+                    records INTEGER NOT NULL,
+                    data BLOB NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS chat_digests (
+                    chat_key TEXT PRIMARY KEY,
+                    messages INTEGER NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS chat_digests_updated_idx
+                    ON chat_digests (updated_at);
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    def _insert(self, records: list) -> None:
+        placeholders = ", ".join("?" for _ in RECORD_COLUMNS)
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for record in records:
+                    old = conn.execute(
+                        f"SELECT {', '.join(RECORD_COLUMNS)} FROM usage_records WHERE message_id = ?",
+                        (record["message_id"],),
+                    ).fetchone()
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO usage_records ({', '.join(RECORD_COLUMNS)}) "
+                        f"VALUES ({placeholders})",
+                        tuple(record.get(c) for c in RECORD_COLUMNS),
+                    )
+                    # 同一消息重复写入时先扣除旧值，保证汇总不重复计算
+                    if old is not None:
+                        self._apply_rollup(conn, dict(zip(RECORD_COLUMNS, old)), -1)
+                    self._apply_rollup(conn, record, 1)
+
+    @staticmethod
+    def _apply_rollup(conn: sqlite3.Connection, record: dict, sign: int) -> None:
+        values = [sign * (record.get(c) or 0) for c in ROLLUP_COLUMNS]
+        increments = ", ".join(f"{c} = {c} + excluded.{c}" for c in ROLLUP_COLUMNS)
+        if record.get("chat_id"):
+            conn.execute(
+                f"INSERT INTO chat_usage (chat_id, user_id, messages, {', '.join(ROLLUP_COLUMNS)}, updated_at) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                f"ON CONFLICT (chat_id) DO UPDATE SET messages = messages + excluded.messages, "
+                f"{increments}, updated_at = excluded.updated_at",
+                (record["chat_id"], record.get("user_id"), sign, *values, time.time()),
+            )
+        if record.get("user_id"):
+            day = time.strftime("%Y-%m-%d", time.localtime(record.get("created_at") or time.time()))
+            conn.execute(
+                f"INSERT INTO user_daily_usage (user_id, day, messages, {', '.join(ROLLUP_COLUMNS)}) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?) "
+                f"ON CONFLICT (user_id, day) DO UPDATE SET messages = messages + excluded.messages, "
+                f"{increments}",
+                (record["user_id"], day, sign, *values),
+            )
+
+    async def put(self, record: dict) -> None:
+        """
+        写入一条记录；等待期间到达的其他记录会在同一事务中一起提交。
+        事务失败时同一批的每个调用方都会收到该异常，不会有记录被静默丢弃。
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        written = asyncio.get_running_loop().create_future()
+        self._pending.append((record, written))
+        async with self._flush_lock:
+            if self._pending:
+                batch, self._pending = self._pending, []
+                try:
+                    await asyncio.to_thread(self._insert, [r for r, _ in batch])
+                except BaseException as e:
+                    # 本调用方直接收到异常（包括取消），其余调用方通过各自的 future 收到
+                    error = e if isinstance(e, Exception) else RuntimeError("记录写入被中断")
+                    for _, future in batch:
+                        if future is not written and not future.done():
+                            future.set_exception(error)
+                    raise
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+        await written
+
+    def get(self, message_id: str) -> Optional[dict]:
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                f"SELECT {', '.join(RECORD_COLUMNS)} FROM usage_records WHERE message_id = ?",
+                (message_id,),
+            ).fetchone()
+        return dict(zip(RECORD_COLUMNS, row)) if row else None
+
+    def compact(self, older_than_days: int) -> int:
+        """
+        把 older_than_days 天之前的记录按天压缩进 usage_segments（gzip NDJSON），并从
+        usage_records 删除。每天一个 IMMEDIATE 事务，多个 worker 同时执行也不会重复压缩；
+        某天已有分段时（迟到的记录）合并后重写。汇总表不受影响。
+        """
+        cutoff = day_start(days_ago(older_than_days))
+        compacted = 0
+        while True:
+            with self._lock:
+                conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    oldest = conn.execute(
+                        "SELECT MIN(created_at) FROM usage_records WHERE created_at < ?",
+                        (cutoff,),
+                    ).fetchone()[0]
+                    if oldest is None:
+                        conn.commit()
+                        return compacted
+                    day = local_day(oldest)
+                    end = min(
+                        cutoff,
+                        (datetime.datetime.fromtimestamp(day_start(day)) + datetime.timedelta(days=1)).timestamp(),
+                    )
+                    rows = conn.execute(
+                        f"SELECT {', '.join(RECORD_COLUMNS)} FROM usage_records "
+                        f"WHERE created_at < ? ORDER BY created_at",
+                        (end,),
+                    ).fetchall()
+                    records = [dict(zip(RECORD_COLUMNS, row)) for row in rows]
+                    existing = conn.execute(
+                        "SELECT data FROM usage_segments WHERE day = ?", (day,)
+                    ).fetchone()
+                    if existing is not None:
+                        merged = {r["message_id"]: r for r in iter_segment(existing[0])}
+                        merged.update((r["message_id"], r) for r in records)
+                        records = sorted(merged.values(), key=lambda r: r.get("created_at") or 0)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO usage_segments (day, records, data) VALUES (?, ?, ?)",
+                        (day, len(records), encode_segment(records)),
+                    )
+                    conn.execute("DELETE FROM usage_records WHERE created_at < ?", (end,))
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+            compacted += len(rows)
+
+    def enforce_retention(self, retention_days: int) -> int:
+        """删除 retention_days 天之前的记录、分段和汇总，返回删除的逐条记录数"""
+        first_day = days_ago(retention_days)
+        cutoff = day_start(first_day)
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                removed = conn.execute(
+                    "DELETE FROM usage_records WHERE created_at < ?", (cutoff,)
+                ).rowcount
+                removed += conn.execute(
+                    "SELECT COALESCE(SUM(records), 0) FROM usage_segments WHERE day < ?",
+                    (first_day,),
+                ).fetchone()[0]
+                conn.execute("DELETE FROM usage_segments WHERE day < ?", (first_day,))
+                conn.execute("DELETE FROM user_daily_usage WHERE day < ?", (first_day,))
+                conn.execute("DELETE FROM chat_usage WHERE updated_at < ?", (cutoff,))
+        return removed
+
+    def _claim_maintenance(self, min_interval: float) -> bool:
+        """多个 worker 共用一个库，min_interval 秒内只有一个执行维护"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT value FROM store_meta WHERE key = 'maintained_at'"
+                ).fetchone()
+                now = time.time()
+                if row is not None and now - float(row[0]) < min_interval:
+                    conn.rollback()
+                    return False
+                conn.execute(
+                    "INSERT OR REPLACE INTO store_meta (key, value) VALUES ('maintained_at', ?)",
+                    (str(now),),
+                )
+                conn.commit()
+                return True
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def maintain(
+        self, compact_after_days: int, retention_days: int, min_interval: float = 0
+    ) -> Optional[dict]:
+        """定期维护：先按保留期删除，再压缩旧记录；参数为 0 时跳过对应步骤"""
+        if min_interval > 0 and not self._claim_maintenance(min_interval):
+            return None
+        removed = self.enforce_retention(retention_days) if retention_days > 0 else 0
+        compacted = self.compact(compact_after_days) if compact_after_days > 0 else 0
+        return {"removed": removed, "compacted": compacted}
+
+    def export(
+        self,
+        out,
+        fmt: str = "ndjson",
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+    ) -> int:
+        """
+        按日期范围（YYYY-MM-DD，含首尾，服务器本地时区）流式导出记录为 CSV 或 NDJSON，
+        先导出已压缩的分段再导出未压缩的记录，内存中最多只有一天的分段。
+        使用单独的只读连接，不阻塞过滤器写入。
+        """
+        start_at = day_start(start) if start else 0.0
+        end_at = (
+            (datetime.datetime.strptime(end, "%Y-%m-%d") + datetime.timedelta(days=1)).timestamp()
+            if end
+            else float("inf")
+        )
+        if fmt == "csv":
+            writer = csv.DictWriter(out, fieldnames=RECORD_COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            def write(record: dict) -> None:
+                out.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+                out.write("\n")
+
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=30)
+        count = 0
+        try:
+            days = conn.execute(
+                "SELECT day FROM usage_segments WHERE day >= ? AND day <= ? ORDER BY day",
+                (start or "", end or "9999-12-31"),
+            ).fetchall()
+            for (day,) in days:
+                if hasattr(conn, "blobopen"):
+                    # Python 3.11+ 直接流式读取 BLOB
+                    rowid = conn.execute(
+                        "SELECT rowid FROM usage_segments WHERE day = ?", (day,)
+                    ).fetchone()[0]
+                    data = conn.blobopen("usage_segments", "data", rowid, readonly=True)
+                else:
+                    data = conn.execute(
+                        "SELECT data FROM usage_segments WHERE day = ?", (day,)
+                    ).fetchone()[0]
+                try:
+                    for record in iter_segment(data):
+                        if start_at <= (record.get("created_at") or 0) < end_at:
+                            write(record)
+                            count += 1
+                finally:
+                    if hasattr(data, "close"):
+                        data.close()
+            cursor = conn.execute(
+                f"SELECT {', '.join(RECORD_COLUMNS)} FROM usage_records "
+                f"WHERE created_at >= ? AND created_at < ? ORDER BY created_at",
+                (start_at, end_at),
+            )
+            for row in cursor:
+                write(dict(zip(RECORD_COLUMNS, row)))
+                count += 1
+        finally:
+            conn.close()
+        return count
+
+    def migrate_json_directory(self, directory: Optional[str] = None, batch_size: int = 1000) -> int:
+        """一次性导入旧版 JSON 记录目录，完成后写入标记，不会重复导入；原文件保留不删除"""
+        directory = directory or RECORD_DIRECTORY
+        with self._lock:
+            conn = self._connect()
+            done = conn.execute(
+                "SELECT value FROM store_meta WHERE key = 'json_migrated'"
+            ).fetchone()
+        if done or not os.path.isdir(directory):
+            return 0
+
+        imported = 0
+        batch = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json") or not entry.is_file():
+                    continue
+                try:
+                    with open(entry.path, "r") as f:
+                        stats_data = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"跳过无法读取的记录文件 {entry.path}: {e}")
+                    continue
+                batch.append(
+                    {
+                        **{c: stats_data.get(c) for c in RECORD_COLUMNS},
+                        "message_id": entry.name[: -len(".json")],
+                        "created_at": entry.stat().st_mtime,
+                    }
+                )
+                if len(batch) >= batch_size:
+                    imported += self._insert_missing(batch)
+                    batch = []
+        if batch:
+            imported += self._insert_missing(batch)
+
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO store_meta (key, value) VALUES ('json_migrated', ?)",
+                    (str(time.time()),),
+                )
+        return imported
+
+    def _insert_missing(self, records: list) -> int:
+        # 已经写入数据库的新记录优先，不被旧 JSON 覆盖；只有实际插入的记录计入汇总
+        placeholders = ", ".join("?" for _ in RECORD_COLUMNS)
+        inserted = 0
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for record in records:
+                    cursor = conn.execute(
+                        f"INSERT OR IGNORE INTO usage_records ({', '.join(RECORD_COLUMNS)}) "
+                        f"VALUES ({placeholders})",
+                        tuple(record.get(c) for c in RECORD_COLUMNS),
+                    )
+                    if cursor.rowcount == 1:
+                        self._apply_rollup(conn, record, 1)
+                        inserted += 1
+        return inserted
+
+    def get_chat_digest(self, chat_key: str) -> Optional[tuple]:
+        """监控端已接受的 (消息数, 指纹)，不论上一轮由哪个 worker 上报"""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT messages, fingerprint FROM chat_digests WHERE chat_key = ?", (chat_key,)
+            ).fetchone()
+
+    def set_chat_digest(self, chat_key: str, messages: int, fingerprint: str) -> None:
+        """记录监控端已接受的前缀，只保留最近更新的 CHAT_DIGEST_LIMIT 个对话"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO chat_digests (chat_key, messages, fingerprint, updated_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (chat_key, messages, fingerprint, time.time()),
+                )
+                conn.execute(
+                    "DELETE FROM chat_digests WHERE updated_at < ("
+                    "SELECT updated_at FROM chat_digests ORDER BY updated_at DESC LIMIT 1 OFFSET ?)",
+                    (CHAT_DIGEST_LIMIT,),
+                )
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# 监控端 inlet/outlet 接口的精简协议版本；1 为旧版 {"user", "body"} 格式
+COMPACT_PAYLOAD_VERSION = 2
+USER_FIELDS = ("id", "email", "name", "role")
+
+
+def message_text(content) -> str:
+    """将消息内容（字符串或多模态分片）展开为用于计算 token 的纯文本"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            part.get("text", "")
+            for part in content
+            if isinstance(part, dict) and part.get("type") == "text"
+        )
+    return "" if content is None else str(content)
+
+
+def json_default(o: Any) -> Any:
+    """pydantic 对象（用户 valves、模型信息）在序列化时直接导出，无需事先 model_dump"""
+    if hasattr(o, "model_dump"):
+        return o.model_dump(mode="json")
+    return o.dict() if hasattr(o, "dict") else str(o)
+
+
+def dump_json(data: Any) -> bytes:
+    """一次性编码为 UTF-8 JSON 字节，安装了 orjson 时优先使用"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # orjson 不支持超过 64 位的整数和过深的嵌套，交给标准库
+            pass
+    return json.dumps(
+        data, ensure_ascii=False, separators=(",", ":"), default=json_default
+    ).encode("utf-8")
+
+
+# 监控端 inlet/outlet 接口支持的 Content-Encoding
+REQUEST_COMPRESSIONS = ("gzip", "zstd")
+
+
+def request_headers(encoding: str) -> dict:
+    headers = {"Content-Type": "application/json"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return headers
+
+
+def compress_body(content: bytes, encoding: str) -> Optional[bytes]:
+    """压缩请求体；本地没有对应编解码器时返回 None"""
+    if encoding == "gzip":
+        return gzip.compress(content, compresslevel=5, mtime=0)
+    if encoding == "zstd":
+        try:
+            from compression import zstd  # Python 3.14+
+
+            return zstd.compress(content, level=3)
+        except ImportError:
+            pass
+        try:
+            import zstandard
+        except ImportError:
+            return None
+        return zstandard.ZstdCompressor(level=3).compress(content)
+    return None
+
+
+def reports_usage(messages: list) -> bool:
+    """最后一条消息是否带有完整的 usage；带有时 outlet 不需要上报消息列表"""
+    usage = (messages[-1].get("usage") if messages else None) or {}
+    return bool(usage.get("prompt_tokens") and usage.get("completion_tokens"))
+
+
+def compact_usage_payload(user: dict, body: dict, with_messages: bool = True) -> dict:
+    """构造精简请求：只包含模型、用户和最后一条消息的 usage，缺少 usage 时才附带纯文本消息"""
+    payload = {
+        "version": COMPACT_PAYLOAD_VERSION,
+        "user": {k: user.get(k) for k in USER_FIELDS if k in user},
+        "model": body.get("model"),
+    }
+    if not with_messages:
+        return payload
+    messages = body.get("messages") or []
+    if reports_usage(messages):
+        usage = messages[-1]["usage"]
+        payload["usage"] = {
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+        }
+    else:
+        payload["messages"] = [
+            {"role": m.get("role"), "content": message_text(m.get("content"))}
+            for m in messages
+        ]
+    return payload
+
+
+def parse_endpoints(value: str) -> list:
+    """API_ENDPOINT 可以是一个地址，也可以是逗号分隔的多个监控副本地址"""
+    return [url.strip().rstrip("/") for url in (value or "").split(",") if url.strip()]
+
+
+class MonitorEndpoint:
+    __slots__ = ("url", "outstanding", "ewma", "failures", "ejected_until", "ejections")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.ewma: Optional[float] = None
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+
+
+class EndpointPool:
+    """
+    在多个监控副本之间分配请求。
+
+    least_outstanding 选进行中请求最少的副本；ewma 再乘以平滑后的延迟，慢副本分到的请求更少。
+    被动健康检查：连续失败 eject_after 次的副本暂停 eject_seconds 秒（重复摘除时翻倍，最多 8 倍），
+    恢复后成功一次即重置。所有副本都被摘除时仍使用最早恢复的那个。
+    """
+
+    EWMA_ALPHA = 0.3
+
+    def __init__(self):
+        self.endpoints: dict = {}
+        self._value: Optional[str] = None
+        self.strategy = "least_outstanding"
+        self.eject_after = 3
+        self.eject_seconds = 30.0
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def configure(self, value: str, strategy: str, eject_after: int, eject_seconds: float) -> None:
+        if value != self._value:
+            # 仍在列表中的副本保留负载和健康状态
+            self.endpoints = {
+                url: self.endpoints.get(url) or MonitorEndpoint(url)
+                for url in parse_endpoints(value)
+            }
+            self._value = value
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+
+    def _score(self, endpoint: MonitorEndpoint) -> float:
+        if self.strategy == "ewma":
+            return (endpoint.ewma or 0.0) * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def pick(self, exclude: tuple = ()) -> Optional[MonitorEndpoint]:
+        candidates = [e for e in self.endpoints.values() if e.url not in exclude]
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+        now = time.monotonic()
+        healthy = [e for e in candidates if e.ejected_until <= now]
+        if not healthy:
+            return min(candidates, key=lambda e: e.ejected_until)
+        best = min(self._score(e) for e in healthy)
+        return random.choice([e for e in healthy if self._score(e) == best])
+
+    def finish(self, endpoint: MonitorEndpoint, seconds: float, outage: Optional[bool]) -> None:
+        """outage 为 None 表示请求被取消，不计入健康状态"""
+        endpoint.outstanding -= 1
+        if outage is None:
+            return
+        if not outage:
+            endpoint.failures = 0
+            endpoint.ejections = 0
+            endpoint.ejected_until = 0.0
+            endpoint.ewma = (
+                seconds
+                if endpoint.ewma is None
+                else endpoint.ewma + self.EWMA_ALPHA * (seconds - endpoint.ewma)
+            )
+            return
+        endpoint.failures += 1
+        if self.eject_after > 0 and endpoint.failures >= self.eject_after and len(self.endpoints) > 1:
+            duration = self.eject_seconds * min(2**endpoint.ejections, 8)
+            endpoint.ejected_until = time.monotonic() + duration
+            endpoint.ejections += 1
+            endpoint.failures = 0
+            print(f"监控副本 {endpoint.url} 连续失败，暂停使用 {duration:.0f} 秒")
+
+
+class TurnState:
+    """
+    带过期时间和容量上限的有界映射，保存 inlet 到 outlet 之间的单轮状态。
+
+    按写入顺序保存，写入时从头部清理过期项，超出上限时淘汰最早的项，
+    避免 outlet 未被调用（请求中断等）时状态无限增长。
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def configure(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def set(self, key: Any, value: Any) -> None:
+        now = time.monotonic()
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        while self._data:
+            expires_at = next(iter(self._data.values()))[0]
+            if self.ttl <= 0 or expires_at > now:
+                break
+            self._data.popitem(last=False)
+        while self.max_size > 0 and len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if self.ttl > 0 and item[0] <= time.monotonic():
+            del self._data[key]
+            return default
+        return item[1]
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        if item is None or (self.ttl > 0 and item[0] <= time.monotonic()):
+            return default
+        return item[1]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def turn_keys(message_id: Optional[str], chat_id: Optional[str], user_id: Optional[str]) -> list:
+    """单轮状态的查找键，按 消息 -> 对话 -> 用户 的顺序回退"""
+    keys = []
+    if message_id:
+        keys.append(f"message:{message_id}")
+    if chat_id:
+        keys.append(f"chat:{chat_id}")
+    if user_id:
+        keys.append(f"user:{user_id}")
+    return keys
+
+
+def chain_fingerprint(previous: str, role: str, content: str) -> str:
+    """对上一个指纹、角色和文本做 sha256 链式摘要，监控端按相同方式计算"""
+    digest = hashlib.sha256()
+    for part in (previous, "\n", role, "\n", content):
+        digest.update(part.encode("utf-8", "surrogatepass"))
+    return digest.hexdigest()[:32]
+
+
+def message_fingerprints(messages: list) -> list:
+    fingerprints = []
+    previous = ""
+    for message in messages:
+        previous = chain_fingerprint(
+            previous, message.get("role") or "", message.get("content") or ""
+        )
+        fingerprints.append(previous)
+    return fingerprints
+
+
+def delta_section(chat_id: str, messages: list, fingerprints: list, prefix_count: int) -> dict:
+    """增量格式：只包含前 prefix_count 条已上报消息之后的消息"""
+    return {
+        "chat_id": chat_id,
+        "prefix_count": prefix_count,
+        "prefix_hash": fingerprints[prefix_count - 1] if prefix_count else "",
+        "messages": messages[prefix_count:],
+    }
+
+
+def sampled(key: str, rate: float) -> bool:
+    """按 key 的哈希决定是否采样，同一轮在所有 worker 上的结果一致"""
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    digest = hashlib.sha256(key.encode("utf-8", "surrogatepass")).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64 < rate
+
+
+def redact_messages(messages: list) -> list:
+    """只保留角色、长度和内容摘要，不输出对话原文"""
+    redacted = []
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        content = message.get("content")
+        text = content if isinstance(content, str) else json.dumps(content, ensure_ascii=False, default=str)
+        redacted.append(
+            {
+                "role": message.get("role"),
+                "chars": len(text),
+                "sha256": hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()[:16],
+            }
+        )
+    return redacted
+
+
+# 流量采集行格式的版本号，字段变化时递增；scripts/replay_filters.py 会检查
+CAPTURE_FORMAT_VERSION = 1
+
+
+def anonymize_id(value) -> Optional[str]:
+    """用户、对话和消息 id 的短哈希，采集文件能关联同一轮而不含原始 id"""
+    if value is None:
+        return None
+    return hashlib.sha256(
+        f"usage_monitor:{value}".encode("utf-8", "surrogatepass")
+    ).hexdigest()[:16]
+
+
+def call_shape(
+    hook: str, body: dict, metadata: dict, user: dict, seconds: float, outcome: str
+) -> dict:
+    """一行流量采集：inlet/outlet 调用的形状，不含任何对话内容（模型 id 原样保留）"""
+    messages = [m for m in body.get("messages") or [] if isinstance(m, dict)]
+    message_id = metadata.get("message_id") or (
+        messages[-1].get("id") if messages else None
+    )
+    shape = {
+        "v": CAPTURE_FORMAT_VERSION,
+        "ts": round(time.time(), 3),
+        "hook": hook,
+        "turn": anonymize_id(message_id),
+        "user": anonymize_id(user.get("id")),
+        "chat": anonymize_id(body.get("chat_id") or metadata.get("chat_id")),
+        "model": body.get("model"),
+        "roles": "".join(str(m.get("role") or "?")[:1] for m in messages),
+        "chars": [len(message_text(m.get("content"))) for m in messages],
+        "ms": round(seconds * 1000, 3),
+        "outcome": outcome,
+    }
+    task = body.get("task") or metadata.get("task")
+    if task:
+        shape["task"] = task
+    if hook == "outlet":
+        usage = messages[-1].get("usage") if messages else None
+        shape["usage"] = (
+            [usage.get("prompt_tokens"), usage.get("completion_tokens")]
+            if isinstance(usage, dict)
+            else None
+        )
+    return shape
+
+
+def append_lines(path: str, lines: list) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "ab") as handle:
+        handle.write(b"".join(lines))
+
+
+class TrafficCapture:
+    """
+    capture_path 的缓冲 NDJSON 写入器，供 scripts/replay_filters.py 回放。
+
+    每秒（或每 256 行）在线程里追加写一次；磁盘跟不上时超过 max_pending 的行直接丢弃并计数。
+    """
+
+    def __init__(
+        self, flush_interval: float = 1.0, flush_lines: int = 256, max_pending: int = 65536
+    ):
+        self.flush_interval = flush_interval
+        self.flush_lines = flush_lines
+        self.max_pending = max_pending
+        self._lines: list = []
+        self._path: Optional[str] = None
+        self._flushed_at = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, path: str, shape: dict) -> None:
+        self._path = path
+        if len(self._lines) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._lines.append(dump_json(shape) + b"\n")
+        now = time.monotonic()
+        if (
+            len(self._lines) < self.flush_lines
+            and now - self._flushed_at < self.flush_interval
+        ):
+            return
+        if self._task is not None and not self._task.done():
+            return
+        lines, self._lines = self._lines, []
+        self._flushed_at = now
+        self._task = asyncio.get_running_loop().create_task(self._write(path, lines))
+
+    async def _write(self, path: str, lines: list) -> None:
+        try:
+            await asyncio.to_thread(append_lines, path, lines)
+            self.written += len(lines)
+        except OSError as e:
+            self.dropped += len(lines)
+            print(f"写入流量采集文件 {path} 失败: {e}")
+
+    async def flush(self) -> None:
+        """立即写出缓冲的行，例如在收集采集文件之前"""
+        if self._task is not None:
+            await self._task
+        if self._lines and self._path:
+            lines, self._lines = self._lines, []
+            self._flushed_at = time.monotonic()
+            await self._write(self._path, lines)
+
+
+# 直方图桶上界：秒、字节、每轮秒数、每秒 token 数
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+TURN_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320)
+
+# 指标名 -> (类型, 说明, 桶)
+METRIC_DEFINITIONS = {
+    "request_seconds": ("histogram", "Round trip time of monitor requests.", LATENCY_BUCKETS),
+    "serialize_seconds": ("histogram", "Time spent encoding monitor request bodies.", LATENCY_BUCKETS),
+    "request_bytes": ("histogram", "Monitor request body size as sent, after any compression.", SIZE_BUCKETS),
+    "request_encoding_total": ("counter", "Monitor request bodies by content encoding.", None),
+    "response_bytes": ("histogram", "Monitor response body size.", SIZE_BUCKETS),
+    "errors_total": ("counter", "Failed monitor calls by path and error type.", None),
+    "hook_seconds": ("histogram", "Time the filter adds to a turn in inlet and outlet.", LATENCY_BUCKETS),
+    "record_write_seconds": ("histogram", "Time spent writing a billing record to SQLite.", LATENCY_BUCKETS),
+    "turn_seconds": ("histogram", "Elapsed time from inlet to outlet per turn.", TURN_BUCKETS),
+    "turn_tokens_per_second": ("histogram", "Output tokens per second over the whole turn.", RATE_BUCKETS),
+}
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _prom_labels(labels: tuple, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for key, value in items
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Metrics:
+    """
+    进程内的计数器和直方图，按 Prometheus 文本格式输出。
+
+    记录操作只是事件循环上的字典和整数运算；render 也应在事件循环中调用，写文件放到线程里。
+    """
+
+    def __init__(self, prefix: str, definitions: dict):
+        self.prefix = prefix
+        self.definitions = definitions
+        self.enabled = True
+        self._series = {}
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def observe(self, name: str, value: Optional[float], **labels) -> None:
+        if not self.enabled or value is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._series.get(key)
+        if histogram is None:
+            histogram = self._series[key] = Histogram(self.definitions[name][2])
+        histogram.observe(value)
+
+    def render(self) -> str:
+        grouped = {}
+        for (name, labels), value in list(self._series.items()):
+            grouped.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, (kind, help_text, _) in self.definitions.items():
+            if name not in grouped:
+                continue
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in sorted(grouped[name], key=lambda item: item[0]):
+                if not isinstance(value, Histogram):
+                    lines.append(f"{full_name}{_prom_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{full_name}_bucket{_prom_labels(labels, le=float(bound))} {cumulative}"
+                    )
+                lines.append(f"{full_name}_bucket{_prom_labels(labels, le='+Inf')} {value.count}")
+                lines.append(f"{full_name}_sum{_prom_labels(labels)} {value.sum}")
+                lines.append(f"{full_name}_count{_prom_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+def write_text_atomic(path: str, text: str) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        handle.write(text)
+    os.replace(tmp_path, path)
 
 
 class Filter:
     class Valves(BaseModel):
         API_ENDPOINT: str = Field(
-            default="", description="The base URL for the API endpoint."
+            default="",
+            description="The base URL for the API endpoint, or several monitor replicas' base URLs separated by commas.",
         )
         API_KEY: str = Field(default="", description="API key for authentication.")
         priority: int = Field(
             default=5, description="Priority level for the filter operations."
         )
+        compact_payload: bool = Field(
+            default=False,
+            description="Send only model, user and usage (version 2 protocol) instead of the whole conversation; requires an up-to-date monitor.",
+        )
+        delta_upload: bool = Field(
+            default=False,
+            description="When messages must be sent, send only those the monitor has not seen for this chat; requires compact_payload and an up-to-date monitor.",
+        )
+        request_timeout: float = Field(
+            default=30.0, description="Timeout for requests to the monitor, in seconds."
+        )
+        max_connections: int = Field(
+            default=100, description="Max concurrent connections to the monitor."
+        )
+        endpoint_selection: str = Field(
+            default="least_outstanding",
+            description="How to spread requests over several monitor replicas: least_outstanding or ewma (latency weighted).",
+        )
+        endpoint_retries: int = Field(
+            default=1,
+            description="Retry a failed call on up to this many other replicas. Outlets carry the message id as idempotency key, so a retry never bills twice (needs an up-to-date monitor).",
+        )
+        endpoint_eject_after: int = Field(
+            default=3, description="Consecutive failures after which a replica is skipped for a while (0 disables ejection)."
+        )
+        endpoint_eject_seconds: float = Field(
+            default=30.0, description="Seconds an ejected replica is skipped, doubled for each repeat ejection up to 8x."
+        )
+        request_compression: str = Field(
+            default="off",
+            description="Compress large request bodies: off, gzip or zstd (zstd needs Python 3.14 or the zstandard package here and Node.js 22.15+ on the monitor). Needs an up-to-date monitor.",
+        )
+        compression_min_bytes: int = Field(
+            default=16384, description="Only compress request bodies at least this large, in bytes."
+        )
+        record_db_path: str = Field(
+            default=RECORD_DB_PATH,
+            description="SQLite database for per-message billing records (shared with the usage button action).",
+        )
+        compact_after_days: int = Field(
+            default=30,
+            description="Records older than this many days are compressed into one segment per day; the usage button still finds them. On by default, so upgraded deployments start compacting (0 disables).",
+        )
+        retention_days: int = Field(
+            default=0,
+            description="Delete records, segments and per-user daily totals older than this many days (0 keeps everything).",
+        )
+        maintenance_interval: float = Field(
+            default=3600.0,
+            description="Seconds between compaction/retention runs; one worker runs it per interval.",
+        )
+        metrics_enabled: bool = Field(
+            default=True, description="Record latency, size and error metrics."
+        )
+        metrics_file: str = Field(
+            default="",
+            description="Write Prometheus text metrics to this file (e.g. for node_exporter's textfile collector); {pid} is replaced by the worker's process id. Empty disables.",
+        )
+        metrics_interval: float = Field(
+            default=15.0, description="Seconds between metrics file writes."
+        )
+        state_max_entries: int = Field(
+            default=10000,
+            description="Maximum number of in-flight turns (and out-of-balance users) kept between inlet and outlet.",
+        )
+        state_ttl: float = Field(
+            default=3600.0,
+            description="Seconds after which per-turn state whose outlet never arrived is dropped.",
+        )
+        log_level: str = Field(
+            default="summary",
+            description="Per-turn stdout logging: off, summary (one JSON line with ids, model, tokens, cost and timings) or body (summary plus a redacted copy of the conversation for log_body_sample_rate of the turns).",
+        )
+        log_sample_rate: float = Field(
+            default=1.0, description="Fraction of turns that get a summary log line (0-1)."
+        )
+        log_body_sample_rate: float = Field(
+            default=0.01,
+            description="With log_level=body, fraction of turns whose redacted conversation (roles, lengths and content hashes only) is logged (0-1).",
+        )
+        capture_path: str = Field(
+            default="",
+            description="Append anonymized inlet/outlet call shapes (hashed ids, model, message sizes, usage presence, hook timings; no content) to this NDJSON file for scripts/replay_filters.py; {pid} is replaced by the worker's process id. Empty disables.",
+        )
+        capture_sample_rate: float = Field(
+            default=1.0, description="Fraction of turns captured when capture_path is set (0-1)."
+        )
 
     def __init__(self):
         self.type = "filter"
         self.name = "OpenWebUI Monitor"
         self.valves = self.Valves()
-        self.outage = False
-        self.start_time = None
-        self.inlet_temp = None
-
-    def _prepare_request_body(self, body: dict) -> dict:
-        """Convert body and nested objects to JSON-serializable format"""
-        body_copy = body.copy()
-        
-        if 'metadata' in body_copy and 'model' in body_copy['metadata']:
-            if hasattr(body_copy['metadata']['model'], 'model_dump'):
-                body_copy['metadata']['model'] = body_copy['metadata']['model'].model_dump()
-        
-        return body_copy
-
-    def _prepare_user_dict(self, __user__: dict) -> dict:
-        """将 __user__ 对象转换为可序列化的字典"""
-        user_dict = dict(__user__)  # 创建副本以避免修改原始对象
-
-        # 如果存在 valves 且是 BaseModel 的实例，将其转换为字典
-        if "valves" in user_dict and hasattr(user_dict["valves"], "model_dump"):
-            user_dict["valves"] = user_dict["valves"].model_dump()
-
-        return user_dict
-
-    def _modify_outlet_body(self, body: dict) -> dict:
-        body_modify = dict(body)
-        last_message = body_modify["messages"][-1]
-    
-        if "info" not in last_message and self.inlet_temp is not None:
-            body_modify["messages"][:-1] = self.inlet_temp["messages"]
-        return body_modify
-
-    def inlet(
-        self, body: dict, user: Optional[dict] = None, __user__: dict = {}
+        # 按消息/对话 id 保存的单轮状态：开始时间，需要时还有 inlet 时的消息列表
+        self._turns = TurnState()
+        # 模型最近一次 outlet 是否带有 usage；带有时 inlet 不必复制消息列表
+        self._usage_models = TurnState()
+        # 余额不足的用户 id，只跳过这些用户的 outlet
+        self._outage_users = TurnState()
+        # 复用的连接池客户端，配置或事件循环变化时重建
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_key = None
+        self._record_store: Optional[RecordStore] = None
+        self._migration: Optional[asyncio.Task] = None
+        self._maintenance_task: Optional[asyncio.Task] = None
+        self._maintained_at = 0.0
+        # 监控端返回过 415 的编码（如旧版 Node.js 上的 zstd），之后不再压缩
+        self._rejected_encodings: set = set()
+        self._endpoints = EndpointPool()
+        self.metrics = Metrics("usage_monitor_invisible", METRIC_DEFINITIONS)
+        self._metrics_written_at = 0.0
+        self._metrics_task: Optional[asyncio.Task] = None
+        self._capture = TrafficCapture()
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        key = (
+            self.valves.API_KEY,
+            self.valves.request_timeout,
+            self.valves.max_connections,
+            id(asyncio.get_running_loop()),
+        )
+        if (
+            self._client is not None
+            and not self._client.is_closed
+            and self._client_key == key
+        ):
+            return self._client
+
+        old_client = self._client
+        self._client = httpx.AsyncClient(
+            # httpx 拒绝以空格结尾的头部值，未配置密钥时照常发送以便服务端返回 401
+            headers={"Authorization": f"Bearer {self.valves.API_KEY}".strip()},
+            timeout=self.valves.request_timeout,
+            limits=httpx.Limits(max_connections=self.valves.max_connections),
+        )
+        self._client_key = key
+        if old_client is not None and not old_client.is_closed:
+            try:
+                await old_client.aclose()
+            except Exception:
+                # 旧客户端可能属于已关闭的事件循环
+                pass
+        return self._client
+
+    async def _send(
+        self, endpoint: MonitorEndpoint, path: str, content: bytes, encoding: str
+    ) -> httpx.Response:
+        client = await self._get_client()
+        endpoint.outstanding += 1
+        started = time.perf_counter()
+        outage: Optional[bool] = None
+        try:
+            response = await client.post(
+                f"{endpoint.url}{path}", content=content, headers=request_headers(encoding)
+            )
+            outage = response.status_code >= 500
+            return response
+        except httpx.TransportError:
+            outage = True
+            raise
+        except Exception:
+            outage = False
+            raise
+        finally:
+            self._endpoints.finish(endpoint, time.perf_counter() - started, outage)
+
+    async def _post(
+        self, path: str, request_data: dict, idempotent: bool = False
+    ) -> httpx.Response:
+        """
+        发送到一个监控副本。连接失败时换一个副本重试；
+        请求可能已被处理（超时、5xx）时只有 idempotent 的请求才重试。
+        """
+        started = time.perf_counter()
+        raw = dump_json(request_data)
+        content, encoding = self._compress(raw)
+        sent = time.perf_counter()
+        self.metrics.observe("serialize_seconds", sent - started, path=path)
+        self.metrics.observe("request_bytes", len(content), path=path)
+        self.metrics.inc("request_encoding_total", path=path, encoding=encoding)
+
+        endpoints = self._endpoints
+        endpoints.configure(
+            self.valves.API_ENDPOINT,
+            self.valves.endpoint_selection,
+            self.valves.endpoint_eject_after,
+            self.valves.endpoint_eject_seconds,
+        )
+        tried: tuple = ()
+        while True:
+            endpoint = endpoints.pick(exclude=tried)
+            if endpoint is None:
+                raise ValueError("未配置 API_ENDPOINT")
+            tried += (endpoint.url,)
+            can_retry = (
+                len(tried) <= self.valves.endpoint_retries and len(tried) < len(endpoints)
+            )
+            try:
+                response = await self._send(endpoint, path, content, encoding)
+                if response.status_code == 415 and encoding != "identity":
+                    print(f"监控端不接受 {encoding} 压缩的请求体，改为不压缩发送")
+                    self._rejected_encodings.add(encoding)
+                    content, encoding = raw, "identity"
+                    self.metrics.inc("request_encoding_total", path=path, encoding=encoding)
+                    response = await self._send(endpoint, path, content, encoding)
+            except httpx.HTTPError as e:
+                self.metrics.inc("errors_total", path=path, type=type(e).__name__)
+                if can_retry and (
+                    isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                    or (idempotent and isinstance(e, httpx.TransportError))
+                ):
+                    print(f"{path} 在 {endpoint.url} 失败（{e}），换一个副本重试")
+                    continue
+                raise
+            if response.status_code >= 500 and idempotent and can_retry:
+                self.metrics.inc(
+                    "errors_total", path=path, type=f"http_{response.status_code}"
+                )
+                print(f"{path} 在 {endpoint.url} 返回 {response.status_code}，换一个副本重试")
+                continue
+            break
+        self.metrics.observe("request_seconds", time.perf_counter() - sent, path=path)
+        self.metrics.observe("response_bytes", len(response.content), path=path)
+        if response.status_code >= 400:
+            self.metrics.inc(
+                "errors_total", path=path, type=f"http_{response.status_code}"
+            )
+        return response
+
+    def _compress(self, raw: bytes) -> tuple:
+        encoding = self.valves.request_compression
+        if (
+            encoding not in REQUEST_COMPRESSIONS
+            or encoding in self._rejected_encodings
+            or len(raw) < self.valves.compression_min_bytes
+        ):
+            return raw, "identity"
+        compressed = compress_body(raw, encoding)
+        if compressed is None:
+            print(f"本地不支持 {encoding} 压缩，请求体改为不压缩发送")
+            self._rejected_encodings.add(encoding)
+            return raw, "identity"
+        if len(compressed) >= len(raw):
+            return raw, "identity"
+        return compressed, encoding
+
+    async def _post_outlet(self, request_data: dict, chat_key: Optional[str]) -> httpx.Response:
+        # 带幂等键的 outlet 重试不会重复计费
+        idempotent = "idempotency_key" in request_data
+        if not (
+            self.valves.delta_upload
+            and self.valves.compact_payload
+            and chat_key
+            and request_data.get("messages")
+        ):
+            return await self._post("/api/v1/outlet", request_data, idempotent)
+
+        messages = request_data.pop("messages")
+        fingerprints = message_fingerprints(messages)
+        chat_id = chat_key.split(":", 1)[1]
+        prefix_count = 0
+        store = self._get_record_store()
+        try:
+            reported = await asyncio.to_thread(store.get_chat_digest, chat_key)
+        except sqlite3.Error as e:
+            print(f"读取对话前缀失败: {e}")
+            reported = None
+        if reported is not None:
+            count, fingerprint = reported
+            # 至少回复是新的；历史被编辑时退回完整上传
+            if 0 < count < len(messages) and fingerprints[count - 1] == fingerprint:
+                prefix_count = count
+        request_data["delta"] = delta_section(chat_id, messages, fingerprints, prefix_count)
+        response = await self._post("/api/v1/outlet", request_data, idempotent)
+        if response.status_code == 409 and prefix_count:
+            # 监控端没有与该前缀匹配的统计（如写入失败），完整上传一次
+            request_data["delta"] = delta_section(chat_id, messages, fingerprints, 0)
+            response = await self._post("/api/v1/outlet", request_data, idempotent)
+        if response.is_success:
+            try:
+                await asyncio.to_thread(store.set_chat_digest, chat_key, len(messages), fingerprints[-1])
+            except sqlite3.Error as e:
+                print(f"保存对话前缀失败: {e}")
+        return response
+
+    def metrics_text(self) -> str:
+        """Prometheus 文本格式的指标"""
+        return self.metrics.render()
+
+    def _maybe_write_metrics(self) -> None:
+        self.metrics.enabled = self.valves.metrics_enabled
+        path = self.valves.metrics_file
+        if not path or not self.valves.metrics_enabled:
+            return
+        now = time.monotonic()
+        if now - self._metrics_written_at < self.valves.metrics_interval:
+            return
+        if self._metrics_task is not None and not self._metrics_task.done():
+            return
+        self._metrics_written_at = now
+        self._metrics_task = asyncio.get_running_loop().create_task(
+            self._write_metrics(
+                path.replace("{pid}", str(os.getpid())), self.metrics_text()
+            )
+        )
+
+    @staticmethod
+    async def _write_metrics(path: str, text: str) -> None:
+        try:
+            await asyncio.to_thread(write_text_atomic, path, text)
+        except OSError as e:
+            print(f"写入指标文件 {path} 失败: {e}")
+
+    def _capture_call(
+        self,
+        hook: str,
+        body,
+        metadata: Optional[dict],
+        user: Optional[dict],
+        seconds: float,
+        outcome: str,
+    ) -> None:
+        path = self.valves.capture_path
+        if not path or not isinstance(body, dict):
+            return
+        try:
+            shape = call_shape(hook, body, metadata or {}, user or {}, seconds, outcome)
+            # 按轮采样：同一轮的 inlet 和 outlet 在任何 worker 上要么都采集，要么都不采集
+            turn = shape["turn"]
+            rate = self.valves.capture_sample_rate
+            if not (sampled(turn, rate) if turn else random.random() < rate):
+                return
+            self._capture.record(path.replace("{pid}", str(os.getpid())), shape)
+        except Exception as e:
+            # 采集只用于诊断，不能影响对话
+            print(f"流量采集失败: {e}")
+
+    def _get_record_store(self) -> RecordStore:
+        if self._record_store is None or self._record_store.path != self.valves.record_db_path:
+            if self._record_store is not None:
+                self._record_store.close()
+            self._record_store = RecordStore(self.valves.record_db_path)
+            # 首次使用时在后台导入旧版 JSON 记录
+            self._migration = asyncio.get_running_loop().create_task(
+                self._migrate_records(self._record_store)
+            )
+        return self._record_store
+
+    @staticmethod
+    async def _migrate_records(store: RecordStore) -> None:
+        try:
+            count = await asyncio.to_thread(store.migrate_json_directory)
+            if count:
+                print(f"已从 {RECORD_DIRECTORY} 导入 {count} 条计费记录")
+        except Exception as e:
+            print(f"导入旧版计费记录失败: {e}")
+
+    def _maybe_maintain(self) -> None:
+        if not (self.valves.compact_after_days > 0 or self.valves.retention_days > 0):
+            return
+        now = time.monotonic()
+        if now - self._maintained_at < self.valves.maintenance_interval:
+            return
+        if self._maintenance_task is not None and not self._maintenance_task.done():
+            return
+        self._maintained_at = now
+        self._maintenance_task = asyncio.get_running_loop().create_task(
+            self._maintain_records(self._get_record_store())
+        )
+
+    async def _maintain_records(self, store: RecordStore) -> None:
+        try:
+            result = await asyncio.to_thread(
+                store.maintain,
+                self.valves.compact_after_days,
+                self.valves.retention_days,
+                self.valves.maintenance_interval,
+            )
+            if result and (result["removed"] or result["compacted"]):
+                print(
+                    f"计费记录维护：删除 {result['removed']} 条过期记录，压缩 {result['compacted']} 条旧记录"
+                )
+        except Exception as e:
+            print(f"计费记录维护失败: {e}")
+
+    def _configure_state(self) -> None:
+        for state in (self._turns, self._outage_users, self._usage_models):
+            state.configure(self.valves.state_max_entries, self.valves.state_ttl)
+
+    def _pop_turn(self, keys: list) -> Optional[dict]:
+        for key in keys:
+            turn = self._turns.pop(key)
+            if turn is not None:
+                return turn
+        return None
+
+    def _log_turn(self, record: dict, body: dict) -> None:
+        """每轮一行紧凑 JSON；采样后日志开销与对话长度无关（body 模式的采样轮次除外）"""
+        level = self.valves.log_level
+        if level not in ("summary", "body"):
+            return
+        key = str(record.get("message_id") or time.time_ns())
+        if not sampled(key, self.valves.log_sample_rate):
+            return
+        line = {"event": "usage_monitor_turn", **record}
+        if level == "body" and sampled(f"{key}:body", self.valves.log_body_sample_rate):
+            line["body"] = {"messages": redact_messages(body.get("messages") or [])}
+        print(json.dumps(line, ensure_ascii=False, separators=(",", ":"), default=str))
+
+    def _needs_inlet_messages(self, model: Optional[str]) -> bool:
+        """监控端只在缺少 usage 时按消息列表计算 token，已知会返回 usage 的模型不必保存 inlet 的消息"""
+        return not self._usage_models.get(model)
+
+    def _modify_outlet_body(self, body: dict, inlet_messages: Optional[list]) -> dict:
+        messages = body.get("messages") or []
+        if not messages or inlet_messages is None or "info" in messages[-1]:
+            return body
+        # 新建列表，不修改 Open WebUI 传入的消息
+        return {**body, "messages": list(inlet_messages) + [messages[-1]]}
+
+    async def inlet(
+        self,
+        body: dict,
+        user: Optional[dict] = None,
+        __user__: dict = {},
+        __metadata__: Optional[dict] = None,
     ) -> dict:
-        self.start_time = time.time()
+        started = time.perf_counter()
+        outcome = "error"
+        request = body
+        try:
+            body = await self._inlet(body, __user__, __metadata__)
+            outcome = "ok"
+            return body
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.observe("hook_seconds", elapsed, hook="inlet", outcome=outcome)
+            self._maybe_write_metrics()
+            self._capture_call("inlet", request, __metadata__, __user__, elapsed, outcome)
+
+    async def _inlet(
+        self, body: dict, __user__: dict, __metadata__: Optional[dict]
+    ) -> dict:
+        self._configure_state()
+        metadata = __metadata__ or {}
+        keys = turn_keys(
+            metadata.get("message_id"),
+            body.get("chat_id") or metadata.get("chat_id"),
+            __user__.get("id"),
+        )
+        # 只保存 outlet 需要的开始时间，消息列表只在 outlet 会用到时才复制
+        if keys:
+            turn = {"start_time": time.monotonic()}
+            if self._needs_inlet_messages(body.get("model")):
+                turn["messages"] = list(body.get("messages") or [])
+            self._turns.set(keys[0], turn)
 
         try:
-            post_url = f"{self.valves.API_ENDPOINT}/api/v1/inlet"
-            headers = {"Authorization": f"Bearer {self.valves.API_KEY}"}
-
-            # 使用 _prepare_user_dict 处理 __user__ 对象
-            user_dict = self._prepare_user_dict(__user__)
-            body_dict = self._prepare_request_body(body)
-            self.inlet_temp = body_dict
-            request_data = {
-                "user": user_dict,
-                "body": body_dict
-            }
-            response = requests.post(post_url, headers=headers, json=request_data)
+            # pydantic 对象由 dump_json 在序列化时导出，这里不再复制和转换
+            if self.valves.compact_payload:
+                request_data = compact_usage_payload(
+                    __user__, body, with_messages=False
+                )
+            else:
+                request_data = {"user": __user__, "body": body}
+            response = await self._post("/api/v1/inlet", request_data)
 
             if response.status_code == 401:
                 return body
@@ -84,15 +1522,16 @@ class Filter:
                 error_type = response_data.get("error_type", "UNKNOWN_ERROR")
                 raise Exception(f"请求失败: [{error_type}] {error_msg}")
 
-            self.outage = response_data.get("balance", 0) <= 0
-            if self.outage:
+            if response_data.get("balance", 0) <= 0:
+                self._outage_users.set(__user__.get("id"), True)
                 raise Exception(f"余额不足: 当前余额 `{response_data['balance']:.4f}`")
+            self._outage_users.pop(__user__.get("id"))
 
             return body
 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             if (
-                isinstance(e, requests.exceptions.HTTPError)
+                isinstance(e, httpx.HTTPStatusError)
                 and e.response.status_code == 401
             ):
                 return body
@@ -106,24 +1545,60 @@ class Filter:
         user: Optional[dict] = None,
         __user__: dict = {},
         __event_emitter__: Callable[[Any], Awaitable[None]] = None,
+        __metadata__: Optional[dict] = None,
     ) -> dict:
-        if self.outage:
+        started = time.perf_counter()
+        outcome = "error"
+        request = body
+        try:
+            body = await self._outlet(body, __user__, __event_emitter__, __metadata__)
+            outcome = "ok"
             return body
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.observe("hook_seconds", elapsed, hook="outlet", outcome=outcome)
+            self._maybe_write_metrics()
+            self._capture_call("outlet", request, __metadata__, __user__, elapsed, outcome)
 
-        try:
-            post_url = f"{self.valves.API_ENDPOINT}/api/v1/outlet"
-            headers = {"Authorization": f"Bearer {self.valves.API_KEY}"}
-
-            # 使用 _prepare_user_dict 处理 __user__ 对象
-            user_dict = self._prepare_user_dict(__user__)
-            body_dict = self._prepare_request_body(body)
-            body_modify = self._modify_outlet_body(body_dict)
-            request_data = {
-                "user": user_dict,
-                "body": body_modify
-            }
-            response = requests.post(post_url, headers=headers, json=request_data)
+    async def _outlet(
+        self,
+        body: dict,
+        __user__: dict,
+        __event_emitter__: Optional[Callable[[Any], Awaitable[None]]],
+        __metadata__: Optional[dict],
+    ) -> dict:
+        metadata = __metadata__ or {}
+        messages = body.get("messages", [])
+        turn = self._pop_turn(
+            turn_keys(
+                metadata.get("message_id") or (messages[-1].get("id") if messages else None),
+                body.get("chat_id") or metadata.get("chat_id"),
+                __user__.get("id"),
+            )
+        )
+        if self._outage_users.get(__user__.get("id")):
+            return body
+        if messages:
+            self._usage_models.set(body.get("model"), reports_usage(messages))
 
+        try:
+            body_modify = self._modify_outlet_body(
+                body, turn.get("messages") if turn else None
+            )
+            if self.valves.compact_payload:
+                request_data = compact_usage_payload(__user__, body_modify)
+            else:
+                request_data = {"user": __user__, "body": body_modify}
+            messages = body_modify.get("messages") or []
+            idempotency_key = (__metadata__ or {}).get("message_id") or (
+                messages[-1].get("id") if messages else None
+            )
+            if idempotency_key:
+                request_data["idempotency_key"] = str(idempotency_key)
+            chat_id = body.get("chat_id") or (__metadata__ or {}).get("chat_id")
+            response = await self._post_outlet(
+                request_data, f"{__user__.get('id')}:{chat_id}" if chat_id else None
+            )
 
             if response.status_code == 401:
                 if __event_emitter__:
@@ -152,44 +1627,52 @@ class Filter:
             total_cost = result["totalCost"]
             new_balance = result["newBalance"]
 
-            print(f"user_dict: {json.dumps(user_dict, indent=4)}")
-            print(f"inlet body: {json.dumps(body, indent=4)}")
-
             # 从 body 中获取消息 ID
             messages = body.get("messages", [])
             message_id = messages[-1].get("id") if messages else None
 
-            if message_id:  # 需要 message_id
-                # 构建统计信息字典
-                stats_data = {
-                    "input_tokens": input_tokens,
-                    "output_tokens": output_tokens,
-                    "total_cost": total_cost,
-                    "new_balance": new_balance,
-                }
-
-                # 计算耗时（如果有start_time）
-                if self.start_time:
-                    elapsed_time = time.time() - self.start_time
-                    stats_data["elapsed_time"] = elapsed_time
-
-                    # 计算每秒输出速度，使用三元运算符避免除以零
-                    stats_data["tokens_per_sec"] = (
-                        output_tokens / elapsed_time if elapsed_time > 0 else 0
-                    )
+            # 构建统计信息字典
+            stats_data = {
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_cost": total_cost,
+                "new_balance": new_balance,
+            }
 
-                    # 指定目标目录路径
-                    directory_path = "/app/backend/data/record"
+            # 计算耗时（如果找到了本轮的 inlet 状态）
+            if turn:
+                elapsed_time = time.monotonic() - turn["start_time"]
+                stats_data["elapsed_time"] = elapsed_time
 
-                    # 确保目录存在
-                    os.makedirs(directory_path, exist_ok=True)
+                # 计算每秒输出速度，使用三元运算符避免除以零
+                stats_data["tokens_per_sec"] = (
+                    output_tokens / elapsed_time if elapsed_time > 0 else 0
+                )
+                self.metrics.observe("turn_seconds", elapsed_time)
+                if elapsed_time > 0 and output_tokens:
+                    self.metrics.observe(
+                        "turn_tokens_per_second", stats_data["tokens_per_sec"]
+                    )
 
-                # 构建文件路径
-                file_path = os.path.join(directory_path, f"{message_id}.json")
+            record = {
+                **stats_data,
+                "message_id": message_id,
+                "user_id": __user__.get("id"),
+                "chat_id": body.get("chat_id") or (__metadata__ or {}).get("chat_id"),
+                "model": body.get("model"),
+                "created_at": time.time(),
+            }
+            # 只记录 id、模型、用量和耗时，不再打印整个对话
+            self._log_turn(record, body_modify)
 
-                # 将统计信息写入 JSON 文件
-                with open(file_path, "w") as f:
-                    json.dump(stats_data, f, indent=4)
+            if message_id:  # 需要 message_id
+                # 写入记录库（同一时刻的多条记录合并为一个事务）
+                write_started = time.perf_counter()
+                await self._get_record_store().put(record)
+                self.metrics.observe(
+                    "record_write_seconds", time.perf_counter() - write_started
+                )
+                self._maybe_maintain()
             else:
                 if __event_emitter__:
                     await __event_emitter__(
@@ -204,9 +1687,9 @@ class Filter:
 
             return body
 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             if (
-                isinstance(e, requests.exceptions.HTTPError)
+                isinstance(e, httpx.HTTPStatusError)
                 and e.response.status_code == 401
             ):
                 if __event_emitter__:
@@ -243,3 +1726,50 @@ class Filter:
                     }
                 )
             raise Exception(f"处理请求时发生错误: {str(e)}")
+
+
+def main(argv: list) -> None:
+    """
+    命令行入口：
+      python openwebui_monitor_invisible.py [JSON 目录] [数据库路径]      手动迁移旧版 JSON 记录
+      python openwebui_monitor_invisible.py maintain [--db 路径] [--compact-after-days N] [--retention-days N]
+      python openwebui_monitor_invisible.py export [--db 路径] [--format csv|ndjson] [--start YYYY-MM-DD] [--end YYYY-MM-DD] [--output 文件]
+    """
+    if not argv or argv[0] not in ("maintain", "export"):
+        json_dir = argv[0] if len(argv) > 0 else RECORD_DIRECTORY
+        db_path = argv[1] if len(argv) > 1 else RECORD_DB_PATH
+        count = RecordStore(db_path).migrate_json_directory(json_dir)
+        print(f"已导入 {count} 条记录到 {db_path}")
+        return
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="openwebui_monitor_invisible.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    maintain = commands.add_parser("maintain", help="压缩旧记录并删除超出保留期的数据")
+    maintain.add_argument("--db", default=RECORD_DB_PATH)
+    maintain.add_argument("--compact-after-days", type=int, default=30)
+    maintain.add_argument("--retention-days", type=int, default=0)
+    export = commands.add_parser("export", help="按日期范围流式导出记录")
+    export.add_argument("--db", default=RECORD_DB_PATH)
+    export.add_argument("--format", choices=("csv", "ndjson"), default="ndjson")
+    export.add_argument("--start", help="起始日期（含），YYYY-MM-DD")
+    export.add_argument("--end", help="结束日期（含），YYYY-MM-DD")
+    export.add_argument("--output", help="输出文件，默认标准输出")
+    args = parser.parse_args(argv)
+
+    store = RecordStore(args.db)
+    if args.command == "maintain":
+        result = store.maintain(args.compact_after_days, args.retention_days)
+        print(f"删除 {result['removed']} 条过期记录，压缩 {result['compacted']} 条旧记录")
+        return
+    if args.output:
+        with open(args.output, "w", encoding="utf-8", newline="") as out:
+            count = store.export(out, args.format, args.start, args.end)
+    else:
+        count = store.export(sys.stdout, args.format, args.start, args.end)
+    print(f"已导出 {count} 条记录", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
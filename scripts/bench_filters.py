@@ -0,0 +1,524 @@
+"""
+Benchmark the Open WebUI functions in resources/functions against a local stand-in monitor.
+
+Starts an in-process fake monitor (inlet, outlet, outlet/batch and models routes) with
+configurable latency and error injection, drives the filters' inlet/outlet and the usage
+button's action with synthetic conversations, and prints machine-readable JSON so results
+can be compared between versions:
+
+    python scripts/bench_filters.py --targets monitor,invisible,button \\
+        --concurrency 1,16,64 --messages 2,40 --turns 500 --latency-ms 20 \\
+        --valve monitor.compact_payload=true --output bench.json
+
+Needs httpx and pydantic (what the functions themselves require). The invisible filter
+imports open_webui; outside an Open WebUI install a placeholder for that import is used.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gzip
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources", "functions")
+TARGET_FILES = {
+    "monitor": "openwebui_monitor.py",
+    "invisible": "openwebui_monitor_invisible.py",
+    "button": "get_usage_button.py",
+}
+RESULT_FORMAT_VERSION = 1
+
+
+class FakeMonitor:
+    """
+    Threaded stand-in for the monitor's /api/v1 routes.
+
+    Every request sleeps ``latency`` seconds (plus up to ``jitter``) and fails with a 500
+    for an ``error_rate`` fraction of calls. Balances are tracked per user so long runs
+    never trip the insufficient-balance path.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        balance: float = 1e6,
+        prices: Optional[List[dict]] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.initial_balance = balance
+        self.prices = prices or [
+            {"id": "bench-model", "name": "bench-model", "input_price": 60.0, "output_price": 60.0, "per_msg_price": -1}
+        ]
+        self.balances: Dict[str, float] = {}
+        self.requests: Dict[str, int] = {}
+        self.request_bytes = 0
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeMonitor":
+        monitor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; without this, delayed ACKs add ~40ms per call.
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                monitor._handle(self, None)
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                with monitor._lock:
+                    monitor.request_bytes += len(raw)
+                if self.headers.get("Content-Encoding") == "gzip":
+                    raw = gzip.decompress(raw)
+                monitor._handle(self, json.loads(raw or b"{}"))
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _debit(self, user_id: str, cost: float) -> float:
+        with self._lock:
+            balance = self.balances.get(user_id, self.initial_balance) - cost
+            self.balances[user_id] = balance
+            return balance
+
+    def _usage(self, data: dict) -> dict:
+        user_id = (data.get("user") or {}).get("id", "default")
+        messages = data.get("messages") or (data.get("body") or {}).get("messages") or []
+        usage = data.get("usage") or (messages[-1].get("usage") if messages else None) or {}
+        tokens = data.get("tokens") or {}
+        input_tokens = usage.get("prompt_tokens") or tokens.get("input")
+        output_tokens = usage.get("completion_tokens") or tokens.get("output")
+        if not input_tokens or not output_tokens:
+            # Roughly what the real route's tokenizer would return.
+            sizes = [len(str(m.get("content") or "")) // 4 for m in messages]
+            input_tokens, output_tokens = sum(sizes[:-1]), sizes[-1] if sizes else 0
+        cost = (input_tokens + output_tokens) * 60.0 / 1_000_000
+        return {
+            "success": True,
+            "inputTokens": input_tokens,
+            "outputTokens": output_tokens,
+            "totalCost": cost,
+            "newBalance": self._debit(user_id, cost),
+        }
+
+    def _handle(self, handler: BaseHTTPRequestHandler, data: Optional[dict]) -> None:
+        path = handler.path.split("?", 1)[0]
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+        delay = self.latency + (random.random() * self.jitter if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            return self._reply(handler, 500, {"success": False, "error": "injected failure"})
+
+        if path == "/api/v1/models" and data is None:
+            return self._reply(handler, 200, self.prices)
+        if path == "/api/v1/inlet":
+            user_id = (data.get("user") or {}).get("id", "default")
+            with self._lock:
+                balance = self.balances.get(user_id, self.initial_balance)
+            return self._reply(handler, 200, {"success": True, "balance": balance, "inlet_cost": 0})
+        if path == "/api/v1/outlet":
+            return self._reply(handler, 200, self._usage(data))
+        if path == "/api/v1/outlet/batch":
+            results = [self._usage(event) for event in data.get("events") or []]
+            return self._reply(handler, 200, {"success": True, "results": results})
+        return self._reply(handler, 404, {"success": False, "error": "not found"})
+
+    @staticmethod
+    def _reply(handler: BaseHTTPRequestHandler, status: int, payload: Any) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        try:
+            handler.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up (timeout or shutdown); nothing left to answer.
+            pass
+
+
+def _ensure_open_webui_importable() -> None:
+    try:
+        import open_webui.utils.misc  # noqa: F401
+    except ImportError:
+        # Only the import itself is needed; the filter never calls it.
+        misc = types.ModuleType("open_webui.utils.misc")
+        misc.get_last_assistant_message = lambda messages: next(
+            (m.get("content") for m in reversed(messages) if m.get("role") == "assistant"), None
+        )
+        for name in ("open_webui", "open_webui.utils"):
+            sys.modules.setdefault(name, types.ModuleType(name))
+        sys.modules["open_webui.utils.misc"] = misc
+
+
+def load_function(target: str) -> types.ModuleType:
+    if target == "invisible":
+        _ensure_open_webui_importable()
+    path = os.path.join(FUNCTIONS_DIR, TARGET_FILES[target])
+    spec = importlib.util.spec_from_file_location(f"bench_{target}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def function_version(module: types.ModuleType) -> Optional[str]:
+    match = re.search(r"^version:\s*(\S+)", module.__doc__ or "", re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def apply_valves(valves: Any, overrides: Dict[str, str]) -> None:
+    for key, raw in overrides.items():
+        if key not in type(valves).model_fields:
+            raise SystemExit(f"unknown valve {key!r} for {type(valves).__qualname__}")
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            value = raw
+        # Validate through the model so "true"/"5" are coerced like the Open WebUI form does.
+        validated = type(valves).model_validate({**valves.model_dump(), key: value})
+        setattr(valves, key, getattr(validated, key))
+
+
+def make_conversation(turn: int, length: int, chars: int) -> dict:
+    words = "the quick brown fox jumps over a lazy dog while billing keeps count "
+    text = (words * (chars // len(words) + 1))[:chars]
+    messages = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i} {text}"} for i in range(max(1, length - 1))
+    ]
+    if messages[-1]["role"] != "user":
+        messages.append({"role": "user", "content": f"q {text}"})
+    return {"model": "bench-model", "chat_id": f"chat-{turn % 97}", "messages": messages}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(samples: List[float]) -> Dict[str, Optional[float]]:
+    ms = [s * 1000 for s in samples]
+    return {
+        "count": len(ms),
+        "mean_ms": sum(ms) / len(ms) if ms else None,
+        "p50_ms": percentile(ms, 50),
+        "p90_ms": percentile(ms, 90),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": max(ms) if ms else None,
+    }
+
+
+async def _noop_emitter(event: dict) -> None:
+    pass
+
+
+def make_filter(
+    module: types.ModuleType, target: str, monitor: FakeMonitor, workdir: str, case: str, overrides: Dict[str, str]
+) -> Any:
+    """A Filter pointed at ``monitor``, with its files under ``workdir`` and the --valve overrides applied."""
+    flt = module.Filter()
+    if target == "monitor":
+        flt.valves.api_endpoint = monitor.url
+        flt.valves.api_key = "bench"
+        flt.valves.report_spool_path = os.path.join(workdir, "spool.ndjson")
+    else:
+        flt.valves.API_ENDPOINT = monitor.url
+        flt.valves.API_KEY = "bench"
+        flt.valves.record_db_path = os.path.join(workdir, f"records-{case}.db")
+    apply_valves(flt.valves, overrides)
+    return flt
+
+
+async def close_filter(flt: Any, target: str) -> None:
+    if target == "monitor":
+        await flt.close()
+        return
+    if getattr(flt, "_capture", None) is not None:
+        await flt._capture.flush()
+    if getattr(flt, "_record_store", None) is not None:
+        if flt._migration is not None:
+            await flt._migration
+        flt._record_store.close()
+
+
+async def run_filter_case(
+    module: types.ModuleType,
+    target: str,
+    monitor: FakeMonitor,
+    workdir: str,
+    concurrency: int,
+    length: int,
+    args: argparse.Namespace,
+    overrides: Dict[str, str],
+) -> dict:
+    flt = make_filter(module, target, monitor, workdir, f"{concurrency}-{length}", overrides)
+
+    inlet_samples: List[float] = []
+    outlet_samples: List[float] = []
+    errors: Dict[str, int] = {}
+    next_turn = iter(range(args.turns))
+    rng = random.Random(args.seed)
+
+    async def worker() -> None:
+        for turn in next_turn:
+            user = {"id": f"user-{turn % args.users}", "name": "Bench", "email": "bench@example.com", "role": "user"}
+            message_id = f"msg-{concurrency}-{length}-{turn}"
+            metadata = {"message_id": message_id, "chat_id": f"chat-{turn % 97}"}
+            body = make_conversation(turn, length, args.message_chars)
+            try:
+                started = time.perf_counter()
+                if target == "monitor":
+                    await flt.inlet(body, __metadata__=metadata, __user__=user)
+                else:
+                    await flt.inlet(body, __user__=user)
+                inlet_samples.append(time.perf_counter() - started)
+
+                reply = {"id": message_id, "role": "assistant", "content": f"a {'x' * args.message_chars}"}
+                if rng.random() < args.usage_ratio:
+                    reply["usage"] = {"prompt_tokens": length * args.message_chars // 4, "completion_tokens": 256}
+                out_body = {**body, "messages": body["messages"] + [reply]}
+                started = time.perf_counter()
+                await flt.outlet(
+                    out_body, __metadata__=metadata, __user__=user, __event_emitter__=_noop_emitter
+                )
+                outlet_samples.append(time.perf_counter() - started)
+            except Exception as err:
+                errors[type(err).__name__] = errors.get(type(err).__name__, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    await close_filter(flt, target)
+
+    turns = [i + o for i, o in zip(inlet_samples, outlet_samples)]
+    return {
+        "inlet": summarize(inlet_samples),
+        "outlet": summarize(outlet_samples),
+        "added_per_turn": summarize(turns),
+        "throughput_turns_per_s": len(outlet_samples) / wall if wall > 0 else None,
+        "wall_s": wall,
+        "errors": errors,
+    }
+
+
+async def run_button_case(
+    module: types.ModuleType,
+    invisible: types.ModuleType,
+    workdir: str,
+    concurrency: int,
+    length: int,
+    args: argparse.Namespace,
+    overrides: Dict[str, str],
+) -> dict:
+    db_path = os.path.join(workdir, f"button-{concurrency}-{length}.db")
+    store = invisible.RecordStore(db_path)
+    now = time.time()
+    await asyncio.gather(
+        *(
+            store.put(
+                {
+                    "message_id": f"msg-{turn}",
+                    "user_id": f"user-{turn % args.users}",
+                    "chat_id": f"chat-{turn % 97}",
+                    "model": "bench-model",
+                    "created_at": now,
+                    "input_tokens": length * args.message_chars // 4,
+                    "output_tokens": 256,
+                    "total_cost": 0.01,
+                    "new_balance": 100.0,
+                    "elapsed_time": 2.0,
+                    "tokens_per_sec": 128.0,
+                }
+            )
+            for turn in range(args.turns)
+        )
+    )
+    store.close()
+
+    action = module.Action()
+    action.valves.record_db_path = db_path
+    apply_valves(action.valves, overrides)
+    samples: List[float] = []
+    errors: Dict[str, int] = {}
+    next_turn = iter(range(args.turns))
+
+    async def worker() -> None:
+        for turn in next_turn:
+            body = make_conversation(turn, length, args.message_chars)
+            body["messages"].append({"id": f"msg-{turn}", "role": "assistant", "content": "a"})
+            try:
+                started = time.perf_counter()
+                await action.action(body, {"id": f"user-{turn % args.users}"}, _noop_emitter)
+                samples.append(time.perf_counter() - started)
+            except Exception as err:
+                errors[type(err).__name__] = errors.get(type(err).__name__, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    return {
+        "action": summarize(samples),
+        "throughput_calls_per_s": len(samples) / wall if wall > 0 else None,
+        "wall_s": wall,
+        "errors": errors,
+    }
+
+
+def peak_rss_kb() -> int:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS.
+    return usage // 1024 if sys.platform == "darwin" else usage
+
+
+def parse_overrides(values: List[str]) -> Dict[str, Dict[str, str]]:
+    overrides: Dict[str, Dict[str, str]] = {target: {} for target in TARGET_FILES}
+    for item in values:
+        key, sep, value = item.partition("=")
+        target, dot, name = key.partition(".")
+        if not sep or not dot or target not in overrides:
+            raise SystemExit(f"--valve expects <target>.<name>=<value>, got {item!r}")
+        overrides[target][name] = value
+    return overrides
+
+
+def int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--targets", default="monitor,invisible,button", help="comma separated: monitor, invisible, button")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 16, 64], help="concurrent turns, comma separated")
+    parser.add_argument("--messages", type=int_list, default=[2, 40], help="messages per conversation, comma separated")
+    parser.add_argument("--message-chars", type=int, default=400, help="characters per message")
+    parser.add_argument("--turns", type=int, default=300, help="turns per case")
+    parser.add_argument("--users", type=int, default=50, help="distinct users the turns are spread over")
+    parser.add_argument("--usage-ratio", type=float, default=0.8, help="fraction of replies that carry provider usage")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fake monitor latency per request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra random latency, up to this much")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of monitor requests answered with a 500")
+    parser.add_argument("--valve", action="append", default=[], help="override a valve, e.g. monitor.async_reporting=true")
+    parser.add_argument("--tracemalloc", action="store_true", help="report allocations (slows every case down)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="keep the functions' own logging on stderr")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if not args.verbose:
+        # Injected failures would otherwise log a traceback per turn.
+        logging.disable(logging.CRITICAL)
+    targets = [t for t in args.targets.split(",") if t]
+    unknown = set(targets) - set(TARGET_FILES)
+    if unknown:
+        raise SystemExit(f"unknown targets: {', '.join(sorted(unknown))}")
+    overrides = parse_overrides(args.valve)
+    modules = {target: load_function(target) for target in targets}
+    invisible = modules.get("invisible") or (load_function("invisible") if "button" in targets else None)
+
+    monitor = FakeMonitor(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate).start()
+    workdir = tempfile.mkdtemp(prefix="owui-bench-")
+    report = {
+        "format": RESULT_FORMAT_VERSION,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "versions": {target: function_version(module) for target, module in modules.items()},
+        "config": {
+            **{key: value for key, value in vars(args).items() if key not in ("output", "valve", "verbose")},
+            "valves": {target: values for target, values in overrides.items() if values},
+        },
+        "results": [],
+    }
+    try:
+        for target in targets:
+            for length in args.messages:
+                for concurrency in args.concurrency:
+                    if args.tracemalloc:
+                        tracemalloc.start()
+                    before = dict(monitor.requests)
+                    bytes_before = monitor.request_bytes
+                    if target == "button":
+                        case = run_button_case(
+                            modules[target], invisible, workdir, concurrency, length, args, overrides[target]
+                        )
+                    else:
+                        case = run_filter_case(
+                            modules[target], target, monitor, workdir, concurrency, length, args, overrides[target]
+                        )
+                    # The functions print per-call diagnostics; keep the report on stdout clean JSON.
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                        result = asyncio.run(case)
+                    if args.tracemalloc:
+                        current, peak = tracemalloc.get_traced_memory()
+                        tracemalloc.stop()
+                        result["tracemalloc"] = {"current_bytes": current, "peak_bytes": peak}
+                    result["monitor_requests"] = {
+                        path: count - before.get(path, 0)
+                        for path, count in monitor.requests.items()
+                        if count - before.get(path, 0)
+                    }
+                    result["monitor_request_bytes"] = monitor.request_bytes - bytes_before
+                    result["peak_rss_kb"] = peak_rss_kb()
+                    report["results"].append(
+                        {"target": target, "messages": length, "concurrency": concurrency, **result}
+                    )
+    finally:
+        monitor.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,345 @@
+"""
+Replay a traffic capture against the Open WebUI filters and a local stand-in monitor.
+
+Reads the NDJSON the filters write when their capture_path valve is set (one or more files,
+e.g. one per worker), rebuilds synthetic requests of the recorded shapes (model, message
+roles and sizes, usage presence, streamed chunk count) and calls Filter.inlet, stream and
+outlet at the recorded offsets, sped up with --speed or with every turn repeated --scale
+times. Reports the latency the filter added, throughput, how far calls fell behind the
+schedule and memory, as JSON in the same style as bench_filters.py:
+
+    python scripts/replay_filters.py capture-*.ndjson --targets monitor --speed 4 --scale 2 \\
+        --latency-ms 20 --valve monitor.async_reporting=true --output replay.json
+
+Replays are deterministic: the same capture and options produce the same calls with the
+same bodies in the same order. --speed 0 replays as fast as --max-in-flight allows.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gzip
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from typing import Any, Dict, List, Optional
+
+from bench_filters import (
+    FakeMonitor,
+    close_filter,
+    function_version,
+    load_function,
+    make_filter,
+    parse_overrides,
+    peak_rss_kb,
+    summarize,
+)
+
+# Capture line format this script understands (CAPTURE_FORMAT_VERSION in the filters).
+CAPTURE_FORMAT_VERSION = 1
+RESULT_FORMAT_VERSION = 1
+FILTER_TARGETS = ("monitor", "invisible")
+ROLES = {"s": "system", "u": "user", "a": "assistant", "t": "tool"}
+FILLER = "the quick brown fox jumps over a lazy dog while billing keeps count "
+
+
+def read_capture(paths: List[str]) -> Dict[str, Any]:
+    """Pair inlet and outlet lines by hashed message id; lines without one are turns of their own."""
+    turns: Dict[str, Dict[str, Any]] = {}
+    skipped = 0
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as handle:
+            for line_no, line in enumerate(handle, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    shape = json.loads(line)
+                except ValueError:
+                    # A capture copied while a worker was appending may end mid-line.
+                    skipped += 1
+                    continue
+                if shape.get("v") != CAPTURE_FORMAT_VERSION:
+                    raise SystemExit(f"{path}:{line_no}: unsupported capture format {shape.get('v')!r}")
+                if shape.get("hook") not in ("inlet", "outlet"):
+                    skipped += 1
+                    continue
+                key = shape.get("turn") or f"{path}:{line_no}"
+                # A duplicate outlet (the filter skips it) is replayed as its own turn.
+                if shape["hook"] in turns.get(key, {}):
+                    key = f"{key}:{path}:{line_no}"
+                turns.setdefault(key, {})[shape["hook"]] = shape
+    return {"turns": turns, "skipped_lines": skipped}
+
+
+def call_started(shape: dict) -> float:
+    # ts is taken when the hook returns; ms is how long it ran.
+    return shape["ts"] - shape.get("ms", 0.0) / 1000
+
+
+def build_schedule(turns: Dict[str, Dict[str, Any]], speed: float, scale: int) -> List[Dict[str, Any]]:
+    """Turns ordered by start, with inlet/outlet offsets in replay seconds (all 0 when speed is 0)."""
+    starts = {key: call_started(hooks.get("inlet") or hooks["outlet"]) for key, hooks in turns.items()}
+    origin = min(starts.values(), default=0.0)
+    schedule = []
+    for index, key in enumerate(sorted(turns, key=lambda k: (starts[k], k))):
+        hooks = turns[key]
+        at = (starts[key] - origin) / speed if speed > 0 else 0.0
+        outlet_at = at
+        if "outlet" in hooks and speed > 0:
+            outlet_at = max(at, (call_started(hooks["outlet"]) - origin) / speed)
+        for copy in range(scale):
+            schedule.append({"index": index, "copy": copy, "at": at, "outlet_at": outlet_at, **hooks})
+    schedule.sort(key=lambda turn: (turn["at"], turn["index"], turn["copy"]))
+    return schedule
+
+
+def filler(length: int, seed: str) -> str:
+    # Distinct per message, so token caches see what they would in production, not one repeated text.
+    text = f"{seed} {FILLER}"
+    return (text * (length // len(text) + 1))[:length]
+
+
+def rebuild_body(shape: dict, turn_id: str) -> dict:
+    messages = [
+        {"role": ROLES.get(role, "user"), "content": filler(length, f"{turn_id}.{i}")}
+        for i, (role, length) in enumerate(zip(shape.get("roles") or "", shape.get("chars") or []))
+    ]
+    body: Dict[str, Any] = {"model": shape.get("model") or "bench-model", "messages": messages}
+    if shape.get("chat"):
+        body["chat_id"] = f"chat-{shape['chat']}"
+    if shape.get("task"):
+        body["task"] = shape["task"]
+    return body
+
+
+async def _noop_emitter(event: dict) -> None:
+    pass
+
+
+async def replay_target(
+    module: types.ModuleType,
+    target: str,
+    monitor: FakeMonitor,
+    workdir: str,
+    schedule: List[Dict[str, Any]],
+    args: argparse.Namespace,
+    overrides: Dict[str, str],
+) -> dict:
+    flt = make_filter(module, target, monitor, workdir, "replay", overrides)
+    samples: Dict[str, List[float]] = {"inlet": [], "stream": [], "outlet": [], "turn": [], "lag": []}
+    errors: Dict[str, int] = {}
+    in_flight = asyncio.Semaphore(args.max_in_flight) if args.max_in_flight > 0 else None
+    started = time.perf_counter()
+
+    async def wait_until(offset: float) -> None:
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def call(hook: str, coro: Any) -> float:
+        call_start = time.perf_counter()
+        try:
+            await coro
+        except Exception as err:
+            # The filters raise to reject a turn; that is a result, not a replay failure.
+            name = f"{hook}:{type(err).__name__}"
+            errors[name] = errors.get(name, 0) + 1
+        elapsed = time.perf_counter() - call_start
+        samples[hook].append(elapsed)
+        return elapsed
+
+    async def run_turn(turn: Dict[str, Any]) -> None:
+        turn_id = f"replay-{turn['index']}-{turn['copy']}"
+        shape = turn.get("inlet") or turn["outlet"]
+        user_id = f"user-{shape.get('user') or 'anonymous'}-{turn['copy']}"
+        user = {"id": user_id, "name": "Replay", "email": "replay@example.com", "role": "user"}
+        metadata = {"message_id": turn_id}
+        if shape.get("chat"):
+            metadata["chat_id"] = f"chat-{shape['chat']}"
+        if shape.get("task"):
+            metadata["task"] = shape["task"]
+        added = 0.0
+        samples["lag"].append(max(0.0, time.perf_counter() - started - turn["at"]))
+        if "inlet" in turn:
+            body = rebuild_body(turn["inlet"], turn_id)
+            if target == "monitor":
+                added += await call("inlet", flt.inlet(body, __metadata__=metadata, __user__=user))
+            else:
+                added += await call("inlet", flt.inlet(body, __user__=user, __metadata__=metadata))
+        outlet = turn.get("outlet")
+        if outlet is None:
+            samples["turn"].append(added)
+            return
+        chunks = outlet.get("chunks") or 0
+        if target == "monitor" and chunks and hasattr(flt, "stream"):
+            first = time.perf_counter() - started
+            gap = max(0.0, turn["outlet_at"] - first) / chunks
+            event = {"choices": [{"delta": {"content": "x"}}]}
+            stream_time = 0.0
+            for i in range(chunks):
+                await wait_until(first + gap * (i + 1))
+                chunk_start = time.perf_counter()
+                flt.stream(event, __metadata__=metadata)
+                stream_time += time.perf_counter() - chunk_start
+            samples["stream"].append(stream_time)
+            added += stream_time
+        await wait_until(turn["outlet_at"])
+        body = rebuild_body(outlet, turn_id)
+        if body["messages"]:
+            reply = body["messages"][-1]
+            reply["id"] = turn_id
+            if outlet.get("usage"):
+                prompt_tokens, completion_tokens = outlet["usage"]
+                reply["usage"] = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+        added += await call(
+            "outlet",
+            flt.outlet(body, __metadata__=metadata, __user__=user, __event_emitter__=_noop_emitter),
+        )
+        samples["turn"].append(added)
+
+    async def guarded(turn: Dict[str, Any]) -> None:
+        try:
+            await run_turn(turn)
+        finally:
+            if in_flight is not None:
+                in_flight.release()
+
+    pending = set()
+    for turn in schedule:
+        await wait_until(turn["at"])
+        if in_flight is not None:
+            await in_flight.acquire()
+        task = asyncio.get_running_loop().create_task(guarded(turn))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    await asyncio.gather(*pending)
+    wall = time.perf_counter() - started
+    await close_filter(flt, target)
+
+    span = schedule[-1]["outlet_at"] if schedule else 0.0
+    return {
+        "inlet": summarize(samples["inlet"]),
+        "stream_per_turn": summarize(samples["stream"]),
+        "outlet": summarize(samples["outlet"]),
+        "added_per_turn": summarize(samples["turn"]),
+        "schedule_lag": summarize(samples["lag"]),
+        "throughput_turns_per_s": len(samples["turn"]) / wall if wall > 0 else None,
+        "scheduled_turns_per_s": len(schedule) / span if span > 0 else None,
+        "wall_s": wall,
+        "errors": errors,
+    }
+
+
+def captured_latency(turns: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Hook times recorded in production, to compare the replay against."""
+    result = {}
+    for hook in ("inlet", "outlet"):
+        result[hook] = summarize([hooks[hook]["ms"] / 1000 for hooks in turns.values() if "ms" in hooks.get(hook, {})])
+    return result
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("captures", nargs="+", help="capture files written by the capture_path valve (.gz is fine)")
+    parser.add_argument("--targets", default="monitor", help="comma separated: monitor, invisible")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay this many times faster than recorded (0 = no waiting)")
+    parser.add_argument("--scale", type=int, default=1, help="replay every turn this many times, as distinct users")
+    parser.add_argument("--max-turns", type=int, default=0, help="replay only the first N captured turns (0 = all)")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="cap on concurrently replayed turns (0 = no cap)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fake monitor latency per request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra random latency, up to this much")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of monitor requests answered with a 500")
+    parser.add_argument("--valve", action="append", default=[], help="override a valve, e.g. monitor.async_reporting=true")
+    parser.add_argument("--tracemalloc", action="store_true", help="report allocations (slows the replay down)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the fake monitor's jitter and error injection")
+    parser.add_argument("--verbose", action="store_true", help="keep the functions' own logging on stderr")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    if args.speed < 0 or args.scale < 1:
+        parser.error("--speed must be >= 0 and --scale >= 1")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    targets = [t for t in args.targets.split(",") if t]
+    unknown = set(targets) - set(FILTER_TARGETS)
+    if unknown:
+        raise SystemExit(f"unknown targets: {', '.join(sorted(unknown))}")
+    overrides = parse_overrides(args.valve)
+    capture = read_capture(args.captures)
+    turns = capture["turns"]
+    if args.max_turns > 0:
+        first = sorted(turns, key=lambda k: call_started(turns[k].get("inlet") or turns[k]["outlet"]))[: args.max_turns]
+        turns = {key: turns[key] for key in first}
+    schedule = build_schedule(turns, args.speed, args.scale)
+    modules = {target: load_function(target) for target in targets}
+
+    random.seed(args.seed)
+    monitor = FakeMonitor(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate).start()
+    workdir = tempfile.mkdtemp(prefix="owui-replay-")
+    report = {
+        "format": RESULT_FORMAT_VERSION,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "versions": {target: function_version(module) for target, module in modules.items()},
+        "config": {
+            **{key: value for key, value in vars(args).items() if key not in ("output", "valve", "verbose")},
+            "valves": {target: values for target, values in overrides.items() if values},
+        },
+        "capture": {
+            "turns": len(turns),
+            "replayed_turns": len(schedule),
+            "skipped_lines": capture["skipped_lines"],
+            "captured": captured_latency(turns),
+        },
+        "results": [],
+    }
+    try:
+        for target in targets:
+            if args.tracemalloc:
+                tracemalloc.start()
+            before = dict(monitor.requests)
+            bytes_before = monitor.request_bytes
+            case = replay_target(modules[target], target, monitor, workdir, schedule, args, overrides[target])
+            # The functions print per-call diagnostics; keep the report on stdout clean JSON.
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                result = asyncio.run(case)
+            if args.tracemalloc:
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                result["tracemalloc"] = {"current_bytes": current, "peak_bytes": peak}
+            result["monitor_requests"] = {
+                path: count - before.get(path, 0) for path, count in monitor.requests.items() if count - before.get(path, 0)
+            }
+            result["monitor_request_bytes"] = monitor.request_bytes - bytes_before
+            result["peak_rss_kb"] = peak_rss_kb()
+            report["results"].append({"target": target, **result})
+    finally:
+        monitor.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
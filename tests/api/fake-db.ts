@@ -0,0 +1,192 @@
+/**
+ * In-memory stand-in for the tables the outlet routes touch.
+ *
+ * It understands only the statements those routes send. Each connection keeps
+ * an undo log, so BEGIN, SAVEPOINT, ROLLBACK TO SAVEPOINT and ROLLBACK behave
+ * like Postgres for this connection's writes. `beforeInsert` runs before each
+ * usage record insert and can commit rows as a concurrent transaction would.
+ * `chatTotals` holds chat_token_totals rows by "user:chat".
+ */
+export interface UsageRow {
+  user_id: string;
+  nickname: string;
+  model_name: string;
+  input_tokens: number;
+  output_tokens: number;
+  cost: number;
+  balance_after: number;
+  idempotency_key: string | null;
+}
+
+type Undo = () => void;
+
+export interface ChatTotalsRow {
+  message_count: number;
+  fingerprint: string;
+  tokens: number;
+}
+
+export class FakeDb {
+  balances = new Map<string, number>();
+  records: UsageRow[] = [];
+  chatTotals = new Map<string, ChatTotalsRow>();
+  beforeInsert: ((rows: UsageRow[]) => void) | null = null;
+
+  reset(balances: Record<string, number>) {
+    this.balances = new Map(Object.entries(balances));
+    this.records = [];
+    this.chatTotals = new Map();
+    this.beforeInsert = null;
+  }
+
+  connect(): FakeConnection {
+    return new FakeConnection(this);
+  }
+
+  /** Commit a record outside any connection, like a concurrent request. */
+  commitRecord(row: Partial<UsageRow> & { user_id: string }) {
+    this.records.push({
+      nickname: "Concurrent",
+      model_name: "m",
+      input_tokens: 1,
+      output_tokens: 1,
+      cost: 0,
+      balance_after: this.balances.get(row.user_id) ?? 0,
+      idempotency_key: null,
+      ...row,
+    });
+  }
+}
+
+class FakeConnection {
+  private log: Undo[] = [];
+  private savepoints = new Map<string, number>();
+
+  constructor(private db: FakeDb) {}
+
+  release() {}
+
+  async query(text: string, params: any[] = []) {
+    const sql = text.replace(/\s+/g, " ").trim();
+
+    if (sql === "BEGIN" || sql === "COMMIT") {
+      this.log = [];
+      this.savepoints.clear();
+      return { rows: [], rowCount: 0 };
+    }
+    if (sql === "ROLLBACK") {
+      this.undoTo(0);
+      return { rows: [], rowCount: 0 };
+    }
+    const savepoint = /^SAVEPOINT (\w+)$/.exec(sql);
+    if (savepoint) {
+      this.savepoints.set(savepoint[1], this.log.length);
+      return { rows: [], rowCount: 0 };
+    }
+    const rollbackTo = /^ROLLBACK TO SAVEPOINT (\w+)$/.exec(sql);
+    if (rollbackTo) {
+      this.undoTo(this.savepoints.get(rollbackTo[1])!);
+      return { rows: [], rowCount: 0 };
+    }
+
+    if (sql.includes("FROM model_prices")) {
+      return { rows: [], rowCount: 0 };
+    }
+    if (sql.includes("FROM user_usage_records WHERE (user_id, idempotency_key) IN")) {
+      const [userIds, keys] = params as [string[], string[]];
+      const rows = this.db.records.filter((record) =>
+        userIds.some(
+          (userId, i) =>
+            record.user_id === userId && record.idempotency_key === keys[i]
+        )
+      );
+      return { rows, rowCount: rows.length };
+    }
+    if (sql.includes("FROM chat_token_totals")) {
+      const [userIds, chatIds] = params as [string[], string[]];
+      const rows = userIds.flatMap((userId, i) => {
+        const row = this.db.chatTotals.get(`${userId}:${chatIds[i]}`);
+        return row ? [{ user_id: userId, chat_id: chatIds[i], ...row }] : [];
+      });
+      return { rows, rowCount: rows.length };
+    }
+    if (sql.startsWith("INSERT INTO chat_token_totals")) {
+      const [userIds, chatIds, counts, fingerprints, tokens] = params;
+      userIds.forEach((userId: string, i: number) => {
+        this.db.chatTotals.set(`${userId}:${chatIds[i]}`, {
+          message_count: counts[i],
+          fingerprint: fingerprints[i],
+          tokens: tokens[i],
+        });
+      });
+      return { rows: [], rowCount: userIds.length };
+    }
+    if (sql.startsWith("UPDATE users") && sql.includes("unnest")) {
+      const [ids, costs] = params as [string[], number[]];
+      const rows = ids.flatMap((id, i) => {
+        const balance = this.debit(id, Number(costs[i]));
+        return balance === undefined ? [] : [{ id, balance }];
+      });
+      return { rows, rowCount: rows.length };
+    }
+    if (sql.startsWith("UPDATE users")) {
+      const balance = this.debit(params[1], Number(params[0]));
+      const rows = balance === undefined ? [] : [{ balance }];
+      return { rows, rowCount: rows.length };
+    }
+    if (sql.startsWith("INSERT INTO user_usage_records")) {
+      const columns = sql.includes("unnest")
+        ? params
+        : params.map((value) => [value]);
+      const rows: UsageRow[] = columns[0].map((_: unknown, i: number) => ({
+        user_id: columns[0][i],
+        nickname: columns[1][i],
+        model_name: columns[2][i],
+        input_tokens: columns[3][i],
+        output_tokens: columns[4][i],
+        cost: columns[5][i],
+        balance_after: columns[6][i],
+        idempotency_key: columns[10][i],
+      }));
+      this.db.beforeInsert?.(rows);
+      rows.forEach((row) => {
+        const taken = this.db.records.some(
+          (record) =>
+            row.idempotency_key !== null &&
+            record.user_id === row.user_id &&
+            record.idempotency_key === row.idempotency_key
+        );
+        if (taken) {
+          throw Object.assign(
+            new Error("duplicate key value violates unique constraint"),
+            { code: "23505" }
+          );
+        }
+      });
+      const records = this.db.records;
+      records.push(...rows);
+      this.log.push(() => {
+        rows.forEach((row) => records.splice(records.indexOf(row), 1));
+      });
+      return { rows: [], rowCount: rows.length };
+    }
+    throw new Error(`FakeDb does not understand: ${sql}`);
+  }
+
+  private debit(id: string, cost: number): number | undefined {
+    const before = this.db.balances.get(id);
+    if (before === undefined) {
+      return undefined;
+    }
+    const after = Math.min(before - cost, 999999.9999);
+    this.db.balances.set(id, after);
+    this.log.push(() => this.db.balances.set(id, before));
+    return after;
+  }
+
+  private undoTo(length: number) {
+    while (this.log.length > length) {
+      this.log.pop()!();
+    }
+  }
+}
@@ -0,0 +1,180 @@
+import { beforeEach, test } from "node:test";
+import assert from "node:assert/strict";
+import { Pool } from "pg";
+import { encode } from "gpt-tokenizer/model/gpt-4";
+import { FakeDb } from "./fake-db";
+import { POST as outlet } from "@/app/api/v1/outlet/route";
+import { POST as outletBatch } from "@/app/api/v1/outlet/batch/route";
+import { chainFingerprint } from "@/lib/utils/chat-delta";
+
+const db = new FakeDb();
+// getClient() builds a pg Pool lazily; every connection it hands out is fake.
+Pool.prototype.connect = async function () {
+  return db.connect();
+} as unknown as Pool["connect"];
+
+// 1000 input and 1000 output tokens at the default 60/60 per million.
+const TURN_COST = 0.12;
+
+function event(userId: string, key?: string, extra: object = {}) {
+  return {
+    version: 2,
+    user: { id: userId, name: userId },
+    model: "m",
+    usage: { prompt_tokens: 1000, completion_tokens: 1000 },
+    ...(key ? { idempotency_key: key } : {}),
+    ...extra,
+  };
+}
+
+function post(body: unknown) {
+  return new Request("http://monitor.test/api/v1/outlet", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(body),
+  });
+}
+
+function assertClose(actual: number | undefined, expected: number) {
+  assert.ok(
+    actual !== undefined && Math.abs(actual - expected) < 1e-9,
+    `${actual} != ${expected}`
+  );
+}
+
+beforeEach(() => {
+  db.reset({ u1: 10, u2: 5 });
+  delete process.env.COST_ON_INLET;
+});
+
+test("a repeated outlet returns the original result and bills once", async () => {
+  const first = await (await outlet(post(event("u1", "k1")))).json();
+  const second = await (await outlet(post(event("u1", "k1")))).json();
+
+  assert.equal(first.success, true);
+  assert.equal(second.duplicate, true);
+  assertClose(second.newBalance, first.newBalance);
+  assertClose(db.balances.get("u1"), 10 - TURN_COST);
+  assert.equal(db.records.length, 1);
+});
+
+test("an outlet losing the race to a concurrent retry answers as a duplicate", async () => {
+  db.beforeInsert = () => {
+    db.beforeInsert = null;
+    db.commitRecord({ user_id: "u1", idempotency_key: "k1", cost: TURN_COST });
+  };
+
+  const response = await outlet(post(event("u1", "k1")));
+  const body = await response.json();
+
+  assert.equal(response.status, 200);
+  assert.equal(body.duplicate, true);
+  assertClose(db.balances.get("u1"), 10);
+  assert.equal(db.records.length, 1);
+});
+
+test("inlet_skipped outlets are billed the inlet cost too", async () => {
+  process.env.COST_ON_INLET = "0.05";
+
+  await outlet(post(event("u1", "k1")));
+  await outlet(post(event("u1", "k2", { inlet_skipped: true })));
+
+  assertClose(db.balances.get("u1"), 10 - (TURN_COST - 0.05) - TURN_COST);
+});
+
+test("a batch bills what it can and reports the rest per event", async () => {
+  db.commitRecord({ user_id: "u1", idempotency_key: "old", cost: 1 });
+
+  const response = await outletBatch(
+    post({
+      events: [
+        event("u1", "k1"),
+        event("u1", "old"),
+        event("u1", "k1"),
+        event("nobody", "k2"),
+        { version: 2, user: { id: "u2" }, model: "m" },
+        event("u2"),
+        event("u1", "k3"),
+      ],
+    })
+  );
+  const { results } = await response.json();
+
+  assert.equal(response.status, 200);
+  assert.deepEqual(
+    results.map((r: any) => (r.duplicate ? "duplicate" : r.success)),
+    [true, "duplicate", false, false, false, true, true]
+  );
+  assert.match(results[2].error, /repeats an idempotency key/);
+  assert.equal(results[3].error, "User does not exist");
+  // balance_after follows each user's events in order.
+  assertClose(results[0].newBalance, 10 - TURN_COST);
+  assertClose(results[6].newBalance, 10 - 2 * TURN_COST);
+  assertClose(db.balances.get("u1"), 10 - 2 * TURN_COST);
+  assertClose(db.balances.get("u2"), 5 - TURN_COST);
+});
+
+test("a batch racing a concurrent delivery keeps the rest of the batch", async () => {
+  db.beforeInsert = () => {
+    db.beforeInsert = null;
+    db.commitRecord({ user_id: "u1", idempotency_key: "k2", cost: TURN_COST });
+  };
+
+  const response = await outletBatch(
+    post({ events: [event("u1", "k1"), event("u1", "k2"), event("u2", "k3")] })
+  );
+  const { results } = await response.json();
+
+  assert.equal(response.status, 200);
+  assert.deepEqual(
+    results.map((r: any) => (r.duplicate ? "duplicate" : r.success)),
+    [true, "duplicate", true]
+  );
+  assertClose(db.balances.get("u1"), 10 - TURN_COST);
+  assertClose(db.balances.get("u2"), 5 - TURN_COST);
+  assert.deepEqual(
+    db.records.map((r) => r.idempotency_key).sort(),
+    ["k1", "k2", "k3"]
+  );
+});
+
+test("a delta upload continues a chat whose last turn another replica billed", async () => {
+  const history = [
+    { role: "user", content: "hello there" },
+    { role: "assistant", content: "hi" },
+  ];
+  const prefixHash = history.reduce(
+    (previous, msg) => chainFingerprint(previous, msg.role, msg.content),
+    ""
+  );
+  // Written by the replica that billed the first turn; this one never saw the chat.
+  db.chatTotals.set("u1:c1", {
+    message_count: 2,
+    fingerprint: prefixHash,
+    tokens: 40,
+  });
+  const delta = {
+    chat_id: "c1",
+    prefix_count: 2,
+    prefix_hash: prefixHash,
+    messages: [
+      { role: "user", content: "and again" },
+      { role: "assistant", content: "sure" },
+    ],
+  };
+
+  const response = await outlet(
+    post({ ...event("u1", "k1"), usage: undefined, delta })
+  );
+  const body = await response.json();
+
+  assert.equal(response.status, 200);
+  assert.equal(body.inputTokens, 40 + encode("and again").length);
+  assert.equal(db.chatTotals.get("u1:c1")?.message_count, 4);
+
+  // That prefix is stale now, so the filter is asked for the whole conversation.
+  const stale = await outlet(
+    post({ ...event("u1", "k2"), usage: undefined, delta })
+  );
+  assert.equal(stale.status, 409);
+});
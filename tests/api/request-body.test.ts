@@ -0,0 +1,45 @@
+import { test } from "node:test";
+import assert from "node:assert/strict";
+import { gzipSync } from "zlib";
+import { POST as outlet } from "@/app/api/v1/outlet/route";
+import { POST as outletBatch } from "@/app/api/v1/outlet/batch/route";
+
+function post(body: string | Buffer, encoding?: string) {
+  return new Request("http://monitor.test/api/v1/outlet", {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+      ...(encoding ? { "Content-Encoding": encoding } : {}),
+    },
+    body,
+  });
+}
+
+// Both routes fail before touching the database, so no FakeDb is needed.
+for (const [name, route] of [
+  ["outlet", outlet],
+  ["outlet batch", outletBatch],
+] as const) {
+  test(`${name} answers 400 to a gzip body that is not JSON`, async () => {
+    const response = await route(post(gzipSync("{not json"), "gzip"));
+    const body = await response.json();
+
+    assert.equal(response.status, 400);
+    assert.equal(body.success, false);
+    assert.equal(body.error_type, "INVALID_JSON");
+  });
+
+  test(`${name} answers 400 to a body that is not gzip`, async () => {
+    const response = await route(post("{}", "gzip"));
+
+    assert.equal(response.status, 400);
+    assert.equal((await response.json()).error_type, "INVALID_BODY_ENCODING");
+  });
+
+  test(`${name} answers 400 to a plain body that is not JSON`, async () => {
+    const response = await route(post("{not json"));
+
+    assert.equal(response.status, 400);
+    assert.equal((await response.json()).error_type, "INVALID_JSON");
+  });
+}
@@ -0,0 +1,223 @@
+"""
+Shared fixtures for the Open WebUI functions in resources/functions.
+
+The functions are single files loaded by Open WebUI, so they are imported here by path.
+Monitor calls never leave the process: ``monitor`` swaps the functions' httpx client for
+one backed by ``FakeMonitor``, which bills like the Next.js routes do (inlet cost charged
+on inlet and deducted again on outlet unless the turn was admitted without an inlet call).
+
+Run from the repository root with ``python -m pytest tests/functions`` after
+``pip install httpx pydantic pytest``; Open WebUI itself is not needed.
+"""
+
+import asyncio
+import gzip
+import importlib.util
+import json
+import os
+import time
+import types
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+import pytest
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "resources", "functions")
+FUNCTION_FILES = {
+    "monitor": "openwebui_monitor.py",
+    "invisible": "openwebui_monitor_invisible.py",
+    "button": "get_usage_button.py",
+}
+MONITOR_URL = "http://monitor.test"
+
+
+def load_function(name: str) -> types.ModuleType:
+    path = os.path.join(FUNCTIONS_DIR, FUNCTION_FILES[name])
+    spec = importlib.util.spec_from_file_location(f"owui_{name}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def monitor_module() -> types.ModuleType:
+    return load_function("monitor")
+
+
+@pytest.fixture(scope="session")
+def invisible_module() -> types.ModuleType:
+    return load_function("invisible")
+
+
+@pytest.fixture(scope="session")
+def button_module() -> types.ModuleType:
+    return load_function("button")
+
+
+def run(coro: Any) -> Any:
+    return asyncio.run(coro)
+
+
+async def wait_until(predicate: Callable[[], bool], timeout: float = 2.0) -> None:
+    """Poll for work done by background tasks (reporter, record writes)."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError("condition not reached in time")
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Manual ``time.monotonic`` for synchronous tests; advance it with ``clock[0] += seconds``."""
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    return now
+
+
+class FakeMonitor:
+    """
+    In-process stand-in for the monitor's /api/v1 routes.
+
+    Every turn costs ``turn_cost``. ``inlet_costs`` is COST_ON_INLET (``"default"`` for
+    models without an entry) and is published by the price route unless
+    ``publish_inlet_costs`` is off, as with monitors that predate it. Set ``down`` to make
+    every call fail to connect, or ``fail`` to ``{path: status}`` to answer with an error.
+    """
+
+    def __init__(self):
+        self.balances: Dict[str, float] = {}
+        self.initial_balance = 10.0
+        self.turn_cost = 1.0
+        self.inlet_costs: Dict[str, float] = {}
+        self.publish_inlet_costs = True
+        self.down = False
+        self.fail: Dict[str, int] = {}
+        self.requests: List[Dict[str, Any]] = []
+        self.billed: Dict[str, Dict[str, Any]] = {}
+        self.handlers: Dict[str, Callable[[dict], httpx.Response]] = {}
+
+    def calls(self, path: str) -> List[dict]:
+        return [r["json"] for r in self.requests if r["path"] == path]
+
+    def inlet_cost(self, model: Optional[str]) -> float:
+        return self.inlet_costs.get(model, self.inlet_costs.get("default", 0.0))
+
+    def balance(self, user_id: str) -> float:
+        return self.balances.get(user_id, self.initial_balance)
+
+    def _bill(self, data: dict) -> dict:
+        user_id = (data.get("user") or {}).get("id", "default")
+        model = data.get("model") or (data.get("body") or {}).get("model")
+        key = data.get("idempotency_key")
+        if key and (user_id, key) in self.billed:
+            return {**self.billed[(user_id, key)], "duplicate": True}
+        inlet_cost = 0.0 if data.get("inlet_skipped") else self.inlet_cost(model)
+        self.balances[user_id] = self.balance(user_id) - (self.turn_cost - inlet_cost)
+        result = {
+            "success": True,
+            "inputTokens": 10,
+            "outputTokens": 20,
+            "totalCost": self.turn_cost,
+            "newBalance": self.balances[user_id],
+        }
+        if key:
+            self.billed[(user_id, key)] = result
+        return result
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        if self.down:
+            raise httpx.ConnectError("monitor down", request=request)
+        path = request.url.path
+        raw = request.content
+        if request.headers.get("Content-Encoding") == "gzip":
+            raw = gzip.decompress(raw)
+        data = json.loads(raw) if raw else None
+        self.requests.append({"method": request.method, "path": path, "json": data, "headers": dict(request.headers)})
+        if path in self.fail:
+            return httpx.Response(self.fail[path], json={"success": False, "error": "injected"})
+        if path in self.handlers:
+            return self.handlers[path](data)
+        if path == "/api/v1/models/prices":
+            table = {
+                "success": True,
+                "version": "v1",
+                "models": [],
+                "default": {"input_price": 60, "output_price": 60},
+            }
+            if self.publish_inlet_costs:
+                costs = dict(self.inlet_costs)
+                table["inlet_cost"] = {"default": costs.pop("default", 0.0), "models": costs}
+            return httpx.Response(200, json=table, headers={"ETag": '"v1"'})
+        if path == "/api/v1/inlet":
+            user_id = (data.get("user") or {}).get("id", "default")
+            model = data.get("model") or (data.get("body") or {}).get("model")
+            cost = self.inlet_cost(model)
+            self.balances[user_id] = self.balance(user_id) - cost
+            reply = {"success": True, "balance": self.balances[user_id]}
+            if cost > 0:
+                reply["inlet_cost"] = cost
+            return httpx.Response(200, json=reply)
+        if path == "/api/v1/outlet":
+            return httpx.Response(200, json=self._bill(data))
+        if path == "/api/v1/outlet/batch":
+            return httpx.Response(200, json={"success": True, "results": [self._bill(e) for e in data["events"]]})
+        return httpx.Response(404, json={"success": False, "error": "not found"})
+
+
+@pytest.fixture
+def monitor(monkeypatch, monitor_module, invisible_module) -> FakeMonitor:
+    fake = FakeMonitor()
+    real_client = httpx.AsyncClient
+
+    def client(**kwargs):
+        kwargs.pop("limits", None)
+        kwargs.pop("http2", None)
+        return real_client(transport=httpx.MockTransport(fake.handle), **kwargs)
+
+    monkeypatch.setattr(monitor_module, "AsyncClient", client)
+    monkeypatch.setattr(invisible_module.httpx, "AsyncClient", client)
+    return fake
+
+
+@pytest.fixture
+def make_monitor_filter(monitor_module, tmp_path):
+    def make(**valves):
+        flt = monitor_module.Filter()
+        flt.valves.api_endpoint = MONITOR_URL
+        flt.valves.api_key = "test"
+        flt.valves.report_spool_path = str(tmp_path / "spool.ndjson")
+        for key, value in valves.items():
+            setattr(flt.valves, key, value)
+        return flt
+
+    return make
+
+
+@pytest.fixture
+def make_invisible_filter(invisible_module, tmp_path):
+    def make(**valves):
+        flt = invisible_module.Filter()
+        flt.valves.API_ENDPOINT = MONITOR_URL
+        flt.valves.API_KEY = "test"
+        flt.valves.record_db_path = str(tmp_path / "records.db")
+        for key, value in valves.items():
+            setattr(flt.valves, key, value)
+        return flt
+
+    return make
+
+
+def user(user_id: str = "u1") -> dict:
+    return {"id": user_id, "name": "Test", "email": "test@example.com", "role": "user"}
+
+
+def conversation(model: str = "m", reply: Optional[str] = None, usage: bool = True) -> dict:
+    messages = [{"role": "user", "content": "hello there"}]
+    if reply is not None:
+        message = {"role": "assistant", "content": reply}
+        if usage:
+            message["usage"] = {"prompt_tokens": 10, "completion_tokens": 20}
+        messages.append(message)
+    return {"model": model, "chat_id": "c1", "messages": messages}
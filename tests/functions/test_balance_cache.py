@@ -0,0 +1,64 @@
+import pytest
+
+
+@pytest.fixture
+def cache(monitor_module, clock):
+    cache = monitor_module.BalanceCache()
+    cache.seed("u1", 10.0)
+    return cache
+
+
+def test_reservations_count_against_the_balance_until_released(cache):
+    assert cache.reserve("u1", "t1", 4.0, ttl=60) == 6.0
+    assert cache.reserve("u1", "t2", 4.0, ttl=60) == 2.0
+    # A third turn would leave nothing above the floor.
+    assert cache.reserve("u1", "t3", 4.0, ttl=60, floor=0.0) is None
+    assert cache.available(cache.peek("u1")) == 2.0
+
+    assert cache.release("u1", "t1") == 4.0
+    assert cache.available(cache.peek("u1")) == 6.0
+    assert cache.peek("u1")["balance"] == 10.0
+
+
+def test_reserving_the_same_turn_again_replaces_its_hold(cache):
+    cache.reserve("u1", "t1", 4.0, ttl=60)
+    assert cache.reserve("u1", "t1", 7.0, ttl=60) == 3.0
+    assert cache.available(cache.peek("u1")) == 3.0
+
+
+def test_debited_release_keeps_the_amount_spent_until_the_next_seed(cache):
+    cache.reserve("u1", "t1", 4.0, ttl=60)
+    cache.reserve("u1", "t2", 1.0, ttl=60)
+    assert cache.release("u1", "t1", debit=True) == 4.0
+    assert cache.peek("u1")["balance"] == 6.0
+    # A fresh balance from the monitor replaces the debit but keeps turns still in flight.
+    cache.seed("u1", 9.0)
+    assert cache.available(cache.peek("u1")) == 8.0
+
+
+def test_expired_reservations_stop_counting(cache, clock):
+    cache.reserve("u1", "t1", 4.0, ttl=30)
+    clock[0] += 30
+    assert cache.available(cache.peek("u1")) == 10.0
+    assert cache.release("u1", "t1") == 0.0
+
+
+def test_reserve_needs_a_known_balance(cache):
+    assert cache.reserve("u2", "t1", 1.0, ttl=60) is None
+    assert cache.release("u2", "t1") == 0.0
+
+
+def test_workers_sharing_a_backend_see_each_others_reservations(monitor_module, tmp_path):
+    backend = monitor_module.SQLiteStateBackend(str(tmp_path / "state.db"))
+    workers = []
+    for _ in range(2):
+        entries = monitor_module.SharedMap("balance")
+        entries.backend = backend
+        workers.append(monitor_module.BalanceCache(entries))
+    first, second = workers
+    first.seed("u1", 10.0)
+
+    assert first.reserve("u1", "t1", 6.0, ttl=60) == 4.0
+    assert second.reserve("u1", "t2", 6.0, ttl=60) is None
+    first.release("u1", "t1")
+    assert second.reserve("u1", "t2", 6.0, ttl=60) == 4.0
@@ -0,0 +1,67 @@
+import pytest
+
+A, B = "http://a.monitor.test", "http://b.monitor.test"
+
+
+@pytest.fixture(params=["monitor_module", "invisible_module"])
+def pool(request, clock):
+    pool = request.getfixturevalue(request.param).EndpointPool()
+    pool.configure(f"{A}, {B}/", "least_outstanding", eject_after=2, eject_seconds=10.0)
+    return pool
+
+
+def call(pool, outage, exclude=()):
+    endpoint = pool.pick(exclude)
+    endpoint.outstanding += 1
+    pool.finish(endpoint, 0.1, outage)
+    return endpoint.url
+
+
+def fail(pool, url, times):
+    for _ in range(times):
+        call(pool, True, exclude=tuple(u for u in pool.endpoints if u != url))
+
+
+def test_least_outstanding_prefers_the_idle_replica(pool):
+    pool.endpoints[A].outstanding = 2
+    assert pool.pick().url == B
+    assert pool.pick(exclude=(B,)).url == A
+
+
+def test_failing_replica_is_ejected_with_doubling_backoff(pool, clock):
+    fail(pool, A, 2)
+    assert pool.endpoints[A].ejected_until == clock[0] + 10.0
+    assert {pool.pick().url for _ in range(20)} == {B}
+
+    clock[0] += 10.0
+    fail(pool, A, 2)
+    assert pool.endpoints[A].ejected_until == clock[0] + 20.0
+
+    clock[0] += 20.0
+    call(pool, False, exclude=(B,))
+    assert pool.endpoints[A].ejections == 0 and pool.endpoints[A].ejected_until == 0.0
+
+
+def test_all_ejected_uses_the_one_due_back_first(pool, clock):
+    fail(pool, A, 2)
+    clock[0] += 1.0
+    fail(pool, B, 2)
+    assert pool.pick().url == A
+
+
+def test_cancelled_calls_say_nothing_about_health(pool):
+    for _ in range(5):
+        call(pool, None, exclude=(B,))
+    assert pool.endpoints[A].failures == 0 and pool.endpoints[A].outstanding == 0
+
+
+def test_single_replica_is_never_ejected(pool):
+    pool.configure(A, "least_outstanding", eject_after=1, eject_seconds=10.0)
+    call(pool, True)
+    assert pool.endpoints[A].ejected_until == 0.0
+
+
+def test_reconfiguring_keeps_state_of_remaining_replicas(pool):
+    fail(pool, A, 1)
+    pool.configure(A, "ewma", eject_after=2, eject_seconds=10.0)
+    assert list(pool.endpoints) == [A] and pool.endpoints[A].failures == 1
@@ -0,0 +1,71 @@
+from conftest import conversation, run, user
+
+
+def inlet_body(model: str) -> dict:
+    body = conversation(model)
+    # Open WebUI injects the system prompt on inlet only; the outlet sees the stored chat.
+    body["messages"].insert(0, {"role": "system", "content": "be brief"})
+    return body
+
+
+async def play_turn(flt, message_id: str, model: str, usage: bool) -> dict:
+    metadata = {"message_id": message_id, "chat_id": "c1"}
+    await flt.inlet(inlet_body(model), __user__=user(), __metadata__=metadata)
+    stored = flt._turns.get(f"message:{message_id}")
+    await flt.outlet(conversation(model, reply="hi", usage=usage), __user__=user(), __metadata__=metadata)
+    return stored
+
+
+def test_history_is_kept_only_for_models_without_usage(monitor, make_invisible_filter):
+    flt = make_invisible_filter(compact_payload=True)
+
+    async def scenario():
+        first = await play_turn(flt, "t1", "with-usage", usage=True)
+        second = await play_turn(flt, "t2", "with-usage", usage=True)
+        third = await play_turn(flt, "t3", "no-usage", usage=False)
+        fourth = await play_turn(flt, "t4", "no-usage", usage=False)
+        return first, second, third, fourth
+
+    first, second, third, fourth = run(scenario())
+    # Nothing is known about a model until its first outlet, so that turn keeps the history.
+    assert len(first["messages"]) == 2
+    assert "messages" not in second and "start_time" in second
+    assert len(third["messages"]) == 2 and len(fourth["messages"]) == 2
+    outlets = monitor.calls("/api/v1/outlet")
+    assert "messages" not in outlets[1] and outlets[1]["usage"]["completion_tokens"] == 20
+    # Without usage the monitor counts tokens over the inlet history plus the reply.
+    assert [m["role"] for m in outlets[3]["messages"]] == ["system", "user", "assistant"]
+
+
+def test_full_payload_sends_outlet_messages_once_usage_is_known(monitor, make_invisible_filter):
+    flt = make_invisible_filter(compact_payload=False)
+
+    async def scenario():
+        await play_turn(flt, "t1", "m", usage=True)
+        return await play_turn(flt, "t2", "m", usage=True)
+
+    second = run(scenario())
+    assert "messages" not in second
+    first_body, second_body = (o["body"] for o in monitor.calls("/api/v1/outlet"))
+    assert [m["role"] for m in first_body["messages"]] == ["system", "user", "assistant"]
+    assert [m["role"] for m in second_body["messages"]] == ["user", "assistant"]
+    assert second_body["messages"][-1]["usage"]["prompt_tokens"] == 10
+
+
+def test_delta_uploads_continue_a_chat_reported_by_another_worker(monitor, make_invisible_filter):
+    # Two Open WebUI workers share the records database, and with it the reported prefixes.
+    first, second = (make_invisible_filter(compact_payload=True, delta_upload=True) for _ in range(2))
+    history = [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "hi"}]
+
+    async def scenario():
+        await first._post_outlet({"version": 2, "messages": list(history)}, "u1:c1")
+        more = history + [{"role": "user", "content": "again"}, {"role": "assistant", "content": "sure"}]
+        await second._post_outlet({"version": 2, "messages": more}, "u1:c1")
+        for flt in (first, second):
+            flt._get_record_store().close()
+
+    run(scenario())
+    first_delta, second_delta = (o["delta"] for o in monitor.calls("/api/v1/outlet"))
+    assert first_delta["prefix_count"] == 0 and len(first_delta["messages"]) == 2
+    assert second_delta["prefix_count"] == 2
+    assert [m["content"] for m in second_delta["messages"]] == ["again", "sure"]
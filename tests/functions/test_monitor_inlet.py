@@ -0,0 +1,157 @@
+import threading
+
+import httpx
+import pytest
+
+from conftest import conversation, run, user, wait_until
+
+
+async def play_turn(flt, message_id: str, model: str = "m", user_id: str = "u1") -> None:
+    metadata = {"message_id": message_id, "chat_id": "c1"}
+    await flt.inlet(conversation(model), __metadata__=metadata, __user__=user(user_id))
+    await flt.outlet(conversation(model, reply="hi"), __metadata__=metadata, __user__=user(user_id))
+
+
+def payload_model(data: dict) -> str:
+    return data["model"] if "model" in data else data["body"]["model"]
+
+
+def inlet_models(monitor) -> list:
+    return [payload_model(c) for c in monitor.calls("/api/v1/inlet")]
+
+
+async def prices_loaded(flt) -> None:
+    if flt._prices_task is not None:
+        await flt._prices_task
+
+
+def test_cached_inlet_skips_only_models_without_inlet_cost(monitor, make_monitor_filter):
+    monitor.inlet_costs = {"paid": 0.5}
+    flt = make_monitor_filter(balance_cache_ttl=30.0)
+
+    async def scenario():
+        await play_turn(flt, "t1", model="free")
+        await prices_loaded(flt)
+        await play_turn(flt, "t2", model="free")
+        # Regression: a balance seeded on a free model must not admit a model with an inlet cost.
+        await play_turn(flt, "t3", model="paid")
+        await flt.close()
+
+    run(scenario())
+    assert len(monitor.calls("/api/v1/inlet")) == 2
+    outlets = monitor.calls("/api/v1/outlet")
+    assert [o.get("inlet_skipped", False) for o in outlets] == [False, True, False]
+    # Three turns billed in full: nothing was deducted for an inlet cost that was never charged.
+    assert monitor.balance("u1") == monitor.initial_balance - 3 * monitor.turn_cost
+
+
+def test_model_with_default_inlet_cost_is_never_skipped(monitor, make_monitor_filter):
+    monitor.inlet_costs = {"default": 0.25, "free": 0.0}
+    flt = make_monitor_filter(balance_cache_ttl=30.0)
+
+    async def scenario():
+        await play_turn(flt, "t1", model="free")
+        await prices_loaded(flt)
+        await play_turn(flt, "t2", model="other")
+        await play_turn(flt, "t3", model="free")
+        await flt.close()
+
+    run(scenario())
+    assert inlet_models(monitor) == ["free", "other"]
+    assert monitor.balance("u1") == monitor.initial_balance - 3 * monitor.turn_cost
+
+
+def test_inlet_is_not_skipped_when_monitor_does_not_publish_inlet_costs(monitor, make_monitor_filter):
+    monitor.publish_inlet_costs = False
+    flt = make_monitor_filter(balance_cache_ttl=30.0)
+
+    async def scenario():
+        await play_turn(flt, "t1")
+        await prices_loaded(flt)
+        await play_turn(flt, "t2")
+        await flt.close()
+
+    run(scenario())
+    assert len(monitor.calls("/api/v1/inlet")) == 2
+    assert not any(o.get("inlet_skipped") for o in monitor.calls("/api/v1/outlet"))
+
+
+def delivered(monitor) -> list:
+    return [e for b in monitor.calls("/api/v1/outlet/batch") for e in b["events"]] + monitor.calls("/api/v1/outlet")
+
+
+def test_skipped_inlet_is_flagged_on_queued_outlets(monitor, make_monitor_filter):
+    flt = make_monitor_filter(balance_cache_ttl=30.0, async_reporting=True)
+
+    async def scenario():
+        await play_turn(flt, "t1")
+        await prices_loaded(flt)
+        await wait_until(lambda: len(delivered(monitor)) == 1)
+        await play_turn(flt, "t2")
+        await wait_until(lambda: len(delivered(monitor)) == 2)
+        await flt.close()
+
+    run(scenario())
+    flags = {e["idempotency_key"]: e.get("inlet_skipped", False) for e in delivered(monitor)}
+    assert flags == {"t1": False, "t2": True}
+
+
+def test_inlet_is_retried_on_another_replica_only_for_free_models(monitor, make_monitor_filter):
+    monitor.inlet_costs = {"paid": 0.5}
+    flt = make_monitor_filter(
+        api_endpoint="http://a.monitor.test,http://b.monitor.test", endpoint_retries=1, balance_cache_ttl=0.0
+    )
+    failures = []
+
+    def flaky_inlet(data):
+        monitor.handlers.pop("/api/v1/inlet")
+        failures.append(payload_model(data))
+        return httpx.Response(502, json={"success": False})
+
+    async def scenario():
+        await play_turn(flt, "t1", model="free")
+        await prices_loaded(flt)
+        monitor.handlers["/api/v1/inlet"] = flaky_inlet
+        await play_turn(flt, "t2", model="free")
+        monitor.handlers["/api/v1/inlet"] = flaky_inlet
+        with pytest.raises(Exception):
+            await play_turn(flt, "t3", model="paid")
+        await flt.close()
+
+    run(scenario())
+    assert failures == ["free", "paid"]
+    assert inlet_models(monitor) == ["free", "free", "free", "paid"]
+
+
+CHUNK = {"choices": [{"delta": {"content": "hi"}}]}
+
+
+def test_shared_state_stays_off_the_event_loop(monitor, monitor_module, make_monitor_filter, tmp_path, monkeypatch):
+    backend = monitor_module.SQLiteStateBackend
+    on_loop = []
+    for name in ("get", "set", "pop", "add", "update", "decrement"):
+        original = getattr(backend, name)
+
+        def spy(self, *args, _original=original, _name=name):
+            if threading.current_thread() is threading.main_thread():
+                on_loop.append(_name)
+            return _original(self, *args)
+
+        monkeypatch.setattr(backend, name, spy)
+    state = dict(state_backend="sqlite", state_url=str(tmp_path / "state.db"))
+    # Two workers: the inlet runs on one, the stream and outlet on the other.
+    first, second = make_monitor_filter(**state), make_monitor_filter(**state)
+    metadata = {"message_id": "t1", "chat_id": "c1"}
+
+    async def scenario():
+        await first.inlet(conversation(), __metadata__=metadata, __user__=user())
+        for _ in range(3):
+            second.stream(CHUNK, __metadata__=metadata)
+        await second.outlet(conversation(reply="hi"), __metadata__=metadata, __user__=user())
+        await first.close()
+        await second.close()
+
+    run(scenario())
+    assert on_loop == []
+    [outlet] = monitor.calls("/api/v1/outlet")
+    assert outlet["timing"]["chunks"] == 3 and outlet["timing"]["ttft_ms"] is not None
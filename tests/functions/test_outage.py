@@ -0,0 +1,86 @@
+import json
+
+from conftest import conversation, run, user, wait_until
+
+
+def test_breaker_opens_after_threshold_and_probes_once(monitor_module, clock):
+    breaker = monitor_module.CircuitBreaker(failure_threshold=2, reset_timeout=30.0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN and not breaker.allow()
+
+    clock[0] += 30.0
+    assert breaker.state == breaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+
+    clock[0] += 30.0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED and breaker.allow()
+    assert (breaker.opens, breaker.rejections) == (2, 2)
+
+
+def test_lost_half_open_probe_does_not_wedge_the_breaker(monitor_module, clock):
+    breaker = monitor_module.CircuitBreaker(failure_threshold=1, reset_timeout=10.0)
+    breaker.record_failure()
+    clock[0] += 10.0
+    assert breaker.allow()
+    clock[0] += 5.0
+    assert not breaker.allow()
+    clock[0] += 5.0
+    assert breaker.allow()
+
+
+def test_disabled_breaker_always_allows(monitor_module):
+    breaker = monitor_module.CircuitBreaker(failure_threshold=0)
+    for _ in range(10):
+        breaker.record_failure()
+    assert breaker.allow()
+
+
+def test_fail_open_turn_is_billed_its_inlet_cost_at_outlet(monitor, make_monitor_filter):
+    monitor.inlet_costs = {"m": 0.25}
+    flt = make_monitor_filter(outage_policy="fail_open")
+    metadata = {"message_id": "t1", "chat_id": "c1"}
+
+    async def scenario():
+        monitor.down = True
+        await flt.inlet(conversation(), __metadata__=metadata, __user__=user())
+        monitor.down = False
+        await flt.outlet(conversation(reply="hi"), __metadata__=metadata, __user__=user())
+        await flt.close()
+
+    run(scenario())
+    [outlet] = monitor.calls("/api/v1/outlet")
+    assert outlet["inlet_skipped"] is True
+    assert monitor.balance("u1") == monitor.initial_balance - monitor.turn_cost
+
+
+def test_deferred_turn_replays_with_inlet_skipped(monitor, make_monitor_filter):
+    monitor.inlet_costs = {"m": 0.25}
+    flt = make_monitor_filter(outage_policy="defer", report_retry_base_delay=0.01, report_retry_max_delay=0.02)
+    metadata = {"message_id": "t1", "chat_id": "c1"}
+
+    def spooled():
+        try:
+            with open(flt.valves.report_spool_path, encoding="utf-8") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    async def scenario():
+        monitor.down = True
+        await flt.inlet(conversation(), __metadata__=metadata, __user__=user())
+        await flt.outlet(conversation(reply="hi"), __metadata__=metadata, __user__=user())
+        await wait_until(lambda: len(spooled()) == 1)
+        assert spooled()[0]["payload"]["inlet_skipped"] is True
+        monitor.down = False
+        await wait_until(lambda: ("u1", "t1") in monitor.billed, timeout=5.0)
+        await flt.close()
+
+    run(scenario())
+    assert monitor.balance("u1") == monitor.initial_balance - monitor.turn_cost
@@ -0,0 +1,177 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import time
+
+import pytest
+
+from conftest import run
+
+
+def record(message_id: str, chat_id: str = "c1", user_id: str = "u1", created_at=None, **values) -> dict:
+    return {
+        "message_id": message_id,
+        "user_id": user_id,
+        "chat_id": chat_id,
+        "model": "m",
+        "created_at": time.time() if created_at is None else created_at,
+        "input_tokens": 10,
+        "output_tokens": 20,
+        "total_cost": 0.5,
+        "new_balance": 9.0,
+        "elapsed_time": 1.0,
+        "tokens_per_sec": 20.0,
+        **values,
+    }
+
+
+@pytest.fixture
+def store(invisible_module, tmp_path):
+    store = invisible_module.RecordStore(str(tmp_path / "records.db"))
+    yield store
+    store.close()
+
+
+def chat_rollup(store, chat_id: str = "c1") -> tuple:
+    return store._connect().execute(
+        "SELECT messages, input_tokens, total_cost FROM chat_usage WHERE chat_id = ?", (chat_id,)
+    ).fetchone()
+
+
+def test_concurrent_puts_share_a_transaction_and_roll_up(store, monkeypatch):
+    transactions = []
+    insert = store._insert
+    monkeypatch.setattr(store, "_insert", lambda records: (transactions.append(len(records)), insert(records)))
+
+    async def scenario():
+        await asyncio.gather(*(store.put(record(f"m{n}")) for n in range(5)))
+        # Rewriting a message replaces its contribution instead of adding to it.
+        await store.put(record("m0", input_tokens=30))
+
+    run(scenario())
+    assert sum(transactions[:-1]) == 5 and len(transactions) < 6
+    assert chat_rollup(store) == (5, 70, 2.5)
+
+
+def test_failed_transaction_is_raised_to_every_waiter(store, monkeypatch):
+    def failing_insert(records):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "_insert", failing_insert)
+
+    async def scenario():
+        return await asyncio.gather(*(store.put(record(f"m{n}")) for n in range(4)), return_exceptions=True)
+
+    results = run(scenario())
+    assert all(isinstance(r, OSError) for r in results)
+
+
+def test_migration_rolls_up_only_inserted_records(store, tmp_path):
+    directory = tmp_path / "record"
+    directory.mkdir()
+    for name in ("old1", "old2", "kept"):
+        (directory / f"{name}.json").write_text(
+            json.dumps({"user_id": "u1", "chat_id": "c1", "input_tokens": 1, "total_cost": 0.25})
+        )
+    (directory / "broken.json").write_text("{")
+    run(store.put(record("kept")))
+
+    assert store.migrate_json_directory(str(directory)) == 2
+    assert store.get("kept")["input_tokens"] == 10
+    assert chat_rollup(store) == (3, 12, 1.0)
+    # The marker stops a second import from counting the files again.
+    assert store.migrate_json_directory(str(directory)) == 0
+    assert chat_rollup(store) == (3, 12, 1.0)
+    assert os.path.exists(directory / "old1.json")
+
+
+DAY = 86400
+
+
+def seed(store, ages_in_days: list) -> list:
+    now = time.time()
+    records = [record(f"m{n}", created_at=now - age * DAY) for n, age in enumerate(ages_in_days)]
+
+    async def write():
+        for r in records:
+            await store.put(r)
+
+    run(write())
+    return records
+
+
+def test_compact_moves_old_records_into_day_segments_and_keeps_rollups(store, invisible_module):
+    records = seed(store, [10, 10, 9, 1])
+    before = chat_rollup(store)
+
+    assert store.compact(older_than_days=7) == 3
+    conn = store._connect()
+    assert conn.execute("SELECT COUNT(*) FROM usage_records").fetchone()[0] == 1
+    segments = dict(conn.execute("SELECT day, records FROM usage_segments").fetchall())
+    assert segments == {
+        invisible_module.local_day(records[0]["created_at"]): 2,
+        invisible_module.local_day(records[2]["created_at"]): 1,
+    }
+    assert chat_rollup(store) == before
+    # Compacting again has nothing to do; a late record for a compacted day is merged in.
+    assert store.compact(older_than_days=7) == 0
+    run(store.put(record("late", created_at=records[0]["created_at"])))
+    assert store.compact(older_than_days=7) == 1
+    day = invisible_module.local_day(records[0]["created_at"])
+    assert conn.execute("SELECT records FROM usage_segments WHERE day = ?", (day,)).fetchone()[0] == 3
+
+
+def test_retention_drops_old_records_segments_and_daily_rollups(store):
+    seed(store, [30, 20, 1])
+    store.compact(older_than_days=25)
+
+    assert store.enforce_retention(retention_days=10) == 2
+    conn = store._connect()
+    assert conn.execute("SELECT COUNT(*) FROM usage_records").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM usage_segments").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM user_daily_usage").fetchone()[0] == 1
+
+
+def test_maintenance_is_claimed_by_one_worker_per_interval(store, invisible_module):
+    seed(store, [30, 1])
+    other = invisible_module.RecordStore(store.path)
+    try:
+        assert store.maintain(compact_after_days=7, retention_days=0, min_interval=3600) == {"removed": 0, "compacted": 1}
+        assert other.maintain(compact_after_days=7, retention_days=0, min_interval=3600) is None
+    finally:
+        other.close()
+
+
+def test_export_streams_segments_then_records_within_the_range(store, invisible_module):
+    records = seed(store, [10, 5, 1])
+    store.compact(older_than_days=7)
+    start = invisible_module.local_day(records[1]["created_at"])
+
+    out = io.StringIO()
+    assert store.export(out, "ndjson") == 3
+    assert [json.loads(line)["message_id"] for line in out.getvalue().splitlines()] == ["m0", "m1", "m2"]
+
+    out = io.StringIO()
+    assert store.export(out, "csv", start=start) == 2
+    rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+    assert [row["message_id"] for row in rows] == ["m1", "m2"]
+    assert rows[0]["input_tokens"] == "10"
+
+
+def test_button_finds_compacted_records_by_timestamp_only(store, button_module, tmp_path, monkeypatch):
+    records = seed(store, [10])
+    store.compact(older_than_days=7)
+    monkeypatch.setattr(button_module, "RECORD_DIRECTORY", str(tmp_path / "record"))
+    reader = button_module.RecordReader(store.path)
+
+    found = reader.get("m0", records[0]["created_at"] - 60)
+    assert found["input_tokens"] == 10 and found["chat_id"] == "c1"
+    # Milliseconds, as some Open WebUI versions send them.
+    assert reader.get("m0", (records[0]["created_at"] - 60) * 1000)["message_id"] == "m0"
+    # Other days and missing timestamps never unpack segments; the legacy JSON file is the fallback.
+    assert reader.get("m0", records[0]["created_at"] - 3 * DAY) is None
+    (tmp_path / "record").mkdir()
+    (tmp_path / "record" / "m0.json").write_text(json.dumps({"input_tokens": 7}))
+    assert reader.get("m0") == {"input_tokens": 7}
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import os
+import types
+
+import pytest
+
+from conftest import conversation, run, user, wait_until
+
+
+@pytest.fixture
+def valves(tmp_path):
+    return types.SimpleNamespace(
+        report_queue_size=100,
+        report_batch_size=10,
+        report_batch_window=0.0,
+        report_retry_base_delay=0.01,
+        report_retry_max_delay=0.02,
+        report_max_attempts=0,
+        report_spool_path=str(tmp_path / "spool.ndjson"),
+    )
+
+
+class Sender:
+    """Records delivered payloads; while ``down`` every delivery fails."""
+
+    def __init__(self):
+        self.down = False
+        self.delivered = []
+
+    async def __call__(self, payloads):
+        if self.down:
+            raise ConnectionError("monitor down")
+        self.delivered.extend(payloads)
+        return [{"success": True, "id": p["id"]} for p in payloads]
+
+
+def event(n: int) -> dict:
+    return {"id": f"e{n}", "payload": {"id": n}}
+
+
+def spooled(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_failed_events_are_spooled_and_replayed_on_recovery(monitor_module, valves):
+    send = Sender()
+    send.down = True
+    reporter = monitor_module.UsageReporter(send, lambda: valves)
+
+    async def scenario():
+        for n in range(3):
+            await reporter.submit(event(n))
+        await wait_until(lambda: len(spooled(valves.report_spool_path)) == 3)
+        send.down = False
+        await wait_until(lambda: len(send.delivered) == 3)
+        await reporter.stop()
+
+    run(scenario())
+    assert sorted(p["id"] for p in send.delivered) == [0, 1, 2]
+    assert not os.path.exists(valves.report_spool_path)
+    assert not os.path.exists(valves.report_spool_path + ".replay")
+
+
+def test_events_past_max_attempts_go_to_dead_letter(monitor_module, valves):
+    valves.report_max_attempts = 2
+    send = Sender()
+    send.down = True
+    reporter = monitor_module.UsageReporter(send, lambda: valves)
+    dead_path = valves.report_spool_path + ".dead"
+
+    async def scenario():
+        await reporter.submit(event(1))
+        await wait_until(lambda: len(spooled(dead_path)) == 1)
+        await reporter.stop()
+
+    run(scenario())
+    [dead] = spooled(dead_path)
+    assert dead["id"] == "e1" and dead["attempts"] == 2
+    assert "monitor down" in dead["last_error"]
+    assert spooled(valves.report_spool_path) == []
+
+
+def test_leftover_replay_file_is_delivered_first_and_corrupt_lines_are_dead_lettered(monitor_module, valves):
+    with open(valves.report_spool_path + ".replay", "w", encoding="utf-8") as f:
+        f.write(json.dumps(event(1)) + "\n{not json\n")
+    with open(valves.report_spool_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(event(2)) + "\n")
+    send = Sender()
+    reporter = monitor_module.UsageReporter(send, lambda: valves)
+
+    async def scenario():
+        reporter.ensure_started()
+        await wait_until(lambda: len(send.delivered) == 2)
+        await reporter.stop()
+
+    run(scenario())
+    assert [p["id"] for p in send.delivered] == [1, 2]
+    with open(valves.report_spool_path + ".dead", encoding="utf-8") as f:
+        assert f.read() == "{not json\n"
+
+
+def test_stop_spools_queued_events_and_fails_waiters(monitor_module, valves):
+    send = Sender()
+    reporter = monitor_module.UsageReporter(send, lambda: valves)
+
+    async def scenario():
+        reporter._queue.put_nowait(event(1))
+        await reporter.stop()
+
+    run(scenario())
+    assert [e["id"] for e in spooled(valves.report_spool_path)] == ["e1"]
+    assert send.delivered == []
+
+
+def test_waited_submit_raises_instead_of_spooling(monitor_module, valves):
+    send = Sender()
+    send.down = True
+    reporter = monitor_module.UsageReporter(send, lambda: valves)
+
+    async def scenario():
+        with pytest.raises(ConnectionError):
+            await reporter.submit(event(1), wait=True)
+        await reporter.stop()
+
+    run(scenario())
+    assert spooled(valves.report_spool_path) == []
+
+
+def test_filter_spools_outlets_while_monitor_is_down(monitor, make_monitor_filter):
+    flt = make_monitor_filter(async_reporting=True, report_retry_base_delay=0.01, report_retry_max_delay=0.02)
+    spool = flt.valves.report_spool_path
+
+    async def scenario():
+        metadata = {"message_id": "t1", "chat_id": "c1"}
+        await flt.inlet(conversation(), __metadata__=metadata, __user__=user())
+        monitor.down = True
+        await flt.outlet(conversation(reply="hi"), __metadata__=metadata, __user__=user())
+        await wait_until(lambda: len(spooled(spool)) == 1)
+        monitor.down = False
+        await wait_until(lambda: monitor.calls("/api/v1/outlet/batch") or monitor.calls("/api/v1/outlet"))
+        await flt.close()
+
+    run(scenario())
+    assert ("u1", "t1") in monitor.billed
+    assert monitor.balance("u1") == monitor.initial_balance - monitor.turn_cost
+
+
+def test_workers_sharing_a_spool_replay_each_event_once(monitor_module, valves):
+    valves.report_batch_size = 1
+    with open(valves.report_spool_path, "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(event(n)) + "\n" for n in range(5))
+    delivered = []
+
+    async def slow_send(payloads):
+        await asyncio.sleep(0.02)
+        delivered.extend(payloads)
+        return [{"success": True} for _ in payloads]
+
+    first, second = (monitor_module.UsageReporter(slow_send, lambda: valves) for _ in range(2))
+
+    async def scenario():
+        first.ensure_started()
+        # The second worker starts while the first is halfway through the .replay file.
+        await wait_until(lambda: len(delivered) >= 2)
+        second.ensure_started()
+        await second.submit(event(5))
+        await wait_until(lambda: len(delivered) >= 6)
+        await asyncio.sleep(0.2)
+        await first.stop()
+        await second.stop()
+
+    run(scenario())
+    assert sorted(p["id"] for p in delivered) == list(range(6))
+    assert not os.path.exists(valves.report_spool_path + ".replay")